@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Benchmark of JSON encoding for jsonb parameters
+Compares the previous json.dumps text parameters with the binary jsonb codec
+under each available encoder, on the payloads the mapper prepares for writes
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+# Add the hms_integration directory to Python path
+sys.path.append(str(Path(__file__).parent))
+
+import json_codecs  # noqa: E402
+from benchmark_validation import best_of, sample_rows  # noqa: E402
+
+
+def run(rows: int, repeat: int):
+    from sync_registry import SYNC_DATA_TYPES
+    from sync_pipeline import validate_records
+
+    print(f"{'data type':<14}{'encoder':<34}{'seconds':>10}{'values/s':>14}{'speedup':>10}")
+    for name in ("vitals", "lab_results", "diagnoses"):
+        data_type = SYNC_DATA_TYPES[name]
+        prepared = data_type.transform(validate_records(sample_rows(name, rows), data_type.record))
+        # The JSON payload sits at the same position in every row of a data type
+        position = next(index for index, value in enumerate(prepared[0]) if isinstance(value, dict))
+        payloads = [row[position] for row in prepared]
+
+        strategies = [("json.dumps text (previous)", lambda: [json.dumps(value) for value in payloads])]
+        for encoder, (dumps, _) in json_codecs.ENCODERS.items():
+            strategies.append((f"{encoder} jsonb binary codec",
+                               lambda dumps=dumps: [json_codecs.JSONB_VERSION + dumps(value) for value in payloads]))
+
+        baseline = None
+        for label, function in strategies:
+            seconds = best_of(function, repeat)
+            baseline = baseline or seconds
+            print(f"{name:<14}{label:<34}{seconds:>10.3f}{rows / seconds:>14,.0f}{baseline / seconds:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
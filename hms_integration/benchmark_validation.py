@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark of record validation strategies for HMS bulk imports
+Compares per-row pydantic model construction with batch TypeAdapter
+validation and the trusted path used for column-converted file rows, and
+the memory held per in-flight record by models and slotted records
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import pandas as pd
+
+# Add the hms_integration directory to Python path
+sys.path.append(str(Path(__file__).parent))
+
+from converters import FRAME_SCHEMAS, convert_frame, records_from_frame, rows_from_frame  # noqa: E402
+from sync_pipeline import validate_records  # noqa: E402
+
+
+def sample_rows(data_type: str, count: int) -> List[Dict[str, Any]]:
+    """Synthetic raw rows shaped like an HMS export, all values as strings"""
+    start = datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        when = (start + timedelta(minutes=i)).isoformat()
+        row = {"patient_id": f"P{i % 5000:05d}", "encounter_id": f"E{i}"}
+        if data_type == "vitals":
+            row.update(timestamp=when, systolic_bp=str(110 + i % 60), diastolic_bp=str(70 + i % 30),
+                       heart_rate=str(60 + i % 70), temperature="37.1", respiratory_rate=str(12 + i % 15),
+                       oxygen_saturation=str(90 + i % 10), recorded_by="nurse")
+        elif data_type == "lab_results":
+            row.update(test_name="Hemoglobin", test_code="HGB", result_value="13.2", result_numeric="13.2",
+                       units="g/dL", ordered_date=when, result_date=when)
+        elif data_type == "prescriptions":
+            row.update(medication_name="Amoxicillin", dosage="500mg", frequency="TDS", quantity="21",
+                       prescribed_date=when, prescribed_by="dr-1")
+        else:
+            row.update(diagnosis_code="J18.9", diagnosis_name="Pneumonia", diagnosed_date=when, diagnosed_by="dr-1")
+        rows.append(row)
+    return rows
+
+
+def best_of(function: Callable[[], Any], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def allocated_per_item(build: Callable[[], List[Any]]) -> float:
+    """Bytes still allocated per item while the built list is alive"""
+    tracemalloc.start()
+    try:
+        items = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current / max(1, len(items))
+
+
+def run(rows: int, repeat: int):
+    from sync_registry import SYNC_DATA_TYPES
+
+    print(f"{'data type':<14}{'strategy':<34}{'seconds':>10}{'rows/s':>14}{'speedup':>10}")
+    for name, data_type in SYNC_DATA_TYPES.items():
+        model, record = data_type.model, data_type.record
+        raw = sample_rows(name, rows)
+        converted, _ = convert_frame(pd.DataFrame(raw), FRAME_SCHEMAS[name])
+
+        strategies = [
+            # Previous sync endpoint path: one model_validate call per fetched record
+            ("sync: per-row model_validate", lambda: [model.model_validate(row) for row in raw]),
+            ("sync: batch TypeAdapter", lambda: validate_records(raw, record)),
+            # Previous file endpoint path: one model(**row) per converted row
+            ("file: per-row model(**row)", lambda: [model(**row) for row in rows_from_frame(converted)]),
+            ("file: batch TypeAdapter", lambda: validate_records(rows_from_frame(converted), record)),
+            ("file: trusted records", lambda: records_from_frame(converted, record)),
+        ]
+        baseline = None
+        for label, function in strategies:
+            seconds = best_of(function, repeat)
+            if "per-row" in label:
+                baseline = seconds
+            print(f"{name:<14}{label:<34}{seconds:>10.3f}{rows / seconds:>14,.0f}{baseline / seconds:>9.1f}x")
+
+        model_bytes = allocated_per_item(lambda: [model(**row) for row in rows_from_frame(converted)])
+        record_bytes = allocated_per_item(lambda: records_from_frame(converted, record))
+        print(f"{name:<14}{'memory per record':<34}{'model':>10}{model_bytes:>13,.0f}B"
+              f"  record {record_bytes:,.0f}B ({model_bytes / record_bytes:.1f}x less)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
@@ -0,0 +1,273 @@
+"""
+Streaming decompression of gzip and zstd uploads
+Handles compressed file extensions and request bodies sent with Content-Encoding
+"""
+
+import gzip
+import io
+import logging
+import os
+import zlib
+from typing import Any, Callable, Dict, Tuple
+
+import zstandard
+from fastapi import HTTPException
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse
+
+logger = logging.getLogger(__name__)
+
+# Largest inflated size accepted for one compressed upload or request body
+MAX_INFLATED_BYTES = int(os.getenv("HMS_MAX_INFLATED_BYTES", str(8 * 1024 ** 3)))
+INFLATE_CHUNK_BYTES = 1024 * 1024
+
+COMPRESSED_EXTENSIONS = {
+    ".gz": "gzip",
+    ".gzip": "gzip",
+    ".zst": "zstd",
+    ".zstd": "zstd",
+}
+
+
+def _inflate_limit_error(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Inflated content exceeds {limit} bytes")
+
+
+class _ZlibDecompressor:
+    """zlib decompressobj that continues into further gzip members and stops at limit bytes"""
+
+    def __init__(self, wbits: int, limit: int):
+        self.wbits = wbits
+        self.limit = limit
+        self.inflated = 0
+        self._decompressor = zlib.decompressobj(wbits=wbits)
+
+    def decompress(self, data: bytes) -> bytes:
+        output = []
+        while data:
+            # One byte over the remaining budget is enough to tell that the limit was crossed
+            chunk = self._decompressor.decompress(data, self.limit - self.inflated + 1)
+            self.inflated += len(chunk)
+            if self.inflated > self.limit:
+                raise _inflate_limit_error(self.limit)
+            output.append(chunk)
+            if not self._decompressor.eof:
+                data = self._decompressor.unconsumed_tail
+                continue
+            data = self._decompressor.unused_data
+            if data and self.wbits > zlib.MAX_WBITS:
+                # Concatenated gzip members (e.g. appended exports) form one stream
+                self._decompressor = zlib.decompressobj(wbits=self.wbits)
+            elif data:
+                raise zlib.error("trailing data after the deflate stream")
+        return b"".join(output)
+
+    def flush(self) -> bytes:
+        if not self._decompressor.eof and self.inflated:
+            raise zlib.error("incomplete compressed stream")
+        return b""
+
+
+ZSTD_FRAME_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class _ZstdFrameTracker:
+    """Follows zstd frame and block headers in the compressed bytes to tell whether the last frame ended
+
+    Only headers are read; block contents are skipped by their declared size.
+    Malformed input is left for the decompressor to reject.
+    """
+
+    def __init__(self):
+        self._state = "magic"
+        self._header = bytearray()
+        self._skip = 0
+        self._checksum = False
+
+    @property
+    def complete(self) -> bool:
+        return self._state in ("magic", "invalid") and not self._header and not self._skip
+
+    def feed(self, data: bytes):
+        position = 0
+        while position < len(data) and self._state != "invalid":
+            if self._skip:
+                taken = min(self._skip, len(data) - position)
+                self._skip -= taken
+                position += taken
+                continue
+            wanted = {"magic": 4, "skippable": 4, "frame": 1, "block": 3}[self._state]
+            taken = min(wanted - len(self._header), len(data) - position)
+            self._header += data[position:position + taken]
+            position += taken
+            if len(self._header) == wanted:
+                header, self._header = bytes(self._header), bytearray()
+                self._advance(header)
+
+    def _advance(self, header: bytes):
+        if self._state == "magic":
+            if header == ZSTD_FRAME_MAGIC:
+                self._state = "frame"
+            elif header[1:] == b"\x2a\x4d\x18" and header[0] & 0xF0 == 0x50:
+                self._state = "skippable"
+            else:
+                self._state = "invalid"
+        elif self._state == "skippable":
+            self._skip = int.from_bytes(header, "little")
+            self._state = "magic"
+        elif self._state == "frame":
+            descriptor = header[0]
+            single_segment = bool(descriptor & 0x20)
+            self._checksum = bool(descriptor & 0x04)
+            # Window descriptor, dictionary ID and frame content size follow the descriptor byte
+            self._skip = ((0 if single_segment else 1) + (0, 1, 2, 4)[descriptor & 0x03]
+                          + ((1 if single_segment else 0), 2, 4, 8)[descriptor >> 6])
+            self._state = "block"
+        else:
+            block = int.from_bytes(header, "little")
+            block_type, block_size = (block >> 1) & 0x03, block >> 3
+            # RLE blocks carry a single byte whatever their regenerated size
+            self._skip = 1 if block_type == 1 else block_size
+            if block & 0x01:
+                self._skip += 4 if self._checksum else 0
+                self._state = "magic"
+
+
+class _ZstdDecompressor:
+    """zstd decompressor across frames, with the decompress/flush interface of zlib, stopping at limit bytes"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.inflated = 0
+        self._output: list = []
+        self._frames = _ZstdFrameTracker()
+        # A writer rather than decompressobj: output arrives in write_size pieces,
+        # so decompression stops as soon as the limit is crossed
+        self._writer = zstandard.ZstdDecompressor().stream_writer(self, write_size=INFLATE_CHUNK_BYTES,
+                                                                  closefd=False)
+
+    def write(self, chunk) -> int:
+        self.inflated += len(chunk)
+        if self.inflated > self.limit:
+            raise _inflate_limit_error(self.limit)
+        self._output.append(bytes(chunk))
+        return len(chunk)
+
+    def decompress(self, data: bytes) -> bytes:
+        if data:
+            self._writer.write(data)
+            self._frames.feed(data)
+        output, self._output = self._output, []
+        return b"".join(output)
+
+    def flush(self) -> bytes:
+        if not self._frames.complete:
+            raise zstandard.ZstdError("incomplete compressed stream")
+        return b""
+
+
+# Incremental decompressors by Content-Encoding token, each taking the inflated size limit
+DECOMPRESSORS: Dict[str, Callable[[int], Any]] = {
+    "gzip": lambda limit: _ZlibDecompressor(16 + zlib.MAX_WBITS, limit),
+    "x-gzip": lambda limit: _ZlibDecompressor(16 + zlib.MAX_WBITS, limit),
+    "deflate": lambda limit: _ZlibDecompressor(zlib.MAX_WBITS, limit),
+    "zstd": _ZstdDecompressor,
+}
+
+
+class LimitedReader(io.RawIOBase):
+    """Reader over a decompressing stream that fails once more than limit bytes were inflated"""
+
+    def __init__(self, stream, limit: int):
+        self.stream = stream
+        self.limit = limit
+        self.inflated = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        # Bounded reads: never more than the buffer (or one byte past the limit) is inflated at once
+        data = self.stream.read(min(len(buffer), self.limit - self.inflated + 1))
+        self.inflated += len(data)
+        if self.inflated > self.limit:
+            raise _inflate_limit_error(self.limit)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def split_compression(filename: str) -> Tuple[str, str]:
+    """Split 'vitals.csv.gz' into ('vitals.csv', 'gzip'); uncompressed names get an empty encoding"""
+    lowered = filename.lower()
+    for extension, encoding in COMPRESSED_EXTENSIONS.items():
+        if lowered.endswith(extension):
+            return filename[:-len(extension)], encoding
+    return filename, ""
+
+
+def open_decompressed(fileobj, encoding: str, limit: int = MAX_INFLATED_BYTES):
+    """Wrap an upload in a reader that inflates it as it is read, never all at once
+
+    Every gzip member and zstd frame is read, and reading fails with 413
+    once more than limit bytes were inflated.
+    """
+    if encoding == "gzip":
+        stream = gzip.GzipFile(fileobj=fileobj, mode="rb")
+    elif encoding == "zstd":
+        stream = zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=False)
+    else:
+        return fileobj
+    return io.BufferedReader(LimitedReader(stream, limit), INFLATE_CHUNK_BYTES)
+
+
+class RequestDecompressionMiddleware:
+    """Inflates request bodies sent with Content-Encoding gzip, deflate or zstd
+
+    Each body chunk is decompressed as the application receives it, so
+    multipart uploads and streamed NDJSON pushes are parsed from the
+    inflated stream without the whole payload being held in memory.
+    Content-Encoding and Content-Length are dropped from the request
+    headers because they no longer describe the body the application sees.
+    A body inflating to more than max_inflated bytes is rejected with 413.
+    """
+
+    def __init__(self, app, max_inflated: int = MAX_INFLATED_BYTES):
+        self.app = app
+        self.max_inflated = max_inflated
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = Headers(scope=scope).get("content-encoding", "").strip().lower()
+        if not encoding or encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+
+        if encoding not in DECOMPRESSORS:
+            response = PlainTextResponse(f"Unsupported Content-Encoding: {encoding}", status_code=415)
+            await response(scope, receive, send)
+            return
+
+        decompressor = DECOMPRESSORS[encoding](self.max_inflated)
+        scope = dict(scope)
+        scope["headers"] = [
+            (name, value) for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+
+        async def receive_decompressed():
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            try:
+                body = decompressor.decompress(message.get("body", b""))
+                if not message.get("more_body", False):
+                    body += decompressor.flush()
+            except (zlib.error, zstandard.ZstdError) as e:
+                logger.warning(f"Rejected {encoding} request body: {e}")
+                raise HTTPException(status_code=400, detail=f"Invalid {encoding} request body: {e}")
+            return {**message, "body": body}
+
+        await self.app(scope, receive_decompressed, send)
@@ -0,0 +1,360 @@
+"""
+Column-wise conversion of uploaded HMS data
+Coerces whole DataFrame chunks to typed columns and masks out invalid rows,
+with site-specific column mappings selected by a fingerprint of the header row
+"""
+
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+logger = logging.getLogger(__name__)
+
+
+class FrameSchema:
+    """Column types, required columns and defaults for one upload data type"""
+
+    def __init__(self, name: str, text: List[str], numeric: List[str], datetimes: List[str],
+                 required: List[str], natural_key: List[str], defaults: Optional[Dict[str, Any]] = None,
+                 default_now: Optional[List[str]] = None):
+        self.name = name
+        self.text = text
+        self.numeric = numeric
+        self.datetimes = datetimes
+        self.required = required
+        # Columns identifying the same record across re-uploads
+        self.natural_key = natural_key
+        # Constant fill for empty or missing columns
+        self.defaults = defaults or {}
+        # Datetime columns that default to the upload time when the column is absent
+        self.default_now = default_now or []
+
+    @property
+    def columns(self) -> List[str]:
+        return self.text + self.numeric + self.datetimes
+
+
+FRAME_SCHEMAS: Dict[str, FrameSchema] = {
+    "vitals": FrameSchema(
+        "vitals",
+        text=["patient_id", "encounter_id", "recorded_by"],
+        numeric=["systolic_bp", "diastolic_bp", "heart_rate", "temperature", "respiratory_rate",
+                 "oxygen_saturation", "weight", "height", "bmi"],
+        datetimes=["timestamp"],
+        required=["patient_id", "timestamp"],
+        natural_key=["patient_id", "timestamp"],
+        default_now=["timestamp"],
+    ),
+    "lab_results": FrameSchema(
+        "lab_results",
+        text=["patient_id", "order_id", "test_name", "test_code", "result_value", "reference_range",
+              "units", "status", "ordered_by", "resulted_by"],
+        numeric=["result_numeric"],
+        datetimes=["ordered_date", "result_date"],
+        required=["patient_id", "test_name", "ordered_date"],
+        natural_key=["patient_id", "test_name", "ordered_date"],
+        defaults={"status": "completed"},
+        default_now=["ordered_date"],
+    ),
+    "prescriptions": FrameSchema(
+        "prescriptions",
+        text=["patient_id", "encounter_id", "medication_name", "medication_code", "dosage", "frequency",
+              "duration", "instructions", "prescribed_by", "status"],
+        numeric=["quantity"],
+        datetimes=["prescribed_date"],
+        required=["patient_id", "medication_name", "dosage", "frequency", "prescribed_date", "prescribed_by"],
+        natural_key=["patient_id", "medication_name", "prescribed_date"],
+        defaults={"status": "active"},
+    ),
+    "diagnoses": FrameSchema(
+        "diagnoses",
+        text=["patient_id", "encounter_id", "diagnosis_code", "diagnosis_name", "diagnosis_type", "status",
+              "diagnosed_by"],
+        numeric=[],
+        datetimes=["diagnosed_date"],
+        required=["patient_id", "diagnosis_code", "diagnosis_name", "diagnosed_date", "diagnosed_by"],
+        natural_key=["patient_id", "diagnosis_code", "diagnosed_date"],
+        defaults={"diagnosis_type": "primary", "status": "confirmed"},
+    ),
+}
+
+
+def _blank(values: pd.Series) -> pd.Series:
+    """Mask of missing or whitespace-only cells"""
+    return values.isna() | (values.astype(str).str.strip() == "")
+
+
+def convert_frame(frame: pd.DataFrame, schema: FrameSchema,
+                  date_formats: Optional[Dict[str, str]] = None) -> Tuple[pd.DataFrame, int]:
+    """Coerce a raw chunk to typed columns in one pass per column
+
+    Returns only the rows that passed, with exactly the schema's columns,
+    plus the number of rejected rows. A row is rejected when a required
+    column is blank or a non-blank cell cannot be parsed as its type.
+    Datetime columns are parsed as ISO 8601 unless date_formats names an
+    explicit strptime format for them.
+    """
+    date_formats = date_formats or {}
+    row_count = len(frame)
+    invalid = np.zeros(row_count, dtype=bool)
+    columns: Dict[str, pd.Series] = {}
+    now = pd.Timestamp(datetime.utcnow())
+
+    for name in schema.text:
+        if name not in frame:
+            columns[name] = pd.Series([schema.defaults.get(name)] * row_count, index=frame.index, dtype=object)
+            continue
+        values = frame[name].astype(object)
+        # Cast to str so typed sources (e.g. integer IDs in Parquet) match the models' str fields
+        columns[name] = values.astype(str).where(~_blank(values), schema.defaults.get(name))
+
+    for name in schema.numeric:
+        if name not in frame:
+            columns[name] = pd.Series(np.nan, index=frame.index, dtype="float64")
+            continue
+        blank = _blank(frame[name])
+        parsed = pd.to_numeric(frame[name].where(~blank), errors="coerce")
+        invalid |= (~blank & parsed.isna()).to_numpy()
+        columns[name] = parsed.astype("float64")
+
+    for name in schema.datetimes:
+        if name not in frame:
+            fill = now if name in schema.default_now else pd.NaT
+            columns[name] = pd.Series(fill, index=frame.index, dtype="datetime64[ns]")
+            continue
+        blank = _blank(frame[name])
+        parsed = pd.to_datetime(frame[name].where(~blank), errors="coerce", utc=True,
+                                format=date_formats.get(name, "ISO8601"))
+        invalid |= (~blank & parsed.isna()).to_numpy()
+        # Stored as naive UTC, matching datetime.utcnow() everywhere else in the service
+        columns[name] = parsed.dt.tz_localize(None)
+
+    for name in schema.required:
+        invalid |= columns[name].isna().to_numpy()
+
+    clean = pd.DataFrame(columns, index=frame.index)[~invalid]
+    rejected = int(invalid.sum())
+    if rejected:
+        logger.warning(f"Rejected {rejected} of {row_count} {schema.name} rows during column conversion")
+    return clean, rejected
+
+
+def rows_from_frame(frame: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Plain row dicts from a converted frame, NaN/NaT as None"""
+    columns = list(frame.columns)
+    values = []
+    for name in columns:
+        column = frame[name].to_numpy(dtype=object)
+        missing = frame[name].isna().to_numpy()
+        if missing.any():
+            column[missing] = None
+        values.append(column)
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def records_from_frame(frame: pd.DataFrame, record_type: type) -> List[Any]:
+    """Build records from a frame produced by convert_frame without validating each row again
+
+    convert_frame has already typed every column and rejected rows missing
+    a required value, so records are built positionally straight from the
+    columns; NaN/NaT become None and no per-row dicts are created.
+    """
+    fields = list(record_type.__slots__)
+    values = []
+    for name in fields:
+        if name not in frame:
+            values.append([None] * len(frame))
+            continue
+        column = frame[name].to_numpy(dtype=object)
+        missing = frame[name].isna().to_numpy()
+        if missing.any():
+            column[missing] = None
+        values.append(column)
+    return [record_type(*row) for row in zip(*values)]
+
+
+def frame_from_records(records: List[Any], schema: FrameSchema) -> pd.DataFrame:
+    """Converted column frame from validated records, e.g. for a COPY writer"""
+    frame = pd.DataFrame({name: [getattr(record, name) for record in records] for name in schema.columns})
+    return convert_frame(frame, schema)[0]
+
+
+def frame_to_csv(frame: pd.DataFrame, columns: List[str]) -> pa.Buffer:
+    """Serialize converted columns as headerless CSV for COPY, entirely in Arrow
+
+    Nulls are written unquoted and strings quoted, so COPY ... CSV reads
+    missing values as NULL and empty strings as ''. Timestamps are cut to
+    microseconds, the precision Postgres stores.
+    """
+    table = pa.Table.from_pandas(frame[columns], preserve_index=False)
+    for index, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(index, field.name, table.column(index).cast(pa.timestamp("us"), safe=False))
+    sink = pa.BufferOutputStream()
+    pa_csv.write_csv(table, sink, write_options=pa_csv.WriteOptions(include_header=False))
+    return sink.getvalue()
+
+
+CONVERTER_MAPPINGS_PATH = os.getenv("HMS_CONVERTER_MAPPINGS")
+# Compiled converters kept; every distinct export header compiles one, so the least recently used are dropped
+CONVERTER_CACHE_SIZE = int(os.getenv("HMS_CONVERTER_CACHE_SIZE", "256"))
+
+
+def normalize_header(name: Any) -> str:
+    return str(name).lstrip("\ufeff").strip().lower()
+
+
+def header_fingerprint(columns: List[Any]) -> str:
+    """Identify an export layout by its set of column names, ignoring order, case and padding"""
+    names = sorted(normalize_header(name) for name in columns)
+    return hashlib.sha1("\x1f".join(names).encode()).hexdigest()[:16]
+
+
+class SiteMapping:
+    """A hospital export layout: source column names and date formats for one data type
+
+    The layout is matched by fingerprint, given explicitly or derived from
+    the full header row; without either, the mapped source columns are
+    taken to be the whole header.
+    """
+
+    def __init__(self, name: str, data_type: str, columns: Dict[str, str],
+                 date_formats: Optional[Dict[str, str]] = None, headers: Optional[List[str]] = None,
+                 fingerprint: Optional[str] = None):
+        if data_type not in FRAME_SCHEMAS:
+            raise ValueError(f"Mapping {name} targets unknown data type {data_type}")
+        unknown = set(columns.values()) - set(FRAME_SCHEMAS[data_type].columns)
+        if unknown:
+            raise ValueError(f"Mapping {name} maps to unknown {data_type} columns: {', '.join(sorted(unknown))}")
+        self.name = name
+        self.data_type = data_type
+        self.columns = {normalize_header(source): target for source, target in columns.items()}
+        self.date_formats = date_formats or {}
+        self.fingerprint = fingerprint or header_fingerprint(headers or list(columns))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "data_type": self.data_type,
+            "fingerprint": self.fingerprint,
+            "columns": self.columns,
+            "date_formats": self.date_formats
+        }
+
+
+class CompiledConverter:
+    """Converter for one header layout: which source columns to keep and what they become
+
+    Built once per (data type, fingerprint) and keyed by normalized header
+    names; converting a chunk is a column selection, a rename and
+    convert_frame, with no per-row key lookups.
+    """
+
+    def __init__(self, data_type: str, fingerprint: str, rename: Dict[str, str],
+                 date_formats: Dict[str, str], mapping_name: Optional[str] = None):
+        self.schema = FRAME_SCHEMAS[data_type]
+        self.fingerprint = fingerprint
+        self.rename = rename
+        self.date_formats = date_formats
+        self.mapping_name = mapping_name
+
+    def source_columns(self, columns: List[Any]) -> List[Any]:
+        """The raw column names this converter reads, e.g. for a Parquet column projection"""
+        return [name for name in columns if normalize_header(name) in self.rename]
+
+    def convert(self, frame: pd.DataFrame) -> Tuple[pd.DataFrame, int]:
+        selected = {}
+        for name in frame.columns:
+            target = self.rename.get(normalize_header(name))
+            if target is not None and target not in selected:
+                selected[target] = frame[name]
+        return convert_frame(pd.DataFrame(selected, index=frame.index), self.schema, self.date_formats)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "data_type": self.schema.name,
+            "fingerprint": self.fingerprint,
+            "mapping": self.mapping_name,
+            "columns": self.rename
+        }
+
+
+class ConverterRegistry:
+    """Site mappings by header fingerprint, compiled into converters on first use and cached
+
+    Headers without a registered mapping compile to the standard column
+    names, matched case-insensitively. At most cache_size compiled
+    converters are kept, least recently used first out.
+    """
+
+    def __init__(self, mappings: Optional[List[SiteMapping]] = None, cache_size: int = CONVERTER_CACHE_SIZE):
+        self._mappings: Dict[Tuple[str, str], SiteMapping] = {}
+        self.cache_size = cache_size
+        self._compiled: "OrderedDict[Tuple[str, str], CompiledConverter]" = OrderedDict()
+        for mapping in mappings or []:
+            self.register(mapping)
+
+    @classmethod
+    def from_file(cls, path: Optional[str]) -> "ConverterRegistry":
+        """Load mappings from a JSON list of SiteMapping fields"""
+        if not path:
+            return cls()
+        with open(path) as f:
+            entries = json.load(f)
+        registry = cls([SiteMapping(**entry) for entry in entries])
+        logger.info(f"Loaded {len(entries)} converter mappings from {path}")
+        return registry
+
+    def register(self, mapping: SiteMapping):
+        key = (mapping.data_type, mapping.fingerprint)
+        self._mappings[key] = mapping
+        self._compiled.pop(key, None)
+
+    def converter_for(self, columns: List[Any], data_type: str) -> CompiledConverter:
+        fingerprint = header_fingerprint(columns)
+        key = (data_type, fingerprint)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self._compile(columns, data_type, fingerprint, self._mappings.get(key))
+            self._compiled[key] = compiled
+            while len(self._compiled) > self.cache_size:
+                self._compiled.popitem(last=False)
+        else:
+            self._compiled.move_to_end(key)
+        return compiled
+
+    def _compile(self, columns: List[Any], data_type: str, fingerprint: str,
+                 mapping: Optional[SiteMapping]) -> CompiledConverter:
+        targets = set(FRAME_SCHEMAS[data_type].columns)
+        mapped = mapping.columns if mapping else {}
+        rename = {}
+        for source in columns:
+            normalized = normalize_header(source)
+            target = mapped.get(normalized, normalized)
+            # First source column wins if two map to the same target
+            if target in targets and target not in rename.values():
+                rename[normalized] = target
+        if mapping:
+            logger.info(f"Compiled {data_type} converter for mapping {mapping.name} ({fingerprint})")
+        return CompiledConverter(data_type, fingerprint, rename,
+                                 mapping.date_formats if mapping else {},
+                                 mapping.name if mapping else None)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "mappings": [mapping.to_dict() for mapping in self._mappings.values()],
+            "cache_size": self.cache_size,
+            "compiled": [converter.to_dict() for converter in self._compiled.values()]
+        }
+
+
+converter_registry = ConverterRegistry.from_file(CONVERTER_MAPPINGS_PATH)
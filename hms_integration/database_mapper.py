@@ -5,15 +5,86 @@ Maps HMS data structures to existing Erlessed database tables
 
 import asyncio
 import asyncpg
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Tuple
 from datetime import datetime
-import json
 import logging
-from main import VitalSigns, LabResult, Prescription, Diagnosis
+import numpy as np
+import pandas as pd
+from hms_clients import VitalSigns, LabResult, Prescription, Diagnosis
+from converters import frame_to_csv
+from json_codecs import register_json_codecs, dumps
+from triage_rules import triage_engine, current_facility
+from news2 import news2_tracker, news2_payload
+from vitals_baseline import vitals_baselines, BASELINE_SCHEMA
+from vitals_history import vitals_history
+from triage_queue import triage_queue, QUEUE_SEQUENCE_SCHEMA, DEFAULT_FACILITY
+from records import VitalRecord, LabRecord, PrescriptionRecord, DiagnosisRecord, to_record
 import os
 
 logger = logging.getLogger(__name__)
 
+DB_POOL_MIN_SIZE = int(os.getenv("HMS_DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("HMS_DB_POOL_MAX_SIZE", "10"))
+
+# Natural keys (FRAME_SCHEMAS) that re-synced prescriptions and HMS diagnoses are upserted on.
+# Tables written before the keys existed may hold duplicates, which would stop the unique index
+# from building, so each index is created once behind an advisory lock after keeping only the
+# newest row of every duplicate group. consultations.diagnosis is text in shared/schema.ts.
+NATURAL_KEY_SCHEMAS = {
+    "prescription natural key": """
+        DO $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('hms_prescriptions_natural_key'));
+            IF to_regclass('hms_prescriptions_natural_key') IS NULL THEN
+                DELETE FROM prescriptions a USING prescriptions b
+                WHERE a.patient_id = b.patient_id
+                    AND a.medication_name = b.medication_name
+                    AND a.prescribed_date = b.prescribed_date
+                    AND a.id < b.id;
+                CREATE UNIQUE INDEX hms_prescriptions_natural_key
+                    ON prescriptions (patient_id, medication_name, prescribed_date);
+            END IF;
+        END $$;
+    """,
+    "diagnosis natural key": """
+        DO $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('hms_consultations_diagnosis_key'));
+            IF to_regclass('hms_consultations_diagnosis_key') IS NULL THEN
+                DELETE FROM consultations a USING consultations b
+                WHERE a.consultation_type = 'hms_sync' AND b.consultation_type = 'hms_sync'
+                    AND a.patient_id = b.patient_id
+                    AND (a.diagnosis::jsonb->>'diagnosis_code') = (b.diagnosis::jsonb->>'diagnosis_code')
+                    AND a.consultation_date = b.consultation_date
+                    AND a.id < b.id;
+                CREATE UNIQUE INDEX hms_consultations_diagnosis_key
+                    ON consultations (patient_id, (diagnosis::jsonb->>'diagnosis_code'), consultation_date)
+                    WHERE consultation_type = 'hms_sync';
+            END IF;
+        END $$;
+    """,
+}
+PRESCRIPTION_CONFLICT = """
+            ON CONFLICT (patient_id, medication_name, prescribed_date)
+            DO UPDATE SET
+                dosage = EXCLUDED.dosage,
+                frequency = EXCLUDED.frequency,
+                duration = EXCLUDED.duration,
+                quantity = EXCLUDED.quantity,
+                instructions = EXCLUDED.instructions,
+                prescribed_by = EXCLUDED.prescribed_by,
+                status = EXCLUDED.status
+"""
+
+DIAGNOSIS_CONFLICT = """
+            ON CONFLICT (patient_id, (diagnosis::jsonb->>'diagnosis_code'), consultation_date)
+                WHERE consultation_type = 'hms_sync'
+            DO UPDATE SET
+                notes = EXCLUDED.notes,
+                diagnosis = EXCLUDED.diagnosis,
+                status = EXCLUDED.status
+"""
+
 class ErlessedDatabaseMapper:
     """Maps HMS data to Erlessed database schema"""
     
@@ -21,261 +92,576 @@ class ErlessedDatabaseMapper:
         self.database_url = os.getenv("DATABASE_URL")
         if not self.database_url:
             raise ValueError("DATABASE_URL environment variable is required")
+        self._pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
+        self._ddl_done: set = set()
     
     async def get_connection(self):
-        """Get database connection"""
-        return await asyncpg.connect(self.database_url)
+        """Acquire a pooled connection with the JSON codecs registered; return it with release_connection"""
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.database_url, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                        init=register_json_codecs
+                    )
+        return await self._pool.acquire()
+    
+    async def release_connection(self, conn):
+        """Hand a connection from get_connection back to the pool"""
+        await self._pool.release(conn)
+    
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+            # A later get_connection may run on another event loop (one per shard in worker processes)
+            self._pool_lock = asyncio.Lock()
     
     async def store_vitals(self, vitals: List[VitalSigns]) -> int:
         """Store vital signs in patient_queue table with triage data"""
-        stored_count = 0
+        records = [to_record(item, VitalRecord) for item in vitals]
+        return await self.write_vitals(self.prepare_vitals(records))
+    
+    async def store_lab_results(self, lab_results: List[LabResult]) -> int:
+        """Store lab results in lab_orders table"""
+        records = [to_record(item, LabRecord) for item in lab_results]
+        return await self.write_lab_results(self.prepare_lab_results(records))
+    
+    async def store_prescriptions(self, prescriptions: List[Prescription]) -> int:
+        """Store prescriptions in prescriptions table"""
+        records = [to_record(item, PrescriptionRecord) for item in prescriptions]
+        return await self.write_prescriptions(self.prepare_prescriptions(records))
+    
+    async def store_diagnoses(self, diagnoses: List[Diagnosis]) -> int:
+        """Store diagnoses in consultations table"""
+        records = [to_record(item, DiagnosisRecord) for item in diagnoses]
+        return await self.write_diagnoses(self.prepare_diagnoses(records))
+    
+    def prepare_vitals(self, vitals: List[VitalRecord]) -> List[tuple]:
+        """Map vital signs to patient_queue rows keyed by HMS patient ID; triage is scored per batch on write"""
+        rows = []
+        for vital in vitals:
+            # Create triage data structure
+            triage_data = {
+                "vital_signs": {
+                    "systolic_bp": vital.systolic_bp,
+                    "diastolic_bp": vital.diastolic_bp,
+                    "heart_rate": vital.heart_rate,
+                    "temperature": vital.temperature,
+                    "respiratory_rate": vital.respiratory_rate,
+                    "oxygen_saturation": vital.oxygen_saturation,
+                    "weight": vital.weight,
+                    "height": vital.height,
+                    "bmi": vital.bmi
+                },
+                "recorded_by": vital.recorded_by,
+                "encounter_id": vital.encounter_id,
+                "sync_source": "hms_integration"
+            }
+            
+            rows.append((
+                vital.patient_id,
+                triage_data,
+                vital.timestamp
+            ))
+        return rows
+    
+    def prepare_lab_results(self, lab_results: List[LabRecord]) -> List[tuple]:
+        """Map lab results to lab_orders rows keyed by HMS patient ID"""
+        rows = []
+        for lab in lab_results:
+            # Prepare results data
+            results_data = {
+                "result_value": lab.result_value,
+                "result_numeric": lab.result_numeric,
+                "reference_range": lab.reference_range,
+                "units": lab.units,
+                "test_code": lab.test_code,
+                "order_id": lab.order_id,
+                "resulted_by": lab.resulted_by,
+                "sync_source": "hms_integration"
+            }
+            
+            rows.append((
+                lab.patient_id,
+                lab.test_name,
+                lab.test_code or "LAB",
+                lab.status,
+                results_data,
+                lab.ordered_date,
+                lab.result_date,
+                lab.ordered_by,
+                f"Synced from HMS - Order ID: {lab.order_id}"
+            ))
+        return rows
+    
+    def prepare_prescriptions(self, prescriptions: List[PrescriptionRecord]) -> List[tuple]:
+        """Map prescriptions to prescriptions rows keyed by HMS patient ID"""
+        return [
+            (
+                prescription.patient_id,
+                prescription.medication_name,
+                prescription.dosage,
+                prescription.frequency,
+                prescription.duration,
+                prescription.quantity,
+                prescription.instructions,
+                prescription.prescribed_date,
+                prescription.prescribed_by,
+                prescription.status
+            )
+            for prescription in prescriptions
+        ]
+    
+    def prepare_diagnoses(self, diagnoses: List[DiagnosisRecord]) -> List[tuple]:
+        """Map diagnoses to consultations rows keyed by HMS patient ID"""
+        rows = []
+        for diagnosis in diagnoses:
+            # Create consultation record with diagnosis
+            consultation_data = {
+                "diagnosis_code": diagnosis.diagnosis_code,
+                "diagnosis_name": diagnosis.diagnosis_name,
+                "diagnosis_type": diagnosis.diagnosis_type,
+                "status": diagnosis.status,
+                "diagnosed_by": diagnosis.diagnosed_by,
+                "encounter_id": diagnosis.encounter_id,
+                "sync_source": "hms_integration"
+            }
+            
+            rows.append((
+                diagnosis.patient_id,
+                "hms_sync",
+                f"Diagnosis: {diagnosis.diagnosis_name} ({diagnosis.diagnosis_code})",
+                consultation_data,
+                diagnosis.diagnosed_date,
+                1,  # Default clinician ID
+                diagnosis.status
+            ))
+        return rows
+    
+    async def write_vitals(self, rows: List[tuple]) -> int:
+        """Write prepared vitals rows to patient_queue"""
+        if not rows:
+            return 0
         
+        stored_count = 0
+        hms_patient_ids = [row[0] for row in rows]
+        readings = pd.DataFrame([row[1]["vital_signs"] for row in rows])
+        priorities = await self._triage_priorities(readings, hms_patient_ids)
+        timestamps = [row[2] for row in rows]
+        news2, news2_pending = news2_tracker.score(readings, hms_patient_ids, timestamps)
+        anomalies, baselines_pending = await self._vital_anomalies(readings, hms_patient_ids, timestamps)
+        facility = current_facility.get()
         conn = await self.get_connection()
         try:
-            for vital in vitals:
-                # Check if patient exists
-                patient_query = "SELECT id FROM patients WHERE patient_id = $1"
-                patient_result = await conn.fetchrow(patient_query, vital.patient_id)
+            await vitals_history.prepare(conn, pd.Series(timestamps))
+            # Queue rows and history commit together; in-memory state only follows once they have
+            async with conn.transaction():
+                patient_ids = await self._resolve_patient_ids(conn, hms_patient_ids)
+                positions = iter(await self._next_queue_positions(
+                    conn, sum(1 for patient_id in hms_patient_ids if patient_id in patient_ids)))
                 
-                if not patient_result:
-                    logger.warning(f"Patient {vital.patient_id} not found, skipping vital signs")
-                    continue
-                
-                patient_db_id = patient_result['id']
-                
-                # Create triage data structure
-                triage_data = {
-                    "vital_signs": {
-                        "systolic_bp": vital.systolic_bp,
-                        "diastolic_bp": vital.diastolic_bp,
-                        "heart_rate": vital.heart_rate,
-                        "temperature": vital.temperature,
-                        "respiratory_rate": vital.respiratory_rate,
-                        "oxygen_saturation": vital.oxygen_saturation,
-                        "weight": vital.weight,
-                        "height": vital.height,
-                        "bmi": vital.bmi
-                    },
-                    "recorded_by": vital.recorded_by,
-                    "encounter_id": vital.encounter_id,
-                    "sync_source": "hms_integration"
-                }
-                
-                # Calculate triage priority based on vitals
-                priority = self._calculate_triage_priority(vital)
-                
-                # Insert into patient_queue
+                # An existing queue row keeps its position; RETURNING gives the one it holds
                 insert_query = """
                     INSERT INTO patient_queue (
                         patient_id, queue_position, triage_priority, 
                         triage_data, created_at, updated_at
-                    ) VALUES ($1, $2, $3, $4, $5, $6)
+                    ) VALUES ($1, $2, $3, $4::jsonb, $5, $6)
                     ON CONFLICT (patient_id) 
                     DO UPDATE SET 
                         triage_data = EXCLUDED.triage_data,
                         triage_priority = EXCLUDED.triage_priority,
                         updated_at = EXCLUDED.updated_at
+                    RETURNING queue_position, updated_at
                 """
                 
-                await conn.execute(
-                    insert_query,
-                    patient_db_id,
-                    await self._get_next_queue_position(conn),
-                    priority,
-                    json.dumps(triage_data),
-                    vital.timestamp,
-                    datetime.utcnow()
-                )
+                queued = []
+                stored_rows = []
+                for (hms_patient_id, triage_data, recorded_at), priority, score, flagged in zip(
+                        rows, priorities, news2.itertuples(index=False), anomalies):
+                    patient_db_id = patient_ids.get(hms_patient_id)
+                    if patient_db_id is None:
+                        logger.warning(f"Patient {hms_patient_id} not found, skipping vital signs")
+                        stored_rows.append(False)
+                        continue
+                    stored_rows.append(True)
+                    
+                    queue_row = await conn.fetchrow(
+                        insert_query,
+                        patient_db_id,
+                        next(positions),
+                        priority,
+                        {**triage_data, "news2": news2_payload(*score), "anomalies": flagged, "facility": facility},
+                        recorded_at,
+                        datetime.utcnow()
+                    )
+                    queued.append((hms_patient_id, queue_row['queue_position'], priority, queue_row['updated_at']))
+                    stored_count += 1
                 
-                stored_count += 1
-                logger.info(f"Stored vital signs for patient {vital.patient_id}")
+                await vitals_history.append_rows(
+                    conn,
+                    [patient_ids[row[0]] for row, stored in zip(rows, stored_rows) if stored],
+                    [row[2] for row, stored in zip(rows, stored_rows) if stored],
+                    readings[stored_rows]
+                )
+            for hms_patient_id, position, priority, updated_at in queued:
+                triage_queue.enqueue(facility, hms_patient_id, priority, position, updated_at)
+            stored_ids = [hms_patient_id for hms_patient_id, _, _, _ in queued]
+            news2_tracker.commit(news2_pending, stored_ids)
+            vitals_baselines.commit(baselines_pending, stored_ids)
+            logger.info(f"Stored {stored_count} vital signs records")
                 
         except Exception as e:
             logger.error(f"Error storing vitals: {e}")
             raise
         finally:
-            await conn.close()
+            await self.release_connection(conn)
         
         return stored_count
     
-    async def store_lab_results(self, lab_results: List[LabResult]) -> int:
-        """Store lab results in lab_orders table"""
-        stored_count = 0
+    async def write_lab_results(self, rows: List[tuple]) -> int:
+        """Write prepared lab result rows to lab_orders"""
+        insert_query = """
+            INSERT INTO lab_orders (
+                patient_id, test_name, test_type, status, 
+                results, ordered_date, completed_date, 
+                ordered_by, notes, created_at
+            ) VALUES ($1, $2, $3, $4, $5::jsonb, $6, $7, $8, $9, $10)
+            ON CONFLICT (patient_id, test_name, ordered_date)
+            DO UPDATE SET
+                results = EXCLUDED.results,
+                status = EXCLUDED.status,
+                completed_date = EXCLUDED.completed_date
+        """
+        return await self._write_rows(rows, insert_query, "lab result")
+    
+    async def write_prescriptions(self, rows: List[tuple]) -> int:
+        """Write prepared prescription rows to prescriptions"""
+        insert_query = """
+            INSERT INTO prescriptions (
+                patient_id, medication_name, dosage, frequency,
+                duration, quantity, instructions, prescribed_date,
+                prescribed_by, status, created_at
+            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+        """ + PRESCRIPTION_CONFLICT
+        return await self._write_rows(rows, insert_query, "prescription", before=self._ensure_natural_keys)
+    
+    async def write_diagnoses(self, rows: List[tuple]) -> int:
+        """Write prepared diagnosis rows to consultations"""
+        insert_query = """
+            INSERT INTO consultations (
+                patient_id, consultation_type, notes, 
+                diagnosis, consultation_date, clinician_id, 
+                status, created_at
+            ) VALUES ($1, $2, $3, $4::jsonb, $5, $6, $7, $8)
+        """ + DIAGNOSIS_CONFLICT
+        return await self._write_rows(rows, insert_query, "diagnosis", before=self._ensure_natural_keys)
+    
+    async def _write_rows(self, rows: List[tuple], insert_query: str, record_label: str,
+                          before: Optional[Callable[[Any], Awaitable[Any]]] = None) -> int:
+        """Resolve patient IDs for prepared rows and insert them in one batch
+        
+        Each row starts with the HMS patient ID; created_at is appended as the last parameter.
+        before(conn) runs first, on the same connection.
+        """
+        if not rows:
+            return 0
         
         conn = await self.get_connection()
         try:
-            for lab in lab_results:
-                # Check if patient exists
-                patient_query = "SELECT id FROM patients WHERE patient_id = $1"
-                patient_result = await conn.fetchrow(patient_query, lab.patient_id)
-                
-                if not patient_result:
-                    logger.warning(f"Patient {lab.patient_id} not found, skipping lab result")
+            if before is not None:
+                await before(conn)
+            patient_ids = await self._resolve_patient_ids(conn, [row[0] for row in rows])
+            created_at = datetime.utcnow()
+            
+            args = []
+            for row in rows:
+                patient_db_id = patient_ids.get(row[0])
+                if patient_db_id is None:
+                    logger.warning(f"Patient {row[0]} not found, skipping {record_label}")
                     continue
-                
-                patient_db_id = patient_result['id']
-                
-                # Map lab result to lab_orders schema
-                insert_query = """
-                    INSERT INTO lab_orders (
-                        patient_id, test_name, test_type, status, 
-                        results, ordered_date, completed_date, 
-                        ordered_by, notes, created_at
-                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-                    ON CONFLICT (patient_id, test_name, ordered_date)
-                    DO UPDATE SET
-                        results = EXCLUDED.results,
-                        status = EXCLUDED.status,
-                        completed_date = EXCLUDED.completed_date
-                """
-                
-                # Prepare results data
-                results_data = {
-                    "result_value": lab.result_value,
-                    "result_numeric": lab.result_numeric,
-                    "reference_range": lab.reference_range,
-                    "units": lab.units,
-                    "test_code": lab.test_code,
-                    "order_id": lab.order_id,
-                    "resulted_by": lab.resulted_by,
-                    "sync_source": "hms_integration"
-                }
-                
-                await conn.execute(
-                    insert_query,
-                    patient_db_id,
-                    lab.test_name,
-                    lab.test_code or "LAB",
-                    lab.status,
-                    json.dumps(results_data),
-                    lab.ordered_date,
-                    lab.result_date,
-                    lab.ordered_by,
-                    f"Synced from HMS - Order ID: {lab.order_id}",
-                    datetime.utcnow()
-                )
-                
-                stored_count += 1
-                logger.info(f"Stored lab result for patient {lab.patient_id}: {lab.test_name}")
-                
+                args.append((patient_db_id, *row[1:], created_at))
+            
+            if args:
+                await conn.executemany(insert_query, args)
+            logger.info(f"Stored {len(args)} {record_label} records")
+            return len(args)
+            
         except Exception as e:
-            logger.error(f"Error storing lab results: {e}")
+            logger.error(f"Error storing {record_label} records: {e}")
             raise
         finally:
-            await conn.close()
-        
-        return stored_count
+            await self.release_connection(conn)
     
-    async def store_prescriptions(self, prescriptions: List[Prescription]) -> int:
-        """Store prescriptions in prescriptions table"""
-        stored_count = 0
+    async def copy_vitals_frame(self, frame: pd.DataFrame,
+                                after: Optional[Callable[[Any], Awaitable[Any]]] = None) -> int:
+        """Bulk-write converted vitals columns to patient_queue via COPY; after(conn) runs in the same transaction"""
+        if frame.empty:
+            return 0
+        
+        patient_ids = frame["patient_id"].tolist()
+        frame = frame.assign(triage_priority=await self._triage_priorities(frame, patient_ids))
+        news2, news2_pending = news2_tracker.score(frame, patient_ids, frame["timestamp"].tolist())
+        news2 = news2.set_axis(frame.index)
+        anomalies, baselines_pending = await self._vital_anomalies(frame, patient_ids, frame["timestamp"].tolist())
+        frame = frame.assign(**news2, anomalies=[dumps(flagged).decode() if flagged else None for flagged in anomalies],
+                             facility=current_facility.get())
+        stage_columns = {
+            "patient_id": "text", "encounter_id": "text", "recorded_by": "text",
+            "systolic_bp": "double precision", "diastolic_bp": "double precision",
+            "heart_rate": "double precision", "temperature": "double precision",
+            "respiratory_rate": "double precision", "oxygen_saturation": "double precision",
+            "weight": "double precision", "height": "double precision", "bmi": "double precision",
+            "timestamp": "timestamp", "triage_priority": "text",
+            "news2_score": "integer", "news2_risk": "text", "news2_parameters": "integer",
+            "anomalies": "jsonb", "facility": "text"
+        }
+        # One row per patient: the upsert cannot touch a row twice, and the
+        # last reading in the file wins as it does in write_vitals. New queue
+        # positions are drawn from the sequence in file order.
+        insert_query = """
+            WITH upserted AS (
+                INSERT INTO patient_queue (
+                    patient_id, queue_position, triage_priority, 
+                    triage_data, created_at, updated_at
+                )
+                SELECT s.patient_db_id, nextval('hms_queue_position_seq'),
+                    s.triage_priority,
+                    jsonb_build_object(
+                        'vital_signs', jsonb_build_object(
+                            'systolic_bp', s.systolic_bp, 'diastolic_bp', s.diastolic_bp,
+                            'heart_rate', s.heart_rate, 'temperature', s.temperature,
+                            'respiratory_rate', s.respiratory_rate,
+                            'oxygen_saturation', s.oxygen_saturation,
+                            'weight', s.weight, 'height', s.height, 'bmi', s.bmi
+                        ),
+                        'recorded_by', s.recorded_by,
+                        'encounter_id', s.encounter_id,
+                        'sync_source', 'hms_integration',
+                        'news2', jsonb_build_object(
+                            'score', s.news2_score, 'risk', s.news2_risk,
+                            'parameters', s.news2_parameters
+                        ),
+                        'anomalies', s.anomalies,
+                        'facility', s.facility
+                    ),
+                    s.timestamp, $1
+                FROM (
+                    SELECT latest.*, p.id AS patient_db_id
+                    FROM (
+                        SELECT DISTINCT ON (patient_id) * FROM hms_bulk_stage
+                        ORDER BY patient_id, row_no DESC
+                    ) latest
+                    JOIN patients p ON p.patient_id = latest.patient_id
+                    ORDER BY latest.row_no
+                ) s
+                ON CONFLICT (patient_id) 
+                DO UPDATE SET 
+                    triage_data = EXCLUDED.triage_data,
+                    triage_priority = EXCLUDED.triage_priority,
+                    updated_at = EXCLUDED.updated_at
+                RETURNING patient_id, queue_position, triage_priority, updated_at
+            )
+            SELECT p.patient_id, u.queue_position, u.triage_priority, u.updated_at
+            FROM upserted u JOIN patients p ON p.id = u.patient_id
+        """
+        timestamps = frame["timestamp"]
+        facility = current_facility.get()
+        
+        def on_rows(queued):
+            for row in queued:
+                triage_queue.enqueue(facility, row['patient_id'], row['triage_priority'],
+                                     row['queue_position'], row['updated_at'])
+            stored_ids = [row['patient_id'] for row in queued]
+            news2_tracker.commit(news2_pending, stored_ids)
+            vitals_baselines.commit(baselines_pending, stored_ids)
+        
+        async def append_history(conn):
+            await vitals_history.append_from_stage(conn, timestamps)
+            if after is not None:
+                await after(conn)
         
         conn = await self.get_connection()
         try:
-            for prescription in prescriptions:
-                # Check if patient exists
-                patient_query = "SELECT id FROM patients WHERE patient_id = $1"
-                patient_result = await conn.fetchrow(patient_query, prescription.patient_id)
-                
-                if not patient_result:
-                    logger.warning(f"Patient {prescription.patient_id} not found, skipping prescription")
-                    continue
-                
-                patient_db_id = patient_result['id']
-                
-                # Insert prescription
-                insert_query = """
-                    INSERT INTO prescriptions (
-                        patient_id, medication_name, dosage, frequency,
-                        duration, quantity, instructions, prescribed_date,
-                        prescribed_by, status, created_at
-                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
-                """
-                
-                await conn.execute(
-                    insert_query,
-                    patient_db_id,
-                    prescription.medication_name,
-                    prescription.dosage,
-                    prescription.frequency,
-                    prescription.duration,
-                    prescription.quantity,
-                    prescription.instructions,
-                    prescription.prescribed_date,
-                    prescription.prescribed_by,
-                    prescription.status,
-                    datetime.utcnow()
-                )
-                
-                stored_count += 1
-                logger.info(f"Stored prescription for patient {prescription.patient_id}: {prescription.medication_name}")
-                
-        except Exception as e:
-            logger.error(f"Error storing prescriptions: {e}")
-            raise
+            await vitals_history.prepare(conn, timestamps)
         finally:
-            await conn.close()
+            await self.release_connection(conn)
+        return await self._copy_frame(frame, stage_columns, insert_query, "vital signs",
+                                      before=self._ensure_queue_sequence, after=append_history,
+                                      on_rows=on_rows)
+    
+    async def copy_lab_results_frame(self, frame: pd.DataFrame,
+                                     after: Optional[Callable[[Any], Awaitable[Any]]] = None) -> int:
+        """Bulk-write converted lab result columns to lab_orders via COPY; after(conn) runs in the same transaction"""
+        if frame.empty:
+            return 0
         
-        return stored_count
+        stage_columns = {
+            "patient_id": "text", "order_id": "text", "test_name": "text", "test_code": "text",
+            "result_value": "text", "result_numeric": "double precision",
+            "reference_range": "text", "units": "text", "status": "text",
+            "ordered_by": "text", "resulted_by": "text",
+            "ordered_date": "timestamp", "result_date": "timestamp"
+        }
+        insert_query = """
+            INSERT INTO lab_orders (
+                patient_id, test_name, test_type, status, 
+                results, ordered_date, completed_date, 
+                ordered_by, notes, created_at
+            )
+            SELECT p.id, s.test_name, COALESCE(s.test_code, 'LAB'), s.status,
+                jsonb_build_object(
+                    'result_value', s.result_value,
+                    'result_numeric', s.result_numeric,
+                    'reference_range', s.reference_range,
+                    'units', s.units,
+                    'test_code', s.test_code,
+                    'order_id', s.order_id,
+                    'resulted_by', s.resulted_by,
+                    'sync_source', 'hms_integration'
+                ),
+                s.ordered_date, s.result_date, s.ordered_by,
+                'Synced from HMS - Order ID: ' || COALESCE(s.order_id, 'None'),
+                $1
+            FROM (
+                SELECT DISTINCT ON (patient_id, test_name, ordered_date) * FROM hms_bulk_stage
+                ORDER BY patient_id, test_name, ordered_date, row_no DESC
+            ) s
+            JOIN patients p ON p.patient_id = s.patient_id
+            ON CONFLICT (patient_id, test_name, ordered_date)
+            DO UPDATE SET
+                results = EXCLUDED.results,
+                status = EXCLUDED.status,
+                completed_date = EXCLUDED.completed_date
+        """
+        return await self._copy_frame(frame, stage_columns, insert_query, "lab result", after=after)
     
-    async def store_diagnoses(self, diagnoses: List[Diagnosis]) -> int:
-        """Store diagnoses in consultations table"""
-        stored_count = 0
+    async def copy_prescriptions_frame(self, frame: pd.DataFrame,
+                                       after: Optional[Callable[[Any], Awaitable[Any]]] = None) -> int:
+        """Bulk-write converted prescription columns to prescriptions via COPY; after(conn) runs in the same transaction"""
+        if frame.empty:
+            return 0
+        
+        stage_columns = {
+            "patient_id": "text", "medication_name": "text", "dosage": "text", "frequency": "text",
+            "duration": "text", "quantity": "double precision", "instructions": "text",
+            "prescribed_date": "timestamp", "prescribed_by": "text", "status": "text"
+        }
+        insert_query = """
+            INSERT INTO prescriptions (
+                patient_id, medication_name, dosage, frequency,
+                duration, quantity, instructions, prescribed_date,
+                prescribed_by, status, created_at
+            )
+            SELECT p.id, s.medication_name, s.dosage, s.frequency,
+                s.duration, s.quantity, s.instructions, s.prescribed_date,
+                s.prescribed_by, s.status, $1
+            FROM (
+                SELECT DISTINCT ON (patient_id, medication_name, prescribed_date) * FROM hms_bulk_stage
+                ORDER BY patient_id, medication_name, prescribed_date, row_no DESC
+            ) s
+            JOIN patients p ON p.patient_id = s.patient_id
+        """ + PRESCRIPTION_CONFLICT
+        return await self._copy_frame(frame, stage_columns, insert_query, "prescription",
+                                      before=self._ensure_natural_keys, after=after)
+    
+    async def copy_diagnoses_frame(self, frame: pd.DataFrame,
+                                   after: Optional[Callable[[Any], Awaitable[Any]]] = None) -> int:
+        """Bulk-write converted diagnosis columns to consultations via COPY; after(conn) runs in the same transaction"""
+        if frame.empty:
+            return 0
+        
+        stage_columns = {
+            "patient_id": "text", "encounter_id": "text", "diagnosis_code": "text",
+            "diagnosis_name": "text", "diagnosis_type": "text", "status": "text",
+            "diagnosed_by": "text", "diagnosed_date": "timestamp"
+        }
+        insert_query = """
+            INSERT INTO consultations (
+                patient_id, consultation_type, notes, 
+                diagnosis, consultation_date, clinician_id, 
+                status, created_at
+            )
+            SELECT p.id, 'hms_sync',
+                'Diagnosis: ' || s.diagnosis_name || ' (' || s.diagnosis_code || ')',
+                jsonb_build_object(
+                    'diagnosis_code', s.diagnosis_code,
+                    'diagnosis_name', s.diagnosis_name,
+                    'diagnosis_type', s.diagnosis_type,
+                    'status', s.status,
+                    'diagnosed_by', s.diagnosed_by,
+                    'encounter_id', s.encounter_id,
+                    'sync_source', 'hms_integration'
+                ),
+                s.diagnosed_date,
+                1,  -- Default clinician ID
+                s.status, $1
+            FROM (
+                SELECT DISTINCT ON (patient_id, diagnosis_code, diagnosed_date) * FROM hms_bulk_stage
+                ORDER BY patient_id, diagnosis_code, diagnosed_date, row_no DESC
+            ) s
+            JOIN patients p ON p.patient_id = s.patient_id
+        """ + DIAGNOSIS_CONFLICT
+        return await self._copy_frame(frame, stage_columns, insert_query, "diagnosis",
+                                      before=self._ensure_natural_keys, after=after)
+    
+    async def _copy_frame(self, frame: pd.DataFrame, stage_columns: Dict[str, str],
+                          insert_query: str, record_label: str,
+                          before: Optional[Callable[[Any], Awaitable[Any]]] = None,
+                          after: Optional[Callable[[Any], Awaitable[Any]]] = None,
+                          on_rows: Optional[Callable[[List[Any]], None]] = None) -> int:
+        """COPY frame columns into a temporary stage table and upsert from it in one statement
+        
+        Rows are never materialized as Python objects: Arrow serializes the
+        columns to CSV and Postgres parses them. The stage table carries a
+        row_no column holding the row's position in the upload; the insert
+        query receives created_at as $1 and resolves patients with a join.
+        before(conn) and after(conn) run in the same transaction, before the
+        COPY and while the stage table still exists. With on_rows the insert
+        query returns one row per stored record, passed to on_rows once the
+        transaction has committed.
+        """
+        columns = list(stage_columns)
+        payload = frame_to_csv(frame.assign(row_no=np.arange(len(frame))), ["row_no", *columns])
+        column_ddl = ", ".join(f'"{name}" {sql_type}' for name, sql_type in stage_columns.items())
         
         conn = await self.get_connection()
         try:
-            for diagnosis in diagnoses:
-                # Check if patient exists
-                patient_query = "SELECT id FROM patients WHERE patient_id = $1"
-                patient_result = await conn.fetchrow(patient_query, diagnosis.patient_id)
-                
-                if not patient_result:
-                    logger.warning(f"Patient {diagnosis.patient_id} not found, skipping diagnosis")
-                    continue
-                
-                patient_db_id = patient_result['id']
-                
-                # Create consultation record with diagnosis
-                consultation_data = {
-                    "diagnosis_code": diagnosis.diagnosis_code,
-                    "diagnosis_name": diagnosis.diagnosis_name,
-                    "diagnosis_type": diagnosis.diagnosis_type,
-                    "status": diagnosis.status,
-                    "diagnosed_by": diagnosis.diagnosed_by,
-                    "encounter_id": diagnosis.encounter_id,
-                    "sync_source": "hms_integration"
-                }
-                
-                insert_query = """
-                    INSERT INTO consultations (
-                        patient_id, consultation_type, notes, 
-                        diagnosis, consultation_date, clinician_id, 
-                        status, created_at
-                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-                """
-                
-                await conn.execute(
-                    insert_query,
-                    patient_db_id,
-                    "hms_sync",
-                    f"Diagnosis: {diagnosis.diagnosis_name} ({diagnosis.diagnosis_code})",
-                    json.dumps(consultation_data),
-                    diagnosis.diagnosed_date,
-                    1,  # Default clinician ID
-                    diagnosis.status,
-                    datetime.utcnow()
-                )
-                
-                stored_count += 1
-                logger.info(f"Stored diagnosis for patient {diagnosis.patient_id}: {diagnosis.diagnosis_name}")
-                
+            async with conn.transaction():
+                if before is not None:
+                    await before(conn)
+                await conn.execute(f"CREATE TEMP TABLE hms_bulk_stage (row_no bigint, {column_ddl}) ON COMMIT DROP")
+                await conn.copy_to_table("hms_bulk_stage", source=payload, columns=["row_no", *columns], format="csv")
+                if on_rows is None:
+                    status = await conn.execute(insert_query, datetime.utcnow())
+                    stored_count = int(status.split()[-1])
+                else:
+                    stored = await conn.fetch(insert_query, datetime.utcnow())
+                    stored_count = len(stored)
+                if after is not None:
+                    await after(conn)
+            
+            if on_rows is not None:
+                on_rows(stored)
+            if stored_count < len(frame):
+                logger.warning(f"Skipped {len(frame) - stored_count} {record_label} rows for unknown patients or duplicate keys")
+            logger.info(f"Stored {stored_count} {record_label} records via COPY")
+            return stored_count
+            
         except Exception as e:
-            logger.error(f"Error storing diagnoses: {e}")
+            logger.error(f"Error bulk storing {record_label} records: {e}")
             raise
         finally:
-            await conn.close()
-        
-        return stored_count
+            await self.release_connection(conn)
+    
+    async def _resolve_patient_ids(self, conn, hms_patient_ids: List[str]) -> Dict[str, int]:
+        """Look up Erlessed patient row IDs for a batch of HMS patient IDs in one query"""
+        rows = await conn.fetch(
+            "SELECT id, patient_id FROM patients WHERE patient_id = ANY($1::text[])",
+            list(set(hms_patient_ids))
+        )
+        return {row['patient_id']: row['id'] for row in rows}
     
     async def log_patient_consent(self, patient_id: str, consent_type: str, 
                                  fingerprint_hash: str = None, otp_code: str = None,
@@ -296,13 +682,13 @@ class ErlessedDatabaseMapper:
             insert_query = """
                 INSERT INTO audit_logs (
                     action, details, created_at
-                ) VALUES ($1, $2, $3)
+                ) VALUES ($1, $2::jsonb, $3)
             """
             
             await conn.execute(
                 insert_query,
                 f"patient_consent_{consent_type}",
-                json.dumps(consent_data),
+                consent_data,
                 datetime.utcnow()
             )
             
@@ -319,7 +705,7 @@ class ErlessedDatabaseMapper:
             logger.error(f"Error logging consent: {e}")
             raise
         finally:
-            await conn.close()
+            await self.release_connection(conn)
     
     async def verify_patient_consent(self, patient_id: str, consent_type: str) -> bool:
         """Verify if patient has granted consent for data synchronization"""
@@ -329,7 +715,7 @@ class ErlessedDatabaseMapper:
             query = """
                 SELECT details FROM audit_logs 
                 WHERE action = $1 
-                AND details::json->>'patient_id' = $2
+                AND details->>'patient_id' = $2
                 AND created_at > NOW() - INTERVAL '1 year'
                 ORDER BY created_at DESC
                 LIMIT 1
@@ -338,7 +724,7 @@ class ErlessedDatabaseMapper:
             result = await conn.fetchrow(query, f"patient_consent_{consent_type}", patient_id)
             
             if result:
-                consent_details = json.loads(result['details'])
+                consent_details = result['details']
                 # Check if consent is still valid
                 if consent_details.get('expires_at'):
                     expires_at = datetime.fromisoformat(consent_details['expires_at'])
@@ -353,33 +739,214 @@ class ErlessedDatabaseMapper:
             logger.error(f"Error verifying consent: {e}")
             return False
         finally:
-            await conn.close()
+            await self.release_connection(conn)
     
-    def _calculate_triage_priority(self, vital: VitalSigns) -> str:
-        """Calculate triage priority based on vital signs"""
-        high_priority_conditions = []
-        
-        # Check critical vital signs
-        if vital.systolic_bp and (vital.systolic_bp > 180 or vital.systolic_bp < 90):
-            high_priority_conditions.append("critical_bp")
-        
-        if vital.heart_rate and (vital.heart_rate > 120 or vital.heart_rate < 50):
-            high_priority_conditions.append("critical_hr")
+    async def get_urgent_patient_ids(self) -> Dict[str, List[str]]:
+        """Get HMS patient IDs currently queued with urgent triage priority, by the facility they were triaged under"""
+        conn = await self.get_connection()
+        try:
+            query = """
+                SELECT p.patient_id, q.triage_data->>'facility' AS facility FROM patient_queue q
+                JOIN patients p ON p.id = q.patient_id
+                WHERE q.triage_priority = 'urgent'
+            """
+            rows = await conn.fetch(query)
+            urgent: Dict[str, List[str]] = {}
+            for row in rows:
+                urgent.setdefault(row['facility'] or DEFAULT_FACILITY, []).append(row['patient_id'])
+            return urgent
+        finally:
+            await self.release_connection(conn)
+    
+    async def _triage_priorities(self, readings: pd.DataFrame, hms_patient_ids: List[str]) -> np.ndarray:
+        """Score a batch of vital readings with the current facility's triage rules"""
+        facility = current_facility.get()
+        ages = None
+        if triage_engine.uses_age(facility):
+            conn = await self.get_connection()
+            try:
+                known_ages = await self._patient_ages(conn, hms_patient_ids)
+            finally:
+                await self.release_connection(conn)
+            ages = np.array([known_ages.get(patient_id, np.nan) for patient_id in hms_patient_ids], dtype=float)
+        return triage_engine.evaluate(readings, ages, facility)
+    
+    async def get_vitals_history(self, hms_patient_id: str, resolution: str, since: datetime,
+                                 until: datetime) -> Optional[List[Dict[str, Any]]]:
+        """Vitals trend for an HMS patient, None if the patient is unknown"""
+        conn = await self.get_connection()
+        try:
+            patient_ids = await self._resolve_patient_ids(conn, [hms_patient_id])
+            if hms_patient_id not in patient_ids:
+                return None
+            return await vitals_history.fetch(conn, patient_ids[hms_patient_id], resolution, since, until)
+        finally:
+            await self.release_connection(conn)
+    
+    async def enforce_vitals_retention(self) -> Dict[str, int]:
+        """Expire vitals history and rollups past their retention"""
+        conn = await self.get_connection()
+        try:
+            return await vitals_history.enforce_retention(conn)
+        finally:
+            await self.release_connection(conn)
+    
+    async def _vital_anomalies(self, readings: pd.DataFrame, hms_patient_ids: List[str],
+                               recorded_at: List[datetime]) -> Tuple[List[Optional[Dict[str, Any]]], Dict[str, tuple]]:
+        """Check a batch of readings against each patient's baseline, loading unseen patients first
+
+        Returns the anomalies per row and the updated baselines, which the
+        caller commits for the patients it stored.
+        """
+        unloaded = vitals_baselines.unloaded(hms_patient_ids)
+        if unloaded:
+            conn = await self.get_connection()
+            try:
+                await self._ensure_baseline_schema(conn)
+                rows = await conn.fetch(
+                    """
+                    SELECT patient_id, window_size, stats, observed_until, version FROM hms_vitals_baselines
+                    WHERE patient_id = ANY($1::text[])
+                    """,
+                    unloaded
+                )
+            finally:
+                await self.release_connection(conn)
+            vitals_baselines.load(unloaded, [(row['patient_id'], row['window_size'], row['stats'], row['observed_until'],
+                                              row['version']) for row in rows])
         
-        if vital.temperature and vital.temperature > 39.0:
-            high_priority_conditions.append("high_fever")
+        anomalies, pending = vitals_baselines.observe(readings, hms_patient_ids, recorded_at)
+        flagged = sum(1 for row in anomalies if row)
+        if flagged:
+            logger.warning(f"Flagged {flagged} vital signs readings that deviate from the patient's baseline")
+        return anomalies, pending
+    
+    async def save_vitals_baselines(self) -> int:
+        """Persist the baselines changed since the last save
         
-        if vital.oxygen_saturation and vital.oxygen_saturation < 92:
-            high_priority_conditions.append("low_o2")
+        A row is only replaced if it is still at the version this process
+        loaded; patients whose row moved on elsewhere are dropped from memory
+        and reloaded before their next batch.
+        """
+        changed = vitals_baselines.take_dirty()
+        if not changed:
+            return 0
+        conn = await self.get_connection()
+        try:
+            await self._ensure_baseline_schema(conn)
+            rows = await conn.fetch(
+                """
+                INSERT INTO hms_vitals_baselines AS b (patient_id, window_size, stats, observed_until, version)
+                SELECT t.patient_id, $3, t.stats, t.observed_until, t.version
+                FROM unnest($1::text[], $2::bytea[], $4::timestamp[], $5::bigint[])
+                    AS t(patient_id, stats, observed_until, version)
+                ON CONFLICT (patient_id)
+                DO UPDATE SET window_size = EXCLUDED.window_size, stats = EXCLUDED.stats,
+                    observed_until = EXCLUDED.observed_until, version = EXCLUDED.version,
+                    updated_at = now() at time zone 'utc'
+                WHERE b.version = EXCLUDED.version - 1
+                RETURNING patient_id
+                """,
+                [patient_id for patient_id, _, _, _ in changed], [stats for _, stats, _, _ in changed],
+                vitals_baselines.window_size, [observed_until for _, _, observed_until, _ in changed],
+                [version for _, _, _, version in changed]
+            )
+        except Exception:
+            vitals_baselines.mark_dirty([patient_id for patient_id, _, _, _ in changed])
+            raise
+        finally:
+            await self.release_connection(conn)
+        stale = vitals_baselines.saved(changed, [row['patient_id'] for row in rows])
+        if stale:
+            logger.warning(f"Dropped outdated vitals baselines for {len(stale)} patients saved elsewhere since loaded")
+        logger.info(f"Persisted vitals baselines for {len(changed) - len(stale)} patients")
+        return len(changed) - len(stale)
+    
+    async def _ensure_ddl(self, conn, name: str, ddl: str):
+        """Run idempotent DDL once per mapper
         
-        if high_priority_conditions:
-            return "urgent"
-        elif vital.systolic_bp and vital.systolic_bp > 160:
-            return "semi_urgent"
-        else:
-            return "routine"
-    
-    async def _get_next_queue_position(self, conn) -> int:
-        """Get next available queue position"""
-        result = await conn.fetchrow("SELECT COALESCE(MAX(queue_position), 0) + 1 as next_pos FROM patient_queue")
-        return result['next_pos']
\ No newline at end of file
+        Runs in a savepoint when the caller is in a transaction, so a failure
+        does not abort it. Another replica creating the same objects at the
+        same moment fails IF NOT EXISTS with a duplicate error; the objects
+        then exist, so that counts as done. Any other failure propagates and
+        is retried on the next call.
+        """
+        if name in self._ddl_done:
+            return
+        try:
+            async with conn.transaction():
+                await conn.execute(ddl)
+        except (asyncpg.exceptions.DuplicateTableError, asyncpg.exceptions.DuplicateObjectError) as e:
+            logger.warning(f"Creating {name} raced: {e}")
+        except asyncpg.exceptions.UniqueViolationError as e:
+            # Concurrent CREATE ... IF NOT EXISTS can collide on a system catalog key;
+            # a violation on a user table (e.g. duplicate rows under a new index) is real
+            if not (getattr(e, 'constraint_name', None) or '').startswith('pg_'):
+                raise
+            logger.warning(f"Creating {name} raced: {e}")
+        self._ddl_done.add(name)
+    
+    async def _ensure_natural_keys(self, conn):
+        for name, ddl in NATURAL_KEY_SCHEMAS.items():
+            await self._ensure_ddl(conn, name, ddl)
+    
+    async def _ensure_baseline_schema(self, conn):
+        await self._ensure_ddl(conn, "baselines", BASELINE_SCHEMA)
+    
+    async def _patient_ages(self, conn, hms_patient_ids: List[str]) -> Dict[str, float]:
+        """Current age in years of each known patient, by HMS patient ID"""
+        rows = await conn.fetch(
+            """
+            SELECT patient_id, EXTRACT(YEAR FROM age(date_of_birth))::float8 AS age
+            FROM patients WHERE patient_id = ANY($1::text[])
+            """,
+            list(set(hms_patient_ids))
+        )
+        return {row['patient_id']: row['age'] for row in rows}
+    
+    async def _ensure_queue_sequence(self, conn):
+        await self._ensure_ddl(conn, "queue sequence", QUEUE_SEQUENCE_SCHEMA)
+    
+    async def _next_queue_positions(self, conn, count: int) -> List[int]:
+        """Reserve count queue positions from the shared sequence in one round trip"""
+        await self._ensure_queue_sequence(conn)
+        if count <= 0:
+            return []
+        rows = await conn.fetch("SELECT nextval('hms_queue_position_seq') AS position FROM generate_series(1, $1)", count)
+        return [row['position'] for row in rows]
+    
+    async def load_triage_queue(self) -> int:
+        """Refresh the in-memory triage queues from patient_queue"""
+        read_started = datetime.utcnow()
+        conn = await self.get_connection()
+        try:
+            rows = await conn.fetch(
+                """
+                SELECT p.patient_id, q.queue_position, q.triage_priority,
+                    q.triage_data->>'facility' AS facility, q.updated_at
+                FROM patient_queue q
+                JOIN patients p ON p.id = q.patient_id
+                """
+            )
+        finally:
+            await self.release_connection(conn)
+        triage_queue.load([(row['patient_id'], row['queue_position'], row['triage_priority'],
+                            row['facility'], row['updated_at']) for row in rows], read_started)
+        return len(rows)
+    
+    async def dequeue_patient(self, hms_patient_id: str) -> bool:
+        """Remove a patient from patient_queue and the triage queues; False when they were not queued"""
+        conn = await self.get_connection()
+        try:
+            removed = await conn.fetchval(
+                """
+                DELETE FROM patient_queue q USING patients p
+                WHERE p.id = q.patient_id AND p.patient_id = $1
+                RETURNING q.id
+                """,
+                hms_patient_id
+            )
+        finally:
+            await self.release_connection(conn)
+        triage_queue.remove(hms_patient_id)
+        return removed is not None
\ No newline at end of file
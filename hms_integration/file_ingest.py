@@ -0,0 +1,284 @@
+"""
+Streaming file ingest for HMS CSV/XML/Parquet/Arrow uploads
+Reads uploads chunk by chunk (CSV), record by record (XML) or record batch by
+record batch (Parquet/Arrow) and writes each batch before the next is parsed
+"""
+
+import asyncio
+import logging
+import mmap
+import os
+from concurrent.futures import Executor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, AsyncIterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from defusedxml.ElementTree import iterparse as ET_iterparse
+from fastapi import HTTPException
+
+from converters import CompiledConverter, converter_registry, records_from_frame, rows_from_frame
+from sync_pipeline import SyncPipeline, PipelineStage, PipelineStats, SyncDataType, validate_records
+
+logger = logging.getLogger(__name__)
+
+FILE_CHUNK_ROWS = int(os.getenv("HMS_FILE_CHUNK_ROWS", "5000"))
+# Chunks allowed to wait between stages; with one worker per stage at most
+# (queue size + 1) * 3 chunks are in memory regardless of file size
+FILE_QUEUE_SIZE = int(os.getenv("HMS_FILE_QUEUE_SIZE", "1"))
+# Converted file rows are already typed column-wise, so records are built from
+# them directly; set to false to run them through pydantic validation again
+FILE_TRUSTED_CONSTRUCT = os.getenv("HMS_FILE_TRUSTED_CONSTRUCT", "true").lower() == "true"
+
+PARQUET_MAGIC = b"PAR1"
+ARROW_FILE_MAGIC = b"ARROW1"
+
+
+def csv_batches(fileobj, chunk_rows: int = FILE_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Yield CSV chunks as raw text frames straight from the spooled upload
+
+    Every column is read as text with empty cells kept as empty strings,
+    so chunk-by-chunk type inference cannot disagree between chunks; typing
+    happens once per column in the header's compiled converter.
+    """
+    with pd.read_csv(fileobj, chunksize=chunk_rows, dtype=str, keep_default_na=False) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def xml_batches(fileobj, batch_size: int = FILE_CHUNK_ROWS) -> Iterator[List[Dict[str, Any]]]:
+    """Yield <record> elements as dicts in batches while the XML is still being parsed
+
+    Each finished record is cleared and detached from its parent, so the
+    partial tree never holds more than the record currently being read.
+    """
+    open_elements = []
+    batch = []
+    for event, elem in ET_iterparse(fileobj, events=("start", "end")):
+        if event == "start":
+            open_elements.append(elem)
+            continue
+
+        open_elements.pop()
+        if elem.tag != "record":
+            continue
+
+        batch.append({child.tag: child.text for child in elem})
+        elem.clear()
+        if open_elements:
+            open_elements[-1].remove(elem)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def arrow_batches(fileobj, data_type: str,
+                  batch_rows: int = FILE_CHUNK_ROWS) -> Iterator[Tuple[pa.RecordBatch, CompiledConverter]]:
+    """Yield record batches from a Parquet or Arrow IPC upload with the converter for its header
+
+    Only the columns the converter uses are read; the converter is chosen
+    from the full header, before that projection.
+
+    The spooled upload is memory-mapped rather than read, so Arrow decodes
+    straight from the page cache. The format is detected from the file's
+    magic bytes: Parquet, the Arrow IPC file format (.arrow/.feather v2),
+    or otherwise the Arrow IPC stream format.
+    """
+    fileobj.seek(0, os.SEEK_END)
+    if fileobj.tell() == 0:
+        raise ValueError("file is empty")
+    # fileno() moves a still in-memory spooled upload to its temporary file first
+    mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        source = pa.BufferReader(pa.py_buffer(mapped))
+        if mapped[:4] == PARQUET_MAGIC:
+            parquet_file = pq.ParquetFile(source)
+            converter = converter_registry.converter_for(parquet_file.schema_arrow.names, data_type)
+            for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=converter.source_columns(parquet_file.schema_arrow.names)):
+                yield batch, converter
+            return
+
+        if mapped[:6] == ARROW_FILE_MAGIC:
+            reader = pa.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        else:
+            batches = pa.ipc.open_stream(source)
+        for batch in batches:
+            converter = converter_registry.converter_for(batch.schema.names, data_type)
+            projected = batch.select(converter.source_columns(batch.schema.names))
+            # IPC batches keep the writer's size; re-slice them (zero-copy) to the chunk size
+            for offset in range(0, batch.num_rows, batch_rows):
+                yield projected.slice(offset, batch_rows), converter
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # Frames built from the last batch can still view the mapping; it closes once they are collected
+            pass
+
+
+async def iter_batches_in_thread(batches: Iterator[Any], label: str,
+                                 executor: Optional[Executor] = None) -> AsyncIterator[Any]:
+    """Pull parsed batches from a blocking parser in a worker thread to keep the event loop free
+
+    executor defaults to the loop's default executor; pass a dedicated one
+    when the source can block for long (e.g. a resumable upload still arriving).
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                batch = await loop.run_in_executor(executor, next, batches, None)
+            except HTTPException:
+                # e.g. 413 from an upload inflating past its limit
+                raise
+            except Exception as e:
+                logger.error(f"{label} processing error: {e}")
+                raise HTTPException(status_code=400, detail=f"Invalid {label} format: {e}")
+            if batch is None:
+                break
+            yield batch
+    finally:
+        batches.close()
+
+
+def iter_csv_batches(fileobj, chunk_rows: int = FILE_CHUNK_ROWS,
+                     executor: Optional[Executor] = None) -> AsyncIterator[pd.DataFrame]:
+    return iter_batches_in_thread(csv_batches(fileobj, chunk_rows), "CSV", executor)
+
+
+def iter_xml_batches(fileobj, batch_size: int = FILE_CHUNK_ROWS,
+                     executor: Optional[Executor] = None) -> AsyncIterator[List[Dict[str, Any]]]:
+    return iter_batches_in_thread(xml_batches(fileobj, batch_size), "XML", executor)
+
+
+def iter_arrow_batches(fileobj, data_type: str,
+                       batch_rows: int = FILE_CHUNK_ROWS) -> AsyncIterator[Tuple[pa.RecordBatch, CompiledConverter]]:
+    return iter_batches_in_thread(arrow_batches(fileobj, data_type, batch_rows), "Parquet/Arrow")
+
+
+def convert_raw_batch(batch: Union[pd.DataFrame, List[Dict[str, Any]]], data_type: SyncDataType,
+                      stats: PipelineStats) -> pd.DataFrame:
+    """Column-convert one raw batch, keeping only the rows that passed"""
+    frame = batch if isinstance(batch, pd.DataFrame) else pd.DataFrame.from_records(batch)
+    stats.add("read", len(frame))
+    clean, rejected = converter_registry.converter_for(frame.columns, data_type.name).convert(frame)
+    stats.rejected += rejected
+    return clean
+
+
+def convert_batch(batch: Union[pd.DataFrame, List[Dict[str, Any]]], data_type: SyncDataType,
+                  stats: PipelineStats) -> List[Any]:
+    """Column-convert one raw batch and build models from the rows that passed"""
+    clean = convert_raw_batch(batch, data_type, stats)
+    if FILE_TRUSTED_CONSTRUCT:
+        return records_from_frame(clean, data_type.record)
+    return validate_records(rows_from_frame(clean), data_type.record, stats)
+
+
+async def ingest_batches(batches: Union[Iterable[Any], AsyncIterable[Any]],
+                         data_type: SyncDataType, ledger: Optional[Any] = None) -> PipelineStats:
+    """Convert and write raw batches (frames or lists of row dicts) as they arrive
+
+    Data types with a COPY writer are bulk-written straight from the
+    converted columns; others build models and go through transform and
+    write. Stats count rows read under "read" and rows written under "write".
+    """
+    stats = PipelineStats()
+
+    if data_type.copy is not None:
+        async def convert_frame_stage(batch: Union[pd.DataFrame, List[Dict[str, Any]]]) -> pd.DataFrame:
+            return await asyncio.to_thread(convert_raw_batch, batch, data_type, stats)
+
+        return await copy_frames(batches, convert_frame_stage, data_type, stats, ledger)
+
+    async def convert_stage(batch: Union[pd.DataFrame, List[Dict[str, Any]]]) -> List[Any]:
+        return await asyncio.to_thread(convert_batch, batch, data_type, stats)
+
+    async def transform_stage(records: List[Any]) -> List[tuple]:
+        return data_type.transform(records)
+
+    pipeline = SyncPipeline([
+        PipelineStage("convert", convert_stage),
+        PipelineStage("transform", transform_stage),
+        PipelineStage("write", data_type.write),
+    ], queue_size=FILE_QUEUE_SIZE)
+    return await pipeline.run(batches, stats)
+
+
+def convert_record_batch(item: Tuple[pa.RecordBatch, CompiledConverter], stats: PipelineStats) -> pd.DataFrame:
+    """Column-convert one Arrow record batch, keeping the result as a frame for COPY"""
+    batch, converter = item
+    frame = batch.to_pandas()
+    stats.add("read", len(frame))
+    clean, rejected = converter.convert(frame)
+    stats.rejected += rejected
+    return clean
+
+
+async def ingest_record_batches(batches: Union[Iterable[Tuple[pa.RecordBatch, CompiledConverter]],
+                                               AsyncIterable[Tuple[pa.RecordBatch, CompiledConverter]]],
+                                data_type: SyncDataType, ledger: Optional[Any] = None) -> PipelineStats:
+    """Convert Arrow record batches column-wise and bulk-write them with the data type's COPY path
+
+    Stats count rows read under "read" and rows written under "write".
+    """
+    stats = PipelineStats()
+
+    async def convert_stage(item: Tuple[pa.RecordBatch, CompiledConverter]) -> pd.DataFrame:
+        return await asyncio.to_thread(convert_record_batch, item, stats)
+
+    return await copy_frames(batches, convert_stage, data_type, stats, ledger)
+
+
+async def ingest_parsed_frames(results: AsyncIterable[Tuple[pd.DataFrame, int, int]],
+                               data_type: SyncDataType, ledger: Optional[Any] = None) -> PipelineStats:
+    """Bulk-write frames already parsed and converted elsewhere (e.g. by worker processes)
+
+    Each result carries its frame with the rows read and rejected while
+    producing it; stats are kept as for ingest_record_batches.
+    """
+    stats = PipelineStats()
+
+    async def collect_stage(result: Tuple[pd.DataFrame, int, int]) -> pd.DataFrame:
+        frame, read, rejected = result
+        stats.add("read", read)
+        stats.rejected += rejected
+        return frame
+
+    return await copy_frames(results, collect_stage, data_type, stats, ledger)
+
+
+async def copy_frames(source: Union[Iterable[Any], AsyncIterable[Any]],
+                      convert_stage: Callable[[Any], Awaitable[pd.DataFrame]],
+                      data_type: SyncDataType, stats: PipelineStats,
+                      ledger: Optional[Any] = None) -> PipelineStats:
+    """Run converted frames into the data type's COPY writer
+
+    With an ingest ledger, rows whose content was already written are
+    dropped before the write and counted under "skipped", the rest under
+    "new" or "changed"; their hashes are recorded in the write's transaction.
+    """
+    if data_type.copy is None:
+        raise HTTPException(status_code=400, detail=f"Bulk upload is not supported for {data_type.name}")
+
+    async def write_stage(frame: pd.DataFrame) -> int:
+        if ledger is None:
+            return await data_type.copy(frame)
+
+        frame, digests, counts = await ledger.partition(data_type.name, frame)
+        for name, count in counts.items():
+            stats.add(name, count)
+        if frame.empty:
+            return 0
+        return await data_type.copy(frame, after=lambda conn: ledger.commit(digests, conn))
+
+    pipeline = SyncPipeline([
+        PipelineStage("convert", convert_stage),
+        PipelineStage("write", write_stage),
+    ], queue_size=FILE_QUEUE_SIZE)
+    return await pipeline.run(source, stats)
@@ -0,0 +1,242 @@
+"""
+HMS record models and API clients
+Imported by the API, the database mapper and shard worker processes, so it
+stays free of the FastAPI app, auth and database setup in main
+"""
+
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+import httpx
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+
+
+class HMSCredentials(BaseModel):
+    system_type: str = Field(..., description="HMS type: openmrs, afyapro, custom")
+    base_url: str = Field(..., description="HMS base URL")
+    username: str
+    password: str
+    client_id: Optional[str] = None
+    client_secret: Optional[str] = None
+    oauth_endpoint: Optional[str] = None
+
+class VitalSigns(BaseModel):
+    patient_id: str
+    encounter_id: Optional[str] = None
+    timestamp: datetime
+    systolic_bp: Optional[float] = None
+    diastolic_bp: Optional[float] = None
+    heart_rate: Optional[float] = None
+    temperature: Optional[float] = None
+    respiratory_rate: Optional[float] = None
+    oxygen_saturation: Optional[float] = None
+    weight: Optional[float] = None
+    height: Optional[float] = None
+    bmi: Optional[float] = None
+    recorded_by: Optional[str] = None
+
+class LabResult(BaseModel):
+    patient_id: str
+    order_id: Optional[str] = None
+    test_name: str
+    test_code: Optional[str] = None
+    result_value: Optional[str] = None
+    result_numeric: Optional[float] = None
+    reference_range: Optional[str] = None
+    units: Optional[str] = None
+    status: str = Field(default="completed", description="pending, completed, cancelled")
+    ordered_date: datetime
+    result_date: Optional[datetime] = None
+    ordered_by: Optional[str] = None
+    resulted_by: Optional[str] = None
+
+class Prescription(BaseModel):
+    patient_id: str
+    encounter_id: Optional[str] = None
+    medication_name: str
+    medication_code: Optional[str] = None
+    dosage: str
+    frequency: str
+    duration: Optional[str] = None
+    quantity: Optional[float] = None
+    instructions: Optional[str] = None
+    prescribed_date: datetime
+    prescribed_by: str
+    status: str = Field(default="active", description="active, completed, cancelled")
+
+class Diagnosis(BaseModel):
+    patient_id: str
+    encounter_id: Optional[str] = None
+    diagnosis_code: str
+    diagnosis_name: str
+    diagnosis_type: str = Field(default="primary", description="primary, secondary, differential")
+    status: str = Field(default="confirmed", description="confirmed, provisional, ruled_out")
+    diagnosed_date: datetime
+    diagnosed_by: str
+
+
+# HMS Integration classes
+class BaseHMSClient:
+    """Base class for HMS system clients"""
+    
+    def __init__(self, credentials: HMSCredentials):
+        self.credentials = credentials
+        self.base_url = credentials.base_url.rstrip('/')
+        self.session = None
+        self.token = None
+        
+    async def authenticate(self):
+        """Authenticate with HMS system"""
+        raise NotImplementedError
+        
+    async def get_vitals(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[VitalSigns]:
+        """Fetch vital signs from HMS"""
+        raise NotImplementedError
+        
+    async def get_lab_results(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[LabResult]:
+        """Fetch lab results from HMS"""
+        raise NotImplementedError
+        
+    async def get_prescriptions(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[Prescription]:
+        """Fetch prescriptions from HMS"""
+        raise NotImplementedError
+        
+    async def get_diagnoses(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[Diagnosis]:
+        """Fetch diagnoses from HMS"""
+        raise NotImplementedError
+
+class OpenMRSClient(BaseHMSClient):
+    """OpenMRS HMS client implementation"""
+    
+    async def authenticate(self):
+        """Authenticate with OpenMRS using session-based auth"""
+        async with httpx.AsyncClient() as client:
+            auth_url = f"{self.base_url}/ws/rest/v1/session"
+            auth_data = {
+                "username": self.credentials.username,
+                "password": self.credentials.password
+            }
+            
+            response = await client.post(auth_url, json=auth_data)
+            if response.status_code == 200:
+                session_data = response.json()
+                self.token = session_data.get("sessionId")
+                logger.info("Successfully authenticated with OpenMRS")
+                return True
+            else:
+                logger.error(f"OpenMRS authentication failed: {response.status_code}")
+                return False
+    
+    async def get_vitals(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[VitalSigns]:
+        """Fetch vital signs from OpenMRS"""
+        vitals = []
+        
+        async with httpx.AsyncClient() as client:
+            headers = {"Cookie": f"JSESSIONID={self.token}"} if self.token else {}
+            
+            for patient_id in patient_ids:
+                url = f"{self.base_url}/ws/rest/v1/patient/{patient_id}/encounter"
+                response = await client.get(url, headers=headers)
+                
+                if response.status_code == 200:
+                    encounters = response.json().get("results", [])
+                    
+                    for encounter in encounters:
+                        # Extract vital signs from encounter observations
+                        obs_url = f"{self.base_url}/ws/rest/v1/encounter/{encounter['uuid']}/obs"
+                        obs_response = await client.get(obs_url, headers=headers)
+                        
+                        if obs_response.status_code == 200:
+                            observations = obs_response.json().get("results", [])
+                            
+                            vital_data = {
+                                "patient_id": patient_id,
+                                "encounter_id": encounter["uuid"],
+                                "timestamp": datetime.fromisoformat(encounter["encounterDatetime"].replace("Z", "+00:00")),
+                            }
+                            
+                            # Map OpenMRS concepts to vital signs
+                            concept_mapping = {
+                                "5085": "systolic_bp",
+                                "5086": "diastolic_bp",
+                                "5087": "heart_rate",
+                                "5088": "temperature",
+                                "5242": "respiratory_rate",
+                                "5092": "oxygen_saturation",
+                                "5089": "weight",
+                                "5090": "height"
+                            }
+                            
+                            for obs in observations:
+                                concept_id = obs.get("concept", {}).get("uuid", "")
+                                if concept_id in concept_mapping:
+                                    field_name = concept_mapping[concept_id]
+                                    vital_data[field_name] = float(obs.get("value", 0))
+                            
+                            if len(vital_data) > 3:  # More than just basic fields
+                                vitals.append(VitalSigns(**vital_data))
+        
+        return vitals
+
+class AfyaProClient(BaseHMSClient):
+    """AfyaPro HMS client implementation"""
+    
+    async def authenticate(self):
+        """Authenticate with AfyaPro using OAuth2"""
+        if not self.credentials.oauth_endpoint:
+            logger.error("OAuth endpoint required for AfyaPro")
+            return False
+            
+        async with httpx.AsyncClient() as client:
+            token_data = {
+                "grant_type": "client_credentials",
+                "client_id": self.credentials.client_id,
+                "client_secret": self.credentials.client_secret
+            }
+            
+            response = await client.post(self.credentials.oauth_endpoint, data=token_data)
+            if response.status_code == 200:
+                token_info = response.json()
+                self.token = token_info.get("access_token")
+                logger.info("Successfully authenticated with AfyaPro")
+                return True
+            else:
+                logger.error(f"AfyaPro authentication failed: {response.status_code}")
+                return False
+
+class CustomEMRClient(BaseHMSClient):
+    """Custom EMR client implementation"""
+    
+    async def authenticate(self):
+        """Authenticate with custom EMR using token-based auth"""
+        async with httpx.AsyncClient() as client:
+            auth_url = f"{self.base_url}/api/auth/login"
+            auth_data = {
+                "username": self.credentials.username,
+                "password": self.credentials.password
+            }
+            
+            response = await client.post(auth_url, json=auth_data)
+            if response.status_code == 200:
+                auth_result = response.json()
+                self.token = auth_result.get("token")
+                logger.info("Successfully authenticated with Custom EMR")
+                return True
+            else:
+                logger.error(f"Custom EMR authentication failed: {response.status_code}")
+                return False
+
+# Factory function to create HMS clients
+def create_hms_client(credentials: HMSCredentials) -> BaseHMSClient:
+    """Factory function to create appropriate HMS client"""
+    if credentials.system_type.lower() == "openmrs":
+        return OpenMRSClient(credentials)
+    elif credentials.system_type.lower() == "afyapro":
+        return AfyaProClient(credentials)
+    elif credentials.system_type.lower() == "custom":
+        return CustomEMRClient(credentials)
+    else:
+        raise ValueError(f"Unsupported HMS type: {credentials.system_type}")
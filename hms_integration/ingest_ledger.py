@@ -0,0 +1,214 @@
+"""
+Content-hash ledger for file ingest
+Remembers file digests and per-row content hashes so re-uploaded exports
+skip files and rows that were already written
+"""
+
+import hashlib
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from converters import FRAME_SCHEMAS
+
+logger = logging.getLogger(__name__)
+
+LEDGER_ENABLED = os.getenv("HMS_INGEST_LEDGER_ENABLED", "true").lower() == "true"
+# A file claimed by an ingest that never finished (e.g. the replica died) can be claimed again after this long
+LEDGER_CLAIM_TIMEOUT_SECONDS = float(os.getenv("HMS_INGEST_CLAIM_TIMEOUT_SECONDS", "3600"))
+
+LEDGER_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hms_ingest_files (
+        data_type text NOT NULL,
+        digest text NOT NULL,
+        filename text,
+        row_count bigint,
+        created_at timestamp NOT NULL DEFAULT (now() at time zone 'utc'),
+        PRIMARY KEY (data_type, digest)
+    );
+    CREATE TABLE IF NOT EXISTS hms_ingest_rows (
+        data_type text NOT NULL,
+        key_hash bigint NOT NULL,
+        content_hash bigint NOT NULL,
+        updated_at timestamp NOT NULL DEFAULT (now() at time zone 'utc'),
+        PRIMARY KEY (data_type, key_hash)
+    );
+"""
+
+
+def file_digest(fileobj, block_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a whole upload, leaving the file positioned at the start"""
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    for block in iter(lambda: fileobj.read(block_size), b""):
+        digest.update(block)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def _hash_rows(frame: pd.DataFrame) -> np.ndarray:
+    """Stable 64-bit hash per row (fixed siphash key), as signed values for a bigint column"""
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy().view(np.int64)
+
+
+class RowDigests:
+    """Natural-key and content hashes of the rows about to be written for one batch"""
+
+    def __init__(self, data_type: str, key_hashes: np.ndarray, content_hashes: np.ndarray,
+                 patient_ids: np.ndarray):
+        self.data_type = data_type
+        self.key_hashes = key_hashes
+        self.content_hashes = content_hashes
+        self.patient_ids = patient_ids
+
+
+class IngestLedger:
+    """Postgres-backed ledger of ingested files and rows
+
+    A file is identified by its SHA-256 and claimed by primary key before
+    it is ingested, so two uploads of the same file cannot both run. Rows
+    are identified by a hash of their data type's natural key columns and
+    compared by a hash of all converted columns, so only new or changed
+    rows are passed on to the writer. Connections come from the database
+    mapper's pool.
+    """
+
+    def __init__(self, mapper, enabled: bool = LEDGER_ENABLED):
+        self.mapper = mapper
+        self.enabled = enabled
+        self._schema_ready = False
+
+    async def _connect(self):
+        conn = await self.mapper.get_connection()
+        if not self._schema_ready:
+            try:
+                await conn.execute(LEDGER_SCHEMA)
+            except Exception:
+                await self.mapper.release_connection(conn)
+                raise
+            self._schema_ready = True
+        return conn
+
+    async def claim_file(self, data_type: str, digest: str, filename: str) -> bool:
+        """Claim a file for ingest; False when it was already ingested or another ingest holds it"""
+        if not self.enabled:
+            return True
+        conn = await self._connect()
+        try:
+            claimed = await conn.fetchval(
+                """
+                INSERT INTO hms_ingest_files AS f (data_type, digest, filename)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (data_type, digest) DO UPDATE SET
+                    filename = EXCLUDED.filename, created_at = EXCLUDED.created_at
+                WHERE f.row_count IS NULL
+                    AND f.created_at < (now() at time zone 'utc') - make_interval(secs => $4)
+                RETURNING digest
+                """,
+                data_type, digest, filename, LEDGER_CLAIM_TIMEOUT_SECONDS
+            )
+            return claimed is not None
+        finally:
+            await self.mapper.release_connection(conn)
+
+    async def release_file(self, data_type: str, digest: str):
+        """Give up a claim whose ingest failed, so the file can be uploaded again"""
+        if not self.enabled:
+            return
+        conn = await self._connect()
+        try:
+            await conn.execute(
+                "DELETE FROM hms_ingest_files WHERE data_type = $1 AND digest = $2 AND row_count IS NULL",
+                data_type, digest
+            )
+        finally:
+            await self.mapper.release_connection(conn)
+
+    async def record_file(self, data_type: str, digest: str, filename: str, row_count: int):
+        """Mark a file as ingested, completing its claim if it has one"""
+        if not self.enabled:
+            return
+        conn = await self._connect()
+        try:
+            await conn.execute(
+                """
+                INSERT INTO hms_ingest_files (data_type, digest, filename, row_count)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (data_type, digest) DO UPDATE SET row_count = EXCLUDED.row_count
+                """,
+                data_type, digest, filename, row_count
+            )
+        finally:
+            await self.mapper.release_connection(conn)
+
+    async def partition(self, data_type: str, frame: pd.DataFrame) -> Tuple[pd.DataFrame, Optional[RowDigests], Dict[str, int]]:
+        """Drop rows whose content is already in the ledger
+
+        Returns the new and changed rows, their digests for commit() in the
+        transaction that writes them, and new/changed/skipped counts.
+        """
+        if not self.enabled or frame.empty:
+            return frame, None, {"new": len(frame), "changed": 0, "skipped": 0}
+
+        schema = FRAME_SCHEMAS[data_type]
+        key_hashes = _hash_rows(frame[schema.natural_key])
+        content_hashes = _hash_rows(frame[schema.columns])
+
+        conn = await self._connect()
+        try:
+            rows = await conn.fetch(
+                "SELECT key_hash, content_hash FROM hms_ingest_rows WHERE data_type = $1 AND key_hash = ANY($2::bigint[])",
+                data_type, np.unique(key_hashes).tolist()
+            )
+        finally:
+            await self.mapper.release_connection(conn)
+
+        known_keys = np.array([row['key_hash'] for row in rows], dtype=np.int64)
+        known_content = np.array([row['content_hash'] for row in rows], dtype=np.int64)
+        position = pd.Index(known_keys).get_indexer(key_hashes)
+        is_new = position < 0
+        is_skipped = np.zeros(len(frame), dtype=bool)
+        if len(known_keys):
+            is_skipped = ~is_new & (known_content[position] == content_hashes)
+
+        counts = {
+            "new": int(is_new.sum()),
+            "changed": int((~is_new & ~is_skipped).sum()),
+            "skipped": int(is_skipped.sum())
+        }
+        keep = ~is_skipped
+        kept = frame[keep]
+        digests = RowDigests(data_type, key_hashes[keep], content_hashes[keep], kept["patient_id"].to_numpy())
+        return kept, digests, counts
+
+    async def commit(self, digests: Optional[RowDigests], conn):
+        """Record the hashes of rows being written, on the writer's connection and transaction
+
+        Rows for patients missing from Erlessed are skipped by the writer,
+        so they are left out and get another chance on the next upload.
+        """
+        if not self.enabled or digests is None or len(digests.key_hashes) == 0:
+            return
+        # One ledger row per natural key; the last occurrence in the batch is what was written
+        latest = pd.DataFrame({
+            "key": digests.key_hashes,
+            "content": digests.content_hashes,
+            "patient_id": digests.patient_ids
+        }).drop_duplicates("key", keep="last")
+        if not self._schema_ready:
+            await conn.execute(LEDGER_SCHEMA)
+            self._schema_ready = True
+        await conn.execute(
+            """
+            INSERT INTO hms_ingest_rows (data_type, key_hash, content_hash)
+            SELECT $1, t.k, t.c
+            FROM unnest($2::bigint[], $3::bigint[], $4::text[]) AS t(k, c, patient_id)
+            WHERE EXISTS (SELECT 1 FROM patients p WHERE p.patient_id = t.patient_id)
+            ON CONFLICT (data_type, key_hash)
+            DO UPDATE SET content_hash = EXCLUDED.content_hash, updated_at = now() at time zone 'utc'
+            """,
+            digests.data_type, latest["key"].tolist(), latest["content"].tolist(), latest["patient_id"].tolist()
+        )
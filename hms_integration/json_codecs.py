@@ -0,0 +1,71 @@
+"""
+JSON encoding for database parameters and HMS payloads
+Registers json/jsonb codecs on asyncpg connections so dicts are encoded at
+bind time by a pluggable encoder (orjson when installed, stdlib json otherwise)
+"""
+
+import json
+import os
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
+JSON_ENCODER = (os.getenv("HMS_JSON_ENCODER") or ("orjson" if orjson else "json")).lower()
+
+# jsonb values on the binary wire format are a version byte followed by the JSON text
+JSONB_VERSION = b"\x01"
+
+
+def _default(value: Any) -> Any:
+    """Fallback for values json cannot encode natively; datetimes as ISO 8601 like orjson"""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if hasattr(value, "item"):  # NumPy scalars
+        return value.item()
+    return str(value)
+
+
+def _stdlib_dumps(value: Any) -> bytes:
+    # allow_nan=False: Postgres rejects NaN/Infinity in JSON, better to fail on our side
+    return json.dumps(value, separators=(",", ":"), allow_nan=False, default=_default).encode()
+
+
+def _orjson_dumps(value: Any) -> bytes:
+    return orjson.dumps(value, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+# Encoder name -> (dumps to UTF-8 bytes, loads from bytes or str)
+ENCODERS: Dict[str, Tuple[Callable[[Any], bytes], Callable[[Any], Any]]] = {
+    "json": (_stdlib_dumps, json.loads),
+}
+if orjson is not None:
+    ENCODERS["orjson"] = (_orjson_dumps, orjson.loads)
+
+if JSON_ENCODER not in ENCODERS:
+    raise ValueError(f"HMS_JSON_ENCODER={JSON_ENCODER} is not available (choose from {', '.join(ENCODERS)})")
+
+dumps, loads = ENCODERS[JSON_ENCODER]
+
+
+def _encode_jsonb(value: Any) -> bytes:
+    return JSONB_VERSION + dumps(value)
+
+
+def _decode_jsonb(data: bytes) -> Any:
+    return loads(data[1:])
+
+
+async def register_json_codecs(conn):
+    """asyncpg connection init hook: exchange json and jsonb as Python values in binary format
+
+    Parameters bound to json/jsonb (including $n::jsonb casts) take dicts
+    and lists directly, and json/jsonb columns come back decoded.
+    """
+    await conn.set_type_codec("jsonb", schema="pg_catalog", format="binary",
+                              encoder=_encode_jsonb, decoder=_decode_jsonb)
+    await conn.set_type_codec("json", schema="pg_catalog", format="binary",
+                              encoder=dumps, decoder=loads)
@@ -3,7 +3,7 @@ Erlessed HMS Integration Microservice
 Secure FastAPI service for hospital management system integration
 """
 
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
@@ -12,10 +12,8 @@ import os
 import logging
 from datetime import datetime, timedelta
 import asyncio
-import httpx
 import json
 import pandas as pd
-from defusedxml.ElementTree import fromstring as ET_fromstring
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import aiofiles
@@ -48,6 +46,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Inflate gzip/zstd request bodies before multipart or NDJSON parsing sees them
+from compression import RequestDecompressionMiddleware, split_compression, open_decompressed
+app.add_middleware(RequestDecompressionMiddleware)
+
 # Security configuration
 SECRET_KEY = os.getenv("HMS_SECRET_KEY", "your-secret-key-here")
 ALGORITHM = "HS256"
@@ -64,6 +66,11 @@ if not DATABASE_URL:
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# HMS record models and clients live in hms_clients so shard workers can import them without the API
+from hms_clients import (
+    HMSCredentials, VitalSigns, LabResult, Prescription, Diagnosis, BaseHMSClient, create_hms_client
+)
+
 # Pydantic models for API requests/responses
 class Token(BaseModel):
     access_token: str
@@ -72,15 +79,6 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     username: Optional[str] = None
 
-class HMSCredentials(BaseModel):
-    system_type: str = Field(..., description="HMS type: openmrs, afyapro, custom")
-    base_url: str = Field(..., description="HMS base URL")
-    username: str
-    password: str
-    client_id: Optional[str] = None
-    client_secret: Optional[str] = None
-    oauth_endpoint: Optional[str] = None
-
 class PatientConsent(BaseModel):
     patient_id: str
     consent_type: str = Field(..., description="data_sync, analytics, sharing")
@@ -99,59 +97,27 @@ class SyncRequest(BaseModel):
     include_prescriptions: bool = True
     include_diagnoses: bool = True
 
-class VitalSigns(BaseModel):
-    patient_id: str
-    encounter_id: Optional[str] = None
-    timestamp: datetime
-    systolic_bp: Optional[float] = None
-    diastolic_bp: Optional[float] = None
-    heart_rate: Optional[float] = None
-    temperature: Optional[float] = None
-    respiratory_rate: Optional[float] = None
-    oxygen_saturation: Optional[float] = None
-    weight: Optional[float] = None
-    height: Optional[float] = None
-    bmi: Optional[float] = None
-    recorded_by: Optional[str] = None
-
-class LabResult(BaseModel):
-    patient_id: str
-    order_id: Optional[str] = None
-    test_name: str
-    test_code: Optional[str] = None
-    result_value: Optional[str] = None
-    result_numeric: Optional[float] = None
-    reference_range: Optional[str] = None
-    units: Optional[str] = None
-    status: str = Field(default="completed", description="pending, completed, cancelled")
-    ordered_date: datetime
-    result_date: Optional[datetime] = None
-    ordered_by: Optional[str] = None
-    resulted_by: Optional[str] = None
-
-class Prescription(BaseModel):
-    patient_id: str
-    encounter_id: Optional[str] = None
-    medication_name: str
-    medication_code: Optional[str] = None
-    dosage: str
-    frequency: str
-    duration: Optional[str] = None
-    quantity: Optional[float] = None
-    instructions: Optional[str] = None
-    prescribed_date: datetime
-    prescribed_by: str
-    status: str = Field(default="active", description="active, completed, cancelled")
-
-class Diagnosis(BaseModel):
-    patient_id: str
-    encounter_id: Optional[str] = None
-    diagnosis_code: str
-    diagnosis_name: str
-    diagnosis_type: str = Field(default="primary", description="primary, secondary, differential")
-    status: str = Field(default="confirmed", description="confirmed, provisional, ruled_out")
-    diagnosed_date: datetime
-    diagnosed_by: str
+class FacilitySchedule(BaseModel):
+    facility_id: str
+    hms_credentials: HMSCredentials
+    patient_ids: Optional[List[str]] = None
+    interval_minutes: int = Field(default=15, ge=1, description="Minutes between incremental syncs")
+    include_vitals: bool = True
+    include_labs: bool = True
+    include_prescriptions: bool = True
+    include_diagnoses: bool = True
+
+class BackfillRequest(BaseModel):
+    date_from: Optional[datetime] = None
+    date_to: Optional[datetime] = None
+    data_types: Optional[List[str]] = Field(default=None, description="vitals, lab_results, prescriptions, diagnoses")
+
+class ResumableUploadInit(BaseModel):
+    data_type: str = Field(..., description="vitals, lab_results, prescriptions, diagnoses")
+    filename: str = Field(..., description="Export file name; the extension selects the parser")
+    total_size: int = Field(..., ge=1, description="Size of the whole file in bytes")
+    sha256: Optional[str] = Field(default=None, description="Digest of the whole file; lets an already ingested file be rejected up front")
+    facility_id: Optional[str] = Field(default=None, description="Registered facility the records come from; selects its triage rules and queue")
 
 # Authentication functions
 def verify_password(plain_password, hashed_password):
@@ -187,173 +153,9 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise credentials_exception
     return token_data
 
-# HMS Integration classes
-class BaseHMSClient:
-    """Base class for HMS system clients"""
-    
-    def __init__(self, credentials: HMSCredentials):
-        self.credentials = credentials
-        self.base_url = credentials.base_url.rstrip('/')
-        self.session = None
-        self.token = None
-        
-    async def authenticate(self):
-        """Authenticate with HMS system"""
-        raise NotImplementedError
-        
-    async def get_vitals(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[VitalSigns]:
-        """Fetch vital signs from HMS"""
-        raise NotImplementedError
-        
-    async def get_lab_results(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[LabResult]:
-        """Fetch lab results from HMS"""
-        raise NotImplementedError
-        
-    async def get_prescriptions(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[Prescription]:
-        """Fetch prescriptions from HMS"""
-        raise NotImplementedError
-        
-    async def get_diagnoses(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[Diagnosis]:
-        """Fetch diagnoses from HMS"""
-        raise NotImplementedError
-
-class OpenMRSClient(BaseHMSClient):
-    """OpenMRS HMS client implementation"""
-    
-    async def authenticate(self):
-        """Authenticate with OpenMRS using session-based auth"""
-        async with httpx.AsyncClient() as client:
-            auth_url = f"{self.base_url}/ws/rest/v1/session"
-            auth_data = {
-                "username": self.credentials.username,
-                "password": self.credentials.password
-            }
-            
-            response = await client.post(auth_url, json=auth_data)
-            if response.status_code == 200:
-                session_data = response.json()
-                self.token = session_data.get("sessionId")
-                logger.info("Successfully authenticated with OpenMRS")
-                return True
-            else:
-                logger.error(f"OpenMRS authentication failed: {response.status_code}")
-                return False
-    
-    async def get_vitals(self, patient_ids: List[str], date_from: datetime = None, date_to: datetime = None) -> List[VitalSigns]:
-        """Fetch vital signs from OpenMRS"""
-        vitals = []
-        
-        async with httpx.AsyncClient() as client:
-            headers = {"Cookie": f"JSESSIONID={self.token}"} if self.token else {}
-            
-            for patient_id in patient_ids:
-                url = f"{self.base_url}/ws/rest/v1/patient/{patient_id}/encounter"
-                response = await client.get(url, headers=headers)
-                
-                if response.status_code == 200:
-                    encounters = response.json().get("results", [])
-                    
-                    for encounter in encounters:
-                        # Extract vital signs from encounter observations
-                        obs_url = f"{self.base_url}/ws/rest/v1/encounter/{encounter['uuid']}/obs"
-                        obs_response = await client.get(obs_url, headers=headers)
-                        
-                        if obs_response.status_code == 200:
-                            observations = obs_response.json().get("results", [])
-                            
-                            vital_data = {
-                                "patient_id": patient_id,
-                                "encounter_id": encounter["uuid"],
-                                "timestamp": datetime.fromisoformat(encounter["encounterDatetime"].replace("Z", "+00:00")),
-                            }
-                            
-                            # Map OpenMRS concepts to vital signs
-                            concept_mapping = {
-                                "5085": "systolic_bp",
-                                "5086": "diastolic_bp",
-                                "5087": "heart_rate",
-                                "5088": "temperature",
-                                "5242": "respiratory_rate",
-                                "5092": "oxygen_saturation",
-                                "5089": "weight",
-                                "5090": "height"
-                            }
-                            
-                            for obs in observations:
-                                concept_id = obs.get("concept", {}).get("uuid", "")
-                                if concept_id in concept_mapping:
-                                    field_name = concept_mapping[concept_id]
-                                    vital_data[field_name] = float(obs.get("value", 0))
-                            
-                            if len(vital_data) > 3:  # More than just basic fields
-                                vitals.append(VitalSigns(**vital_data))
-        
-        return vitals
-
-class AfyaProClient(BaseHMSClient):
-    """AfyaPro HMS client implementation"""
-    
-    async def authenticate(self):
-        """Authenticate with AfyaPro using OAuth2"""
-        if not self.credentials.oauth_endpoint:
-            logger.error("OAuth endpoint required for AfyaPro")
-            return False
-            
-        async with httpx.AsyncClient() as client:
-            token_data = {
-                "grant_type": "client_credentials",
-                "client_id": self.credentials.client_id,
-                "client_secret": self.credentials.client_secret
-            }
-            
-            response = await client.post(self.credentials.oauth_endpoint, data=token_data)
-            if response.status_code == 200:
-                token_info = response.json()
-                self.token = token_info.get("access_token")
-                logger.info("Successfully authenticated with AfyaPro")
-                return True
-            else:
-                logger.error(f"AfyaPro authentication failed: {response.status_code}")
-                return False
-
-class CustomEMRClient(BaseHMSClient):
-    """Custom EMR client implementation"""
-    
-    async def authenticate(self):
-        """Authenticate with custom EMR using token-based auth"""
-        async with httpx.AsyncClient() as client:
-            auth_url = f"{self.base_url}/api/auth/login"
-            auth_data = {
-                "username": self.credentials.username,
-                "password": self.credentials.password
-            }
-            
-            response = await client.post(auth_url, json=auth_data)
-            if response.status_code == 200:
-                auth_result = response.json()
-                self.token = auth_result.get("token")
-                logger.info("Successfully authenticated with Custom EMR")
-                return True
-            else:
-                logger.error(f"Custom EMR authentication failed: {response.status_code}")
-                return False
-
-# Factory function to create HMS clients
-def create_hms_client(credentials: HMSCredentials) -> BaseHMSClient:
-    """Factory function to create appropriate HMS client"""
-    if credentials.system_type.lower() == "openmrs":
-        return OpenMRSClient(credentials)
-    elif credentials.system_type.lower() == "afyapro":
-        return AfyaProClient(credentials)
-    elif credentials.system_type.lower() == "custom":
-        return CustomEMRClient(credentials)
-    else:
-        raise ValueError(f"Unsupported HMS type: {credentials.system_type}")
-
-# Database functions for data normalization and storage
-from database_mapper import ErlessedDatabaseMapper
-
-db_mapper = ErlessedDatabaseMapper()
+# Database functions for data normalization and storage; the mapper and the
+# sync data types, keyed by the names used in sync responses, are in sync_registry
+from sync_registry import db_mapper, SYNC_DATA_TYPES, requested_data_types
 
 async def store_vitals(vitals: List[VitalSigns]) -> int:
     """Store vital signs in Erlessed database"""
@@ -371,33 +173,40 @@ async def store_diagnoses(diagnoses: List[Diagnosis]) -> int:
     """Store diagnoses in Erlessed database"""
     return await db_mapper.store_diagnoses(diagnoses)
 
-# File processing functions for CSV/XML fallback
-async def process_csv_file(file_content: bytes, data_type: str) -> List[Dict]:
-    """Process CSV file and return structured data"""
-    try:
-        df = pd.read_csv(io.BytesIO(file_content))
-        return df.to_dict('records')
-    except Exception as e:
-        logger.error(f"CSV processing error: {e}")
-        raise HTTPException(status_code=400, detail=f"Invalid CSV format: {e}")
+from sync_pipeline import run_sync_pipeline
+from sync_leases import SyncLeaseManager, LeaseSet, LeaseUnavailable, lease_facility_key, REPLICA_ID
+from triage_rules import triage_engine, current_facility
+from news2 import news2_tracker
+from vitals_baseline import vitals_baselines, BASELINE_PERSIST_SECONDS
+from vitals_history import RETENTION_INTERVAL_SECONDS
+from triage_queue import triage_queue, TRIAGE_QUEUE_REFRESH_SECONDS
+
+lease_manager = SyncLeaseManager(DATABASE_URL)
+
+# File processing functions for CSV/XML/Parquet/Arrow uploads
+from file_ingest import (
+    iter_csv_batches, iter_xml_batches, iter_arrow_batches, ingest_batches, ingest_record_batches, ingest_parsed_frames
+)
+from converters import converter_registry
+from parallel_parse import ParallelCsvParser, spool_to_disk, PARALLEL_PARSE_MIN_BYTES
+from ingest_ledger import IngestLedger, file_digest
+
+COLUMNAR_FILE_EXTENSIONS = ('.parquet', '.arrow', '.feather', '.ipc')
+
+parallel_parser = ParallelCsvParser()
+ingest_ledger = IngestLedger(db_mapper)
 
-async def process_xml_file(file_content: bytes, data_type: str) -> List[Dict]:
-    """Process XML file and return structured data"""
+async def ingest_csv_in_processes(fileobj, data_type: str):
+    """Parse a large uncompressed CSV upload across worker processes and bulk-write it"""
+    path = await asyncio.to_thread(spool_to_disk, fileobj)
     try:
-        root = ET_fromstring(file_content)
-        data = []
-        
-        # Basic XML parsing - customize based on your XML structure
-        for item in root.findall('.//record'):
-            record = {}
-            for child in item:
-                record[child.tag] = child.text
-            data.append(record)
-        
-        return data
-    except Exception as e:
-        logger.error(f"XML processing error: {e}")
-        raise HTTPException(status_code=400, detail=f"Invalid XML format: {e}")
+        return await ingest_parsed_frames(parallel_parser.iter_frames(path, data_type), SYNC_DATA_TYPES[data_type],
+                                          ingest_ledger)
+    finally:
+        os.remove(path)
+
+# Push ingest of streamed NDJSON bodies
+from push_ingest import check_ndjson_content_type, ingest_ndjson
 
 # Consent management functions
 async def log_patient_consent(consent: PatientConsent):
@@ -415,6 +224,227 @@ async def verify_patient_consent(patient_id: str, consent_type: str) -> bool:
     """Verify if patient has granted consent for data synchronization"""
     return await db_mapper.verify_patient_consent(patient_id, consent_type)
 
+# Scheduled incremental sync
+from sync_scheduler import SyncScheduler, SCHEDULER_ENABLED
+
+async def run_facility_sync(facility: FacilitySchedule, patient_ids: Optional[List[str]],
+                            date_from: Optional[datetime], date_to: Optional[datetime],
+                            data_types: Optional[List[str]] = None,
+                            leases: Optional[LeaseSet] = None) -> Dict[str, int]:
+    """Fetch and store one slice of patients for a scheduled facility sync
+    
+    leases is the job's lease set, so a data type leased for the first
+    slice stays leased for the rest of the job.
+    """
+    consented_ids = []
+    for patient_id in patient_ids or []:
+        if await verify_patient_consent(patient_id, "data_sync"):
+            consented_ids.append(patient_id)
+        else:
+            logger.info(f"Skipping patient {patient_id} without data_sync consent")
+
+    hms_client = create_hms_client(facility.hms_credentials)
+    if not await hms_client.authenticate():
+        raise RuntimeError(f"HMS authentication failed for facility {facility.facility_id}")
+
+    facility_key = lease_facility_key(facility.hms_credentials)
+    current_facility.set(facility.facility_id)
+    job_leases = leases or lease_manager.lease_set(facility_key)
+    results = {}
+    leased_elsewhere = []
+    try:
+        for data_type in requested_data_types(facility):
+            if data_types is not None and data_type not in data_types:
+                continue
+            if not await job_leases.hold(data_type):
+                leased_elsewhere.append(data_type)
+                continue
+            try:
+                stats = await run_sync_pipeline(hms_client, SYNC_DATA_TYPES[data_type], consented_ids,
+                                                date_from, date_to)
+            except NotImplementedError:
+                logger.debug(f"{facility.hms_credentials.system_type} client does not support {data_type}, skipping")
+                continue
+            results[data_type] = stats.get("write")
+    finally:
+        if leases is None:
+            await job_leases.release()
+
+    if leased_elsewhere:
+        raise LeaseUnavailable(facility_key, leased_elsewhere, results)
+    return results
+
+async def get_urgent_patient_ids() -> Dict[str, List[str]]:
+    """Patients currently queued with urgent triage priority, by facility"""
+    return await db_mapper.get_urgent_patient_ids()
+
+sync_scheduler = SyncScheduler(run_facility_sync, urgent_patients_provider=get_urgent_patient_ids,
+                               lease_manager=lease_manager)
+
+# Sharded sync across worker processes
+from sync_sharding import ShardedSyncRunner, partition_patients
+from sync_scheduler import SyncJob, PRIORITY_ON_DEMAND
+
+sharded_runner = ShardedSyncRunner()
+background_tasks = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    """Run a coroutine in the background, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def run_sharded_job(job: SyncJob, sync_request: SyncRequest, data_types: List[str],
+                          shards: List[List[str]]):
+    """Hold the facility leases while the shard processes run"""
+    facility_key = lease_facility_key(sync_request.hms_credentials)
+    try:
+        async with lease_manager.lease_set(facility_key) as leases:
+            for data_type in data_types:
+                if not await leases.hold(data_type):
+                    raise LeaseUnavailable(facility_key, [data_type])
+            # Shard processes load baselines from the table, so hand them this process's latest
+            await db_mapper.save_vitals_baselines()
+            await sharded_runner.run(job, sync_request.hms_credentials.model_dump(), data_types, shards,
+                                     sync_scheduler.facility_for(sync_request.hms_credentials))
+    except Exception as e:
+        logger.error(f"Sharded sync job {job.job_id} failed: {e}")
+        job.errors.append(str(e))
+        job.status = "failed"
+        job.completed_at = datetime.utcnow()
+    finally:
+        # The shard processes moved these patients on; reload their state before the next batch here
+        synced = [patient_id for shard in shards for patient_id in shard]
+        vitals_baselines.invalidate(synced)
+        news2_tracker.forget(synced)
+        if "vitals" in data_types:
+            # The shard processes wrote these queue rows, so this process's triage queue has not seen them
+            try:
+                await db_mapper.load_triage_queue()
+            except Exception as e:
+                logger.error(f"Reloading the triage queue after sharded sync job {job.job_id} failed: {e}")
+
+# Resumable chunked uploads, ingested while later chunks are still arriving
+from resumable_upload import (ResumableUploadStore, UploadAborted, UploadLimitReached, UPLOAD_CHUNK_MAX_BYTES,
+                              UPLOAD_MAX_BYTES)
+
+# Data types accepted by the file endpoints, with the sync type each reports
+FILE_SYNC_TYPES = {
+    "vitals": "file_vitals",
+    "lab_results": "file_labs",
+    "prescriptions": "file_prescriptions",
+    "diagnoses": "file_diagnoses",
+}
+SUPPORTED_FILE_EXTENSIONS = ('.csv', '.xml') + COLUMNAR_FILE_EXTENSIONS
+
+upload_store = ResumableUploadStore()
+
+async def run_upload_ingest(session, job: SyncJob, claimed_digest: Optional[str] = None,
+                            facility_id: Optional[str] = None):
+    """Ingest a resumable upload from its contiguous prefix and record the result on its job
+    
+    claimed_digest is the ledger claim taken for the client's declared sha256.
+    Rows are written while the file streams in, so the digest can only be
+    checked afterwards: on a mismatch the rows stay written (they are upserts,
+    so a corrected re-upload overwrites them), the file is recorded under its
+    actual digest, the claim is released and the job completes with a warning.
+    On failure the claim is released.
+    """
+    job.status = "running"
+    job.started_at = datetime.utcnow()
+    current_facility.set(facility_id)
+    try:
+        if split_compression(session.filename.lower())[0].endswith(COLUMNAR_FILE_EXTENSIONS):
+            # Parquet keeps its metadata in the footer and Arrow files are memory-mapped, so wait for all bytes
+            await asyncio.get_running_loop().run_in_executor(upload_store.executor, session.wait_until_finalized)
+            fileobj = open(session.path, "rb")
+        else:
+            fileobj = session.open_reader()
+        with fileobj:
+            stats = await ingest_file(fileobj, session.filename, session.data_type, executor=upload_store.executor)
+        job.record({session.data_type: stats.get("write")})
+        with open(session.path, "rb") as completed:
+            digest = await asyncio.to_thread(file_digest, completed)
+        await ingest_ledger.record_file(session.data_type, digest, session.filename, stats.get("read"))
+        if claimed_digest and digest != claimed_digest:
+            warning = f"sha256 of the received file is {digest}, not the declared {claimed_digest}; its rows were written"
+            logger.warning(f"Upload {session.upload_id}: {warning}")
+            job.warnings.append(warning)
+            await ingest_ledger.release_file(session.data_type, claimed_digest)
+            claimed_digest = None
+        job.slices_done = 1
+        job.status = "completed"
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Upload {session.upload_id} ingest failed: {detail}")
+        job.errors.append(detail)
+        job.status = "failed"
+        session.abort(detail)
+        if claimed_digest:
+            await ingest_ledger.release_file(session.data_type, claimed_digest)
+    finally:
+        job.completed_at = datetime.utcnow()
+        # Failed uploads (including idle timeouts) are discarded too; their job keeps the error
+        upload_store.discard(session)
+
+def get_upload_session(upload_id: str):
+    session = upload_store.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found")
+    return session
+
+async def persist_vitals_baselines():
+    """Save changed per-patient vitals baselines every BASELINE_PERSIST_SECONDS"""
+    while True:
+        await asyncio.sleep(BASELINE_PERSIST_SECONDS)
+        try:
+            await db_mapper.save_vitals_baselines()
+        except Exception as e:
+            logger.error(f"Persisting vitals baselines failed: {e}")
+
+async def enforce_vitals_retention():
+    """Expire vitals history partitions and rollups every RETENTION_INTERVAL_SECONDS"""
+    while True:
+        try:
+            await db_mapper.enforce_vitals_retention()
+        except Exception as e:
+            logger.error(f"Vitals history retention failed: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+async def refresh_triage_queue():
+    """Rebuild the triage queues from patient_queue, then pick up other replicas' writes periodically"""
+    while True:
+        try:
+            count = await db_mapper.load_triage_queue()
+            logger.info(f"Loaded {count} queued patients into the triage queues")
+        except Exception as e:
+            logger.error(f"Loading the triage queues failed: {e}")
+        if TRIAGE_QUEUE_REFRESH_SECONDS <= 0 and triage_queue.loaded:
+            return
+        await asyncio.sleep(TRIAGE_QUEUE_REFRESH_SECONDS or 60)
+
+@app.on_event("startup")
+async def start_sync_scheduler():
+    if SCHEDULER_ENABLED:
+        await sync_scheduler.start()
+    start_background_task(persist_vitals_baselines())
+    start_background_task(enforce_vitals_retention())
+    start_background_task(refresh_triage_queue())
+
+@app.on_event("shutdown")
+async def stop_sync_scheduler():
+    await sync_scheduler.stop()
+    await lease_manager.close()
+    sharded_runner.shutdown()
+    parallel_parser.shutdown()
+    upload_store.shutdown()
+    try:
+        await db_mapper.save_vitals_baselines()
+    except Exception as e:
+        logger.error(f"Persisting vitals baselines failed: {e}")
+    await db_mapper.close()
+
 @app.get("/")
 async def root():
     return {
@@ -474,40 +504,63 @@ async def verify_consent(patient_id: str, consent_type: str, current_user: Token
         logger.error(f"Consent verification error: {e}")
         raise HTTPException(status_code=500, detail="Failed to verify consent")
 
-@app.post("/sync/vitals")
-async def sync_vitals(sync_request: SyncRequest, current_user: TokenData = Depends(get_current_user)):
-    """Sync vital signs from HMS to Erlessed database"""
+async def authorize_sync_request(sync_request: SyncRequest) -> BaseHMSClient:
+    """Check patient consent and return an authenticated HMS client"""
+    if sync_request.patient_ids:
+        for patient_id in sync_request.patient_ids:
+            if not await verify_patient_consent(patient_id, "data_sync"):
+                raise HTTPException(
+                    status_code=403,
+                    detail=f"Patient {patient_id} has not granted consent for data synchronization"
+                )
+    
+    hms_client = create_hms_client(sync_request.hms_credentials)
+    auth_success = await hms_client.authenticate()
+    
+    if not auth_success:
+        raise HTTPException(status_code=401, detail="HMS authentication failed")
+    
+    return hms_client
+
+async def run_sync_request(sync_request: SyncRequest, data_types: List[str]) -> Dict[str, int]:
+    """Run the sync pipeline for each data type and return records stored per type
+    
+    Every data type's lease is taken before any work starts and held until
+    the last one is done.
+    """
+    hms_client = await authorize_sync_request(sync_request)
+    facility_key = lease_facility_key(sync_request.hms_credentials)
+    current_facility.set(sync_scheduler.facility_for(sync_request.hms_credentials))
+    
+    sync_results = {}
+    async with lease_manager.lease_set(facility_key) as leases:
+        for data_type in data_types:
+            if not await leases.hold(data_type):
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"A {data_type} sync for {facility_key} is already running on another replica"
+                )
+        for data_type in data_types:
+            stats = await run_sync_pipeline(
+                hms_client,
+                SYNC_DATA_TYPES[data_type],
+                sync_request.patient_ids,
+                sync_request.date_from,
+                sync_request.date_to
+            )
+            sync_results[data_type] = stats.get("write")
+    return sync_results
+
+async def sync_single_data_type(sync_request: SyncRequest, data_type: str) -> Dict[str, Any]:
+    """Sync one data type and build the endpoint response"""
+    label = data_type.replace("_", " ").capitalize()
     try:
-        # Verify patient consent
-        if sync_request.patient_ids:
-            for patient_id in sync_request.patient_ids:
-                if not await verify_patient_consent(patient_id, "data_sync"):
-                    raise HTTPException(
-                        status_code=403,
-                        detail=f"Patient {patient_id} has not granted consent for data synchronization"
-                    )
-        
-        # Create HMS client and authenticate
-        hms_client = create_hms_client(sync_request.hms_credentials)
-        auth_success = await hms_client.authenticate()
-        
-        if not auth_success:
-            raise HTTPException(status_code=401, detail="HMS authentication failed")
-        
-        # Fetch vital signs
-        vitals = await hms_client.get_vitals(
-            sync_request.patient_ids or [],
-            sync_request.date_from,
-            sync_request.date_to
-        )
-        
-        # Store in Erlessed database
-        await store_vitals(vitals)
+        sync_results = await run_sync_request(sync_request, [data_type])
         
         return {
             "status": "success",
-            "records_synced": len(vitals),
-            "sync_type": "vitals",
+            "records_synced": sync_results[data_type],
+            "sync_type": data_type,
             "timestamp": datetime.utcnow().isoformat(),
             "hms_system": sync_request.hms_credentials.system_type
         }
@@ -515,211 +568,38 @@ async def sync_vitals(sync_request: SyncRequest, current_user: TokenData = Depen
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Vitals sync error: {e}")
-        raise HTTPException(status_code=500, detail=f"Vitals synchronization failed: {str(e)}")
+        logger.error(f"{label} sync error: {e}")
+        raise HTTPException(status_code=500, detail=f"{label} synchronization failed: {str(e)}")
+
+@app.post("/sync/vitals")
+async def sync_vitals(sync_request: SyncRequest, current_user: TokenData = Depends(get_current_user)):
+    """Sync vital signs from HMS to Erlessed database"""
+    return await sync_single_data_type(sync_request, "vitals")
 
 @app.post("/sync/labs")
 async def sync_lab_results(sync_request: SyncRequest, current_user: TokenData = Depends(get_current_user)):
     """Sync lab results from HMS to Erlessed database"""
-    try:
-        # Verify patient consent
-        if sync_request.patient_ids:
-            for patient_id in sync_request.patient_ids:
-                if not await verify_patient_consent(patient_id, "data_sync"):
-                    raise HTTPException(
-                        status_code=403,
-                        detail=f"Patient {patient_id} has not granted consent for data synchronization"
-                    )
-        
-        # Create HMS client and authenticate
-        hms_client = create_hms_client(sync_request.hms_credentials)
-        auth_success = await hms_client.authenticate()
-        
-        if not auth_success:
-            raise HTTPException(status_code=401, detail="HMS authentication failed")
-        
-        # Fetch lab results
-        lab_results = await hms_client.get_lab_results(
-            sync_request.patient_ids or [],
-            sync_request.date_from,
-            sync_request.date_to
-        )
-        
-        # Store in Erlessed database
-        await store_lab_results(lab_results)
-        
-        return {
-            "status": "success",
-            "records_synced": len(lab_results),
-            "sync_type": "lab_results",
-            "timestamp": datetime.utcnow().isoformat(),
-            "hms_system": sync_request.hms_credentials.system_type
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Lab results sync error: {e}")
-        raise HTTPException(status_code=500, detail=f"Lab results synchronization failed: {str(e)}")
+    return await sync_single_data_type(sync_request, "lab_results")
 
 @app.post("/sync/prescriptions")
 async def sync_prescriptions(sync_request: SyncRequest, current_user: TokenData = Depends(get_current_user)):
     """Sync prescriptions from HMS to Erlessed database"""
-    try:
-        # Verify patient consent
-        if sync_request.patient_ids:
-            for patient_id in sync_request.patient_ids:
-                if not await verify_patient_consent(patient_id, "data_sync"):
-                    raise HTTPException(
-                        status_code=403,
-                        detail=f"Patient {patient_id} has not granted consent for data synchronization"
-                    )
-        
-        # Create HMS client and authenticate
-        hms_client = create_hms_client(sync_request.hms_credentials)
-        auth_success = await hms_client.authenticate()
-        
-        if not auth_success:
-            raise HTTPException(status_code=401, detail="HMS authentication failed")
-        
-        # Fetch prescriptions
-        prescriptions = await hms_client.get_prescriptions(
-            sync_request.patient_ids or [],
-            sync_request.date_from,
-            sync_request.date_to
-        )
-        
-        # Store in Erlessed database
-        await store_prescriptions(prescriptions)
-        
-        return {
-            "status": "success",
-            "records_synced": len(prescriptions),
-            "sync_type": "prescriptions",
-            "timestamp": datetime.utcnow().isoformat(),
-            "hms_system": sync_request.hms_credentials.system_type
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Prescriptions sync error: {e}")
-        raise HTTPException(status_code=500, detail=f"Prescriptions synchronization failed: {str(e)}")
+    return await sync_single_data_type(sync_request, "prescriptions")
 
 @app.post("/sync/diagnoses")
 async def sync_diagnoses(sync_request: SyncRequest, current_user: TokenData = Depends(get_current_user)):
     """Sync diagnoses from HMS to Erlessed database"""
-    try:
-        # Verify patient consent
-        if sync_request.patient_ids:
-            for patient_id in sync_request.patient_ids:
-                if not await verify_patient_consent(patient_id, "data_sync"):
-                    raise HTTPException(
-                        status_code=403,
-                        detail=f"Patient {patient_id} has not granted consent for data synchronization"
-                    )
-        
-        # Create HMS client and authenticate
-        hms_client = create_hms_client(sync_request.hms_credentials)
-        auth_success = await hms_client.authenticate()
-        
-        if not auth_success:
-            raise HTTPException(status_code=401, detail="HMS authentication failed")
-        
-        # Fetch diagnoses
-        diagnoses = await hms_client.get_diagnoses(
-            sync_request.patient_ids or [],
-            sync_request.date_from,
-            sync_request.date_to
-        )
-        
-        # Store in Erlessed database
-        await store_diagnoses(diagnoses)
-        
-        return {
-            "status": "success",
-            "records_synced": len(diagnoses),
-            "sync_type": "diagnoses",
-            "timestamp": datetime.utcnow().isoformat(),
-            "hms_system": sync_request.hms_credentials.system_type
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Diagnoses sync error: {e}")
-        raise HTTPException(status_code=500, detail=f"Diagnoses synchronization failed: {str(e)}")
+    return await sync_single_data_type(sync_request, "diagnoses")
 
 @app.post("/sync/bulk")
 async def bulk_sync(sync_request: SyncRequest, current_user: TokenData = Depends(get_current_user)):
     """Perform bulk synchronization of all data types"""
     try:
-        # Verify patient consent
-        if sync_request.patient_ids:
-            for patient_id in sync_request.patient_ids:
-                if not await verify_patient_consent(patient_id, "data_sync"):
-                    raise HTTPException(
-                        status_code=403,
-                        detail=f"Patient {patient_id} has not granted consent for data synchronization"
-                    )
-        
-        # Create HMS client and authenticate
-        hms_client = create_hms_client(sync_request.hms_credentials)
-        auth_success = await hms_client.authenticate()
-        
-        if not auth_success:
-            raise HTTPException(status_code=401, detail="HMS authentication failed")
-        
-        sync_results = {}
-        total_records = 0
-        
-        # Sync vitals if requested
-        if sync_request.include_vitals:
-            vitals = await hms_client.get_vitals(
-                sync_request.patient_ids or [],
-                sync_request.date_from,
-                sync_request.date_to
-            )
-            await store_vitals(vitals)
-            sync_results["vitals"] = len(vitals)
-            total_records += len(vitals)
-        
-        # Sync lab results if requested
-        if sync_request.include_labs:
-            lab_results = await hms_client.get_lab_results(
-                sync_request.patient_ids or [],
-                sync_request.date_from,
-                sync_request.date_to
-            )
-            await store_lab_results(lab_results)
-            sync_results["lab_results"] = len(lab_results)
-            total_records += len(lab_results)
-        
-        # Sync prescriptions if requested
-        if sync_request.include_prescriptions:
-            prescriptions = await hms_client.get_prescriptions(
-                sync_request.patient_ids or [],
-                sync_request.date_from,
-                sync_request.date_to
-            )
-            await store_prescriptions(prescriptions)
-            sync_results["prescriptions"] = len(prescriptions)
-            total_records += len(prescriptions)
-        
-        # Sync diagnoses if requested
-        if sync_request.include_diagnoses:
-            diagnoses = await hms_client.get_diagnoses(
-                sync_request.patient_ids or [],
-                sync_request.date_from,
-                sync_request.date_to
-            )
-            await store_diagnoses(diagnoses)
-            sync_results["diagnoses"] = len(diagnoses)
-            total_records += len(diagnoses)
+        sync_results = await run_sync_request(sync_request, requested_data_types(sync_request))
         
         return {
             "status": "success",
-            "total_records_synced": total_records,
+            "total_records_synced": sum(sync_results.values()),
             "sync_breakdown": sync_results,
             "sync_type": "bulk",
             "timestamp": datetime.utcnow().isoformat(),
@@ -732,105 +612,390 @@ async def bulk_sync(sync_request: SyncRequest, current_user: TokenData = Depends
         logger.error(f"Bulk sync error: {e}")
         raise HTTPException(status_code=500, detail=f"Bulk synchronization failed: {str(e)}")
 
+@app.post("/sync/sharded")
+async def sharded_sync(sync_request: SyncRequest, shards: Optional[int] = None,
+                       current_user: TokenData = Depends(get_current_user)):
+    """Start a bulk sync partitioned by patient ID hash across worker processes"""
+    if not sync_request.patient_ids:
+        raise HTTPException(status_code=400, detail="Sharded sync requires patient_ids")
+    if shards is not None and shards < 1:
+        raise HTTPException(status_code=400, detail="shards must be at least 1")
+    
+    # Fail fast on consent and credentials before spawning shard workers
+    await authorize_sync_request(sync_request)
+    
+    data_types = requested_data_types(sync_request)
+    partitions = partition_patients(sync_request.patient_ids, shards or sharded_runner.processes)
+    job = SyncJob(
+        sync_scheduler.facility_for(sync_request.hms_credentials),
+        sync_request.patient_ids,
+        sync_request.date_from,
+        sync_request.date_to,
+        slice_size=len(sync_request.patient_ids),
+        priority=PRIORITY_ON_DEMAND,
+        data_types=data_types,
+        slices=partitions
+    )
+    sync_scheduler.track_job(job)
+    start_background_task(run_sharded_job(job, sync_request, data_types, partitions))
+    return job.to_dict()
+
 # File-based sync endpoints for CSV/XML fallback
-@app.post("/sync/file/vitals")
-async def sync_vitals_from_file(
-    file: UploadFile = File(...),
-    current_user: TokenData = Depends(get_current_user)
-):
-    """Sync vital signs from uploaded CSV/XML file"""
+async def ingest_file(fileobj, filename: str, data_type: str, size: int = 0, executor=None):
+    """Stream a CSV/XML file through convert, transform and write
+    
+    Parquet and Arrow IPC files are read column-wise and bulk-written with COPY.
+    CSV and XML may be gzip or zstd compressed (.gz/.zst) and are inflated as they are parsed,
+    in threads of executor (default: the loop's default executor).
+    Large uncompressed CSVs are parsed in byte ranges across worker processes.
+    Rows already recorded in the ingest ledger with the same content are skipped.
+    """
+    filename, encoding = split_compression(filename.lower())
+    if filename.endswith('.csv') and not encoding and SYNC_DATA_TYPES[data_type].copy \
+            and size >= PARALLEL_PARSE_MIN_BYTES:
+        return await ingest_csv_in_processes(fileobj, data_type)
+    if filename.endswith('.csv'):
+        return await ingest_batches(iter_csv_batches(open_decompressed(fileobj, encoding), executor=executor),
+                                    SYNC_DATA_TYPES[data_type], ingest_ledger)
+    if filename.endswith('.xml'):
+        return await ingest_batches(iter_xml_batches(open_decompressed(fileobj, encoding), executor=executor),
+                                    SYNC_DATA_TYPES[data_type], ingest_ledger)
+    if filename.endswith(COLUMNAR_FILE_EXTENSIONS):
+        if encoding:
+            raise HTTPException(status_code=400, detail="Parquet and Arrow files are compressed internally; upload them without gzip/zstd")
+        return await ingest_record_batches(iter_arrow_batches(fileobj, data_type), SYNC_DATA_TYPES[data_type],
+                                           ingest_ledger)
+    raise HTTPException(status_code=400, detail="Unsupported file format. Use CSV, XML, Parquet or Arrow")
+
+async def sync_from_file(file: UploadFile, data_type: str, sync_type: str,
+                         facility_id: Optional[str] = None) -> Dict[str, Any]:
+    """Ingest an uploaded file and report record counts; a file already ingested is rejected"""
+    label = sync_type.replace("_", " ")
+    current_facility.set(facility_id)
     try:
-        file_content = await file.read()
-        
-        if file.filename.endswith('.csv'):
-            data = await process_csv_file(file_content, "vitals")
-        elif file.filename.endswith('.xml'):
-            data = await process_xml_file(file_content, "vitals")
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported file format. Use CSV or XML")
-        
-        # Convert to VitalSigns objects and store
-        vitals = []
-        for record in data:
-            try:
-                vital = VitalSigns(
-                    patient_id=record.get("patient_id", ""),
-                    timestamp=datetime.fromisoformat(record.get("timestamp", datetime.utcnow().isoformat())),
-                    systolic_bp=float(record.get("systolic_bp", 0)) if record.get("systolic_bp") else None,
-                    diastolic_bp=float(record.get("diastolic_bp", 0)) if record.get("diastolic_bp") else None,
-                    heart_rate=float(record.get("heart_rate", 0)) if record.get("heart_rate") else None,
-                    temperature=float(record.get("temperature", 0)) if record.get("temperature") else None,
-                    # Add other fields as needed
-                )
-                vitals.append(vital)
-            except Exception as e:
-                logger.warning(f"Skipping invalid vital record: {e}")
+        digest = await asyncio.to_thread(file_digest, file.file)
+        if not await ingest_ledger.claim_file(data_type, digest, file.filename):
+            raise HTTPException(status_code=409, detail=f"{file.filename} was already ingested (sha256 {digest})")
         
-        await store_vitals(vitals)
+        try:
+            stats = await ingest_file(file.file, file.filename, data_type, file.size or 0)
+        except BaseException:
+            await ingest_ledger.release_file(data_type, digest)
+            raise
+        await ingest_ledger.record_file(data_type, digest, file.filename, stats.get("read"))
         
         return {
             "status": "success",
-            "records_processed": len(data),
-            "records_stored": len(vitals),
-            "sync_type": "file_vitals",
+            "records_processed": stats.get("read"),
+            "records_stored": stats.get("write"),
+            "records_rejected": stats.rejected,
+            "records_new": stats.get("new"),
+            "records_changed": stats.get("changed"),
+            "records_skipped": stats.get("skipped"),
+            "sync_type": sync_type,
             "filename": file.filename,
+            "sha256": digest,
             "timestamp": datetime.utcnow().isoformat()
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"File vitals sync error: {e}")
-        raise HTTPException(status_code=500, detail=f"File vitals sync failed: {str(e)}")
+        logger.error(f"{label.capitalize()} sync error: {e}")
+        raise HTTPException(status_code=500, detail=f"{label.capitalize()} sync failed: {str(e)}")
+
+@app.post("/sync/file/vitals")
+async def sync_vitals_from_file(
+    file: UploadFile = File(...),
+    facility_id: Optional[str] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
+    """Sync vital signs from uploaded CSV/XML/Parquet/Arrow file"""
+    return await sync_from_file(file, "vitals", "file_vitals", facility_id)
 
 @app.post("/sync/file/labs")
 async def sync_labs_from_file(
     file: UploadFile = File(...),
+    facility_id: Optional[str] = None,
     current_user: TokenData = Depends(get_current_user)
 ):
-    """Sync lab results from uploaded CSV/XML file"""
+    """Sync lab results from uploaded CSV/XML/Parquet/Arrow file"""
+    return await sync_from_file(file, "lab_results", "file_labs", facility_id)
+
+@app.post("/sync/file/prescriptions")
+async def sync_prescriptions_from_file(
+    file: UploadFile = File(...),
+    facility_id: Optional[str] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
+    """Sync prescriptions from uploaded CSV/XML/Parquet/Arrow file"""
+    return await sync_from_file(file, "prescriptions", "file_prescriptions", facility_id)
+
+@app.post("/sync/file/diagnoses")
+async def sync_diagnoses_from_file(
+    file: UploadFile = File(...),
+    facility_id: Optional[str] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
+    """Sync diagnoses from uploaded CSV/XML/Parquet/Arrow file"""
+    return await sync_from_file(file, "diagnoses", "file_diagnoses", facility_id)
+
+@app.post("/sync/file/uploads")
+async def init_resumable_upload(upload: ResumableUploadInit, current_user: TokenData = Depends(get_current_user)):
+    """Open a resumable upload; ingest starts as soon as the first contiguous chunk arrives"""
+    if upload.data_type not in FILE_SYNC_TYPES:
+        raise HTTPException(status_code=400, detail=f"File sync is not supported for {upload.data_type}")
+    if not split_compression(upload.filename.lower())[0].endswith(SUPPORTED_FILE_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="Unsupported file format. Use CSV, XML, Parquet or Arrow")
+    if upload.total_size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {UPLOAD_MAX_BYTES} bytes")
+    claimed_digest = upload.sha256.lower() if upload.sha256 else None
+    if claimed_digest and not await ingest_ledger.claim_file(upload.data_type, claimed_digest, upload.filename):
+        raise HTTPException(status_code=409, detail=f"{upload.filename} was already ingested (sha256 {upload.sha256})")
+    
     try:
-        file_content = await file.read()
-        
-        if file.filename.endswith('.csv'):
-            data = await process_csv_file(file_content, "labs")
-        elif file.filename.endswith('.xml'):
-            data = await process_xml_file(file_content, "labs")
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported file format. Use CSV or XML")
-        
-        # Convert to LabResult objects and store
-        lab_results = []
-        for record in data:
-            try:
-                lab_result = LabResult(
-                    patient_id=record.get("patient_id", ""),
-                    test_name=record.get("test_name", ""),
-                    ordered_date=datetime.fromisoformat(record.get("ordered_date", datetime.utcnow().isoformat())),
-                    result_value=record.get("result_value"),
-                    result_numeric=float(record.get("result_numeric", 0)) if record.get("result_numeric") else None,
-                    # Add other fields as needed
-                )
-                lab_results.append(lab_result)
-            except Exception as e:
-                logger.warning(f"Skipping invalid lab record: {e}")
-        
-        await store_lab_results(lab_results)
-        
+        session = upload_store.create(upload.data_type, upload.filename, upload.total_size)
+    except BaseException as e:
+        if claimed_digest:
+            await ingest_ledger.release_file(upload.data_type, claimed_digest)
+        if isinstance(e, UploadLimitReached):
+            raise HTTPException(status_code=503, detail=str(e))
+        raise
+    job = SyncJob(
+        f"upload:{upload.filename}",
+        None,
+        None,
+        None,
+        slice_size=1,
+        priority=PRIORITY_ON_DEMAND,
+        data_types=[upload.data_type]
+    )
+    session.job_id = job.job_id
+    sync_scheduler.track_job(job)
+    start_background_task(run_upload_ingest(session, job, claimed_digest, upload.facility_id))
+    return {
+        **session.to_dict(),
+        "chunk_max_bytes": UPLOAD_CHUNK_MAX_BYTES
+    }
+
+@app.put("/sync/file/uploads/{upload_id}")
+async def put_upload_chunk(upload_id: str, offset: int, request: Request,
+                           current_user: TokenData = Depends(get_current_user)):
+    """Write one chunk of a resumable upload at its byte offset; resending a chunk is harmless"""
+    session = get_upload_session(upload_id)
+    if session.aborted:
+        raise HTTPException(status_code=409, detail=f"Upload aborted: {session.aborted}")
+    
+    chunk = bytearray()
+    async for part in request.stream():
+        chunk += part
+        if len(chunk) > UPLOAD_CHUNK_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Chunks are limited to {UPLOAD_CHUNK_MAX_BYTES} bytes")
+    
+    try:
+        contiguous = await asyncio.to_thread(session.write_chunk, offset, chunk)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except UploadAborted as e:
+        raise HTTPException(status_code=409, detail=f"Upload aborted: {e}")
+    return {
+        "upload_id": upload_id,
+        "offset": offset,
+        "chunk_bytes": len(chunk),
+        "contiguous_bytes": contiguous,
+        "missing_ranges": [list(r) for r in session.missing_ranges()]
+    }
+
+@app.get("/sync/file/uploads/{upload_id}")
+async def get_resumable_upload(upload_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Get received and missing byte ranges so a client can resume an upload"""
+    return get_upload_session(upload_id).to_dict()
+
+@app.post("/sync/file/uploads/{upload_id}/finalize")
+async def finalize_resumable_upload(upload_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Commit a fully received upload and return the sync job processing it"""
+    session = get_upload_session(upload_id)
+    job = sync_scheduler.get_job(session.job_id)
+    if job is None:
+        # The job has been pruned, so the upload's ingest is long over
+        upload_store.discard(session)
+        raise HTTPException(status_code=409, detail=f"Sync job of upload {upload_id} no longer exists")
+    if session.aborted:
+        upload_store.discard(session)
+        raise HTTPException(status_code=409, detail=f"Upload aborted: {session.aborted}")
+    try:
+        session.finalize()
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return job.to_dict()
+
+@app.delete("/sync/file/uploads/{upload_id}")
+async def cancel_resumable_upload(upload_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Cancel an upload and stop its ingest"""
+    session = get_upload_session(upload_id)
+    session.abort("cancelled by client")
+    upload_store.discard(session)
+    return {"status": "success", "upload_id": upload_id}
+
+@app.post("/ingest/{data_type}")
+async def ingest_pushed_records(
+    data_type: str,
+    request: Request,
+    facility_id: Optional[str] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
+    """Ingest records pushed by an HMS as a streamed NDJSON body, one JSON object per line"""
+    if data_type not in SYNC_DATA_TYPES:
+        raise HTTPException(status_code=404, detail=f"Unknown data type {data_type}")
+    check_ndjson_content_type(request.headers.get("content-type", ""))
+    current_facility.set(facility_id)
+    
+    try:
+        stats = await ingest_ndjson(request.stream(), SYNC_DATA_TYPES[data_type])
         return {
             "status": "success",
-            "records_processed": len(data),
-            "records_stored": len(lab_results),
-            "sync_type": "file_labs",
-            "filename": file.filename,
+            "data_type": data_type,
+            "records_received": stats.get("read"),
+            "records_accepted": stats.get("validate"),
+            "records_rejected": stats.rejected,
+            "records_stored": stats.get("write"),
             "timestamp": datetime.utcnow().isoformat()
         }
-        
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"File labs sync error: {e}")
-        raise HTTPException(status_code=500, detail=f"File labs sync failed: {str(e)}")
+        logger.error(f"Push ingest error for {data_type}: {e}")
+        raise HTTPException(status_code=500, detail=f"Push ingest failed: {str(e)}")
+
+@app.get("/converters")
+async def get_converters(current_user: TokenData = Depends(get_current_user)):
+    """List site column mappings and the converters compiled for headers seen so far"""
+    return converter_registry.status()
+
+@app.get("/triage/rules")
+async def get_triage_rules(current_user: TokenData = Depends(get_current_user)):
+    """Triage rules in effect, per facility and age band"""
+    return triage_engine.status()
+
+@app.get("/triage/queue")
+async def get_triage_queue(facility: Optional[str] = None, limit: int = 100,
+                           current_user: TokenData = Depends(get_current_user)):
+    """Queued patients for a facility, most urgent first, then by arrival"""
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    return {
+        "facility": facility or "default",
+        **triage_queue.status(),
+        "patients": triage_queue.ordered(facility, limit)
+    }
+
+@app.delete("/triage/queue/{patient_id}")
+async def remove_from_triage_queue(patient_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Take an HMS patient off the triage queue, e.g. once they have been seen"""
+    try:
+        removed = await db_mapper.dequeue_patient(patient_id)
+    except Exception as e:
+        logger.error(f"Triage queue removal error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to remove patient from the triage queue")
+    if not removed:
+        raise HTTPException(status_code=404, detail=f"Patient {patient_id} is not queued")
+    return {"status": "success", "patient_id": patient_id}
+
+@app.get("/triage/news2/{patient_id}")
+async def get_news2_score(patient_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Latest streaming NEWS2 score for an HMS patient seen by this replica"""
+    score = news2_tracker.latest(patient_id)
+    if score is None:
+        raise HTTPException(status_code=404, detail=f"No NEWS2 score for patient {patient_id}")
+    return {"patient_id": patient_id, "news2": score}
+
+@app.get("/patients/{patient_id}/vitals/history")
+async def get_vitals_history(patient_id: str, resolution: str = "hour", date_from: Optional[datetime] = None,
+                             date_to: Optional[datetime] = None,
+                             current_user: TokenData = Depends(get_current_user)):
+    """Vitals trend for an HMS patient: raw readings or hourly/daily rollups (default: the last 7 days)"""
+    if resolution not in ("raw", "hour", "day"):
+        raise HTTPException(status_code=400, detail="resolution must be one of raw, hour, day")
+    until = date_to or datetime.utcnow()
+    since = date_from or until - timedelta(days=7)
+    try:
+        history = await db_mapper.get_vitals_history(patient_id, resolution, since, until)
+    except Exception as e:
+        logger.error(f"Vitals history query error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to load vitals history")
+    if history is None:
+        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
+    return {
+        "patient_id": patient_id,
+        "resolution": resolution,
+        "date_from": since.isoformat(),
+        "date_to": until.isoformat(),
+        "points": history
+    }
+
+@app.get("/triage/baselines/{patient_id}")
+async def get_vitals_baseline(patient_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Rolling per-vital baseline used to flag anomalous readings for an HMS patient"""
+    baselines = vitals_baselines.describe(patient_id)
+    if baselines is None:
+        raise HTTPException(status_code=404, detail=f"No vitals baseline loaded for patient {patient_id}")
+    return {"patient_id": patient_id, "baselines": baselines}
+
+# Scheduler endpoints for periodic per-facility sync
+@app.post("/scheduler/facilities")
+async def register_facility_schedule(schedule: FacilitySchedule, current_user: TokenData = Depends(get_current_user)):
+    """Register a facility for periodic incremental sync"""
+    state = sync_scheduler.register_facility(schedule)
+    return {
+        "status": "success",
+        "facility": state.to_dict(),
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+@app.delete("/scheduler/facilities/{facility_id}")
+async def unregister_facility_schedule(facility_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Stop periodic sync for a facility"""
+    if not sync_scheduler.unregister_facility(facility_id):
+        raise HTTPException(status_code=404, detail=f"Facility {facility_id} is not scheduled")
+    return {"status": "success", "facility_id": facility_id}
+
+@app.post("/scheduler/facilities/{facility_id}/run")
+async def run_facility_schedule(facility_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Queue an immediate incremental sync for a scheduled facility"""
+    try:
+        job = sync_scheduler.trigger(facility_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Facility {facility_id} is not scheduled")
+    return job.to_dict()
+
+@app.post("/scheduler/facilities/{facility_id}/backfill")
+async def backfill_facility_schedule(facility_id: str, backfill: BackfillRequest,
+                                     current_user: TokenData = Depends(get_current_user)):
+    """Queue a low-priority historical backfill for a scheduled facility"""
+    try:
+        job = sync_scheduler.enqueue_backfill(facility_id, backfill.date_from, backfill.date_to, backfill.data_types)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Facility {facility_id} is not scheduled")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return job.to_dict()
+
+@app.get("/scheduler/status")
+async def get_scheduler_status(current_user: TokenData = Depends(get_current_user)):
+    """Get scheduler state for all registered facilities"""
+    return {
+        **sync_scheduler.status(),
+        "replica_id": REPLICA_ID,
+        "held_leases": lease_manager.held()
+    }
+
+@app.get("/sync/jobs/{job_id}")
+async def get_sync_job(job_id: str, current_user: TokenData = Depends(get_current_user)):
+    """Get progress and results of a sync job"""
+    job = sync_scheduler.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Sync job {job_id} not found")
+    return job.to_dict()
 
 @app.get("/sync/status")
 async def get_sync_status(current_user: TokenData = Depends(get_current_user)):
@@ -851,8 +1016,21 @@ async def get_sync_status(current_user: TokenData = Depends(get_current_user)):
             ],
             "file_endpoints": [
                 "/sync/file/vitals",
-                "/sync/file/labs"
+                "/sync/file/labs",
+                "/sync/file/prescriptions",
+                "/sync/file/diagnoses"
+            ],
+            "resumable_upload_endpoints": [
+                "POST /sync/file/uploads",
+                "PUT /sync/file/uploads/{upload_id}",
+                "GET /sync/file/uploads/{upload_id}",
+                "POST /sync/file/uploads/{upload_id}/finalize",
+                "DELETE /sync/file/uploads/{upload_id}"
             ],
+            "scheduler": {
+                "running": sync_scheduler.running,
+                "scheduled_facilities": len(sync_scheduler.facilities)
+            },
             "consent_required": True,
             "authentication": "Bearer token required"
         }
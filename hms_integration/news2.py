@@ -0,0 +1,182 @@
+"""
+NEWS2 early-warning scores for synced vitals
+Scores whole batches with NumPy and, in streaming mode, carries each
+patient's latest readings forward so partial observations still score
+"""
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Readings older than this are not carried into a patient's next score; 0 scores each reading alone
+NEWS2_CARRY_MINUTES = float(os.getenv("HMS_NEWS2_CARRY_MINUTES", "240"))
+
+# Upper bounds (inclusive) of each band and the points for each band, one more than the bounds.
+# Supplemental oxygen and consciousness are not in HMS vitals, so every patient
+# is scored as on air and alert, and SpO2 uses scale 1.
+NEWS2_BANDS = {
+    "respiratory_rate": ([8, 11, 20, 24], [3, 1, 0, 2, 3]),
+    "oxygen_saturation": ([91, 93, 95], [3, 2, 1, 0]),
+    "systolic_bp": ([90, 100, 110, 219], [3, 2, 1, 0, 3]),
+    "heart_rate": ([40, 50, 90, 110, 130], [3, 1, 0, 1, 2, 3]),
+    "temperature": ([35.0, 36.0, 38.0, 39.0], [3, 1, 0, 1, 2]),
+}
+NEWS2_VITALS = list(NEWS2_BANDS)
+
+
+def _readings(frame: pd.DataFrame) -> np.ndarray:
+    """NEWS2 vitals as a float matrix; missing and zero readings become NaN"""
+    values = frame.reindex(columns=NEWS2_VITALS).to_numpy(dtype=float, na_value=np.nan)
+    values[values == 0] = np.nan
+    return values
+
+
+def _score(values: np.ndarray) -> pd.DataFrame:
+    """Aggregate score, clinical risk and number of parameters scored per row"""
+    points = np.zeros(values.shape, dtype=np.int8)
+    for column, name in enumerate(NEWS2_VITALS):
+        bounds, band_points = NEWS2_BANDS[name]
+        bands = np.searchsorted(np.asarray(bounds, dtype=float), values[:, column], side="left")
+        points[:, column] = np.asarray(band_points, dtype=np.int8)[np.minimum(bands, len(bounds))]
+    scored = ~np.isnan(values)
+    points[~scored] = 0
+
+    total = points.sum(axis=1, dtype=np.int64)
+    parameters = scored.sum(axis=1)
+    red_score = (points == 3).any(axis=1)
+    risk = np.select([total >= 7, total >= 5, red_score], ["high", "medium", "low_medium"], "low").astype(object)
+    # Nothing to score: no total and no risk rather than a reassuring 0
+    unscored = parameters == 0
+    risk[unscored] = None
+    return pd.DataFrame({
+        "news2_score": pd.arrays.IntegerArray(total, unscored),
+        "news2_risk": risk,
+        "news2_parameters": parameters
+    })
+
+
+def score_news2(readings: pd.DataFrame) -> pd.DataFrame:
+    """Batch NEWS2 over a frame of vital columns, each row scored on its own readings"""
+    return _score(_readings(readings)).set_axis(readings.index)
+
+
+def news2_payload(score: Optional[int], risk: Optional[str], parameters: int) -> Dict[str, Any]:
+    """NEWS2 entry stored in triage_data"""
+    return {
+        "score": None if pd.isna(score) else int(score),
+        "risk": risk,
+        "parameters": int(parameters)
+    }
+
+
+class News2Tracker:
+    """Latest NEWS2 readings per patient, carried into scores of later partial observations
+
+    A batch is scored in one vectorized pass: each patient's stored
+    readings are prepended, readings are forward-filled per patient in time
+    order, and values older than the carry window are dropped before
+    scoring. score() leaves the state alone and returns each patient's
+    newest values; commit() applies them for the patients whose readings
+    were stored. State untouched for the carry window is dropped, since it
+    could no longer be carried into a reading arriving now.
+    """
+
+    def __init__(self, carry_minutes: float = NEWS2_CARRY_MINUTES):
+        self.carry_seconds = carry_minutes * 60
+        # patient_id -> (values, seconds each value was recorded, latest score row, newest reading
+        # in seconds, monotonic time of the update), least recently updated first
+        self._state: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    def score(self, readings: pd.DataFrame, patient_ids: List[str],
+              recorded_at: List[datetime]) -> Tuple[pd.DataFrame, Dict[str, tuple]]:
+        """NEWS2 per row of readings, in the order given, and the pending state for commit()"""
+        values = _readings(readings)
+        if self.carry_seconds <= 0 or not len(values):
+            return _score(values), {}
+
+        seconds = pd.to_datetime(pd.Series(recorded_at)).to_numpy(dtype="datetime64[ns]").astype(np.int64) / 1e9
+        batch_patients = pd.unique(np.asarray(patient_ids, dtype=object))
+        known = [patient_id for patient_id in batch_patients if patient_id in self._state]
+
+        value_columns = [f"v_{name}" for name in NEWS2_VITALS]
+        time_columns = [f"t_{name}" for name in NEWS2_VITALS]
+        batch = pd.DataFrame(values, columns=value_columns)
+        batch[time_columns] = np.where(np.isnan(values), np.nan, seconds[:, None])
+        batch["patient_id"] = list(patient_ids)
+        batch["seconds"] = seconds
+        batch["position"] = np.arange(len(values))
+        if known:
+            seed = pd.DataFrame(np.array([self._state[patient_id][0] for patient_id in known]), columns=value_columns)
+            seed[time_columns] = np.array([self._state[patient_id][1] for patient_id in known])
+            seed["patient_id"] = known
+            seed["seconds"] = [self._state[patient_id][3] for patient_id in known]
+            seed["position"] = -1
+            batch = pd.concat([seed, batch], ignore_index=True)
+
+        batch = batch.sort_values(["patient_id", "seconds", "position"], kind="stable")
+        filled = batch.groupby("patient_id", sort=False)[value_columns + time_columns].ffill()
+        carried = filled[value_columns].to_numpy()
+        age = batch["seconds"].to_numpy()[:, None] - filled[time_columns].to_numpy()
+        carried[age > self.carry_seconds] = np.nan
+
+        scores = _score(carried)
+        is_reading = (batch["position"] >= 0).to_numpy()
+        order = batch["position"].to_numpy()[is_reading]
+
+        # Newest row per patient becomes their state once committed
+        last = ~batch["patient_id"].duplicated(keep="last").to_numpy()
+        pending = {
+            patient_id: (row_values, row_times, tuple(score), newest)
+            for patient_id, row_values, row_times, score, newest in zip(
+                batch["patient_id"].to_numpy()[last], filled[value_columns].to_numpy()[last],
+                filled[time_columns].to_numpy()[last], scores[last].itertuples(index=False),
+                batch["seconds"].to_numpy()[last])
+        }
+
+        result = scores[is_reading].set_axis(order)
+        return result.sort_index().reset_index(drop=True), pending
+
+    def commit(self, pending: Dict[str, tuple], patient_ids: List[str]):
+        """Apply score()'s state for patients whose readings were stored
+
+        A patient whose state already reaches as far as the batch (readings
+        at or before the last one seen, e.g. a re-sync) keeps their state.
+        """
+        now = time.monotonic()
+        for patient_id in set(patient_ids):
+            update = pending.get(patient_id)
+            if update is None:
+                continue
+            current = self._state.get(patient_id)
+            if current is not None and current[3] >= update[3]:
+                continue
+            self._state.pop(patient_id, None)
+            self._state[patient_id] = (*update, now)
+        expired = now - self.carry_seconds
+        while self._state and next(iter(self._state.values()))[4] < expired:
+            self._state.popitem(last=False)
+
+    def forget(self, patient_ids: List[str]):
+        """Drop state another process has moved past (e.g. patients synced by shard workers)"""
+        for patient_id in patient_ids:
+            self._state.pop(patient_id, None)
+
+    def latest(self, patient_id: str) -> Optional[Dict[str, Any]]:
+        state = self._state.get(patient_id)
+        if state is None:
+            return None
+        return news2_payload(*state[2])
+
+
+news2_tracker = News2Tracker()
@@ -0,0 +1,204 @@
+"""
+Multi-process parsing of large CSV uploads
+Splits a CSV on disk into line-aligned byte ranges and parses and converts
+each range in a worker process, handing the columns back as Arrow IPC files
+in shared memory
+"""
+
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+from fastapi import HTTPException
+
+from converters import converter_registry
+
+logger = logging.getLogger(__name__)
+
+PARSE_PROCESSES = int(os.getenv("HMS_PARSE_PROCESSES") or os.cpu_count() or 2)
+PARSE_RANGE_BYTES = int(os.getenv("HMS_PARSE_RANGE_BYTES", str(16 * 1024 * 1024)))
+# Uploads smaller than this are parsed in-process; spawning workers would cost more than it saves
+PARALLEL_PARSE_MIN_BYTES = int(os.getenv("HMS_PARALLEL_PARSE_MIN_BYTES", str(64 * 1024 * 1024)))
+UPLOAD_DIR = os.getenv("HMS_UPLOAD_DIR") or tempfile.gettempdir()
+# Converted ranges are passed from workers as Arrow IPC files; on Linux /dev/shm keeps them in memory
+IPC_DIR = os.getenv("HMS_IPC_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else UPLOAD_DIR)
+
+
+def read_csv_header(path: str) -> Tuple[List[str], int]:
+    """Column names and the byte offset where the first data row starts"""
+    with open(path, "rb") as f:
+        header_line = f.readline()
+        data_start = f.tell()
+    columns = list(pd.read_csv(io.BytesIO(header_line), nrows=0).columns)
+    return columns, data_start
+
+
+def csv_byte_ranges(path: str, data_start: int, range_bytes: int = PARSE_RANGE_BYTES) -> List[Tuple[int, int]]:
+    """Split the data section of a CSV into [start, end) ranges that begin and end on line boundaries
+
+    Quoted fields containing newlines are not supported; HMS exports put one record per line.
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    start = data_start
+    with open(path, "rb") as f:
+        while start < size:
+            end = min(start + range_bytes, size)
+            if end < size:
+                # Extend to the end of the line the cut landed in
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_csv_range(path: str, columns: List[str], start: int, end: int,
+                    schema_name: str, ipc_path: str) -> Tuple[int, int]:
+    """Process pool entry point: parse and column-convert one byte range into an Arrow IPC file
+
+    Returns the number of rows read and rejected; the converted columns
+    cross back to the parent through ipc_path, never pickled and never as
+    row objects.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    converter = converter_registry.converter_for(columns, schema_name)
+    if data.strip():
+        frame = pd.read_csv(io.BytesIO(data), header=None, names=columns, dtype=str, keep_default_na=False)
+    else:
+        frame = pd.DataFrame(columns=columns)
+    clean, rejected = converter.convert(frame)
+    write_ipc(clean, ipc_path)
+    return len(frame), rejected
+
+
+def write_ipc(frame: pd.DataFrame, path: str):
+    """Write a converted frame as an Arrow IPC file"""
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def read_ipc(path: str) -> pd.DataFrame:
+    """Memory-map an Arrow IPC file as a frame and remove the file
+
+    The Arrow buffers are read in place from the mapping; only columns
+    pandas cannot hold as views (e.g. strings) are copied. The mapping
+    outlives the unlinked file for as long as the frame references it.
+    """
+    try:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    finally:
+        os.remove(path)
+
+
+def _discard_ipc(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def spool_to_disk(fileobj, directory: str = UPLOAD_DIR) -> str:
+    """Copy an upload to a named file that worker processes can open; the caller removes it"""
+    fileobj.seek(0)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix="hms-upload-", suffix=".csv", delete=False) as target:
+        shutil.copyfileobj(fileobj, target, 1024 * 1024)
+        return target.name
+
+
+class ParallelCsvParser:
+    """Parses byte ranges of a CSV file across a pool of worker processes
+
+    Ranges are submitted a few at a time and their results yielded in file
+    order, so at most two ranges per worker are held in memory and later
+    rows still overwrite earlier ones when written. The event loop only
+    awaits futures while the workers do the parsing.
+    """
+
+    def __init__(self, processes: int = PARSE_PROCESSES, range_bytes: int = PARSE_RANGE_BYTES):
+        self.processes = max(1, processes)
+        self.range_bytes = range_bytes
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _discard_executor(self, executor: ProcessPoolExecutor):
+        """Replace a pool whose worker died; a broken pool rejects every later submit"""
+        if self._executor is executor:
+            logger.error("CSV parse worker process died; starting a new pool for later uploads")
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def iter_frames(self, path: str, schema_name: str) -> AsyncIterator[Tuple[pd.DataFrame, int, int]]:
+        """Yield (converted frame, rows read, rows rejected) per byte range, in file order"""
+        columns, data_start = await asyncio.to_thread(read_csv_header, path)
+        ranges = await asyncio.to_thread(csv_byte_ranges, path, data_start, self.range_bytes)
+        logger.info(f"Parsing {path} in {len(ranges)} ranges across {self.processes} processes")
+
+        executor = self._get_executor()
+        pending = deque()
+        try:
+            for start, end in ranges:
+                ipc_path = os.path.join(IPC_DIR, f"hms-range-{uuid.uuid4()}.arrow")
+                try:
+                    future = executor.submit(parse_csv_range, path, columns, start, end, schema_name, ipc_path)
+                except BrokenProcessPool as e:
+                    self._discard_executor(executor)
+                    raise HTTPException(status_code=503, detail=f"CSV parse workers unavailable, retry the upload: {e}")
+                pending.append((future, ipc_path))
+                if len(pending) >= self.processes * 2:
+                    yield await self._result(executor, *pending.popleft())
+            while pending:
+                yield await self._result(executor, *pending.popleft())
+        finally:
+            # Ranges already running finish on their own; drop their files once written
+            for future, ipc_path in pending:
+                if not future.cancel():
+                    future.add_done_callback(lambda _, ipc_path=ipc_path: _discard_ipc(ipc_path))
+
+    async def _result(self, executor: ProcessPoolExecutor, future: Future,
+                      ipc_path: str) -> Tuple[pd.DataFrame, int, int]:
+        """Frame of one finished range; bad CSV is the client's error, a failed worker is ours"""
+        try:
+            rows, rejected = await asyncio.wrap_future(future)
+            frame = await asyncio.to_thread(read_ipc, ipc_path)
+        except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+            _discard_ipc(ipc_path)
+            logger.error(f"CSV range parsing error: {e}")
+            raise HTTPException(status_code=400, detail=f"Invalid CSV format: {e}")
+        except BrokenProcessPool as e:
+            _discard_ipc(ipc_path)
+            self._discard_executor(executor)
+            raise HTTPException(status_code=503, detail=f"CSV parse worker died, retry the upload: {e}")
+        except Exception as e:
+            _discard_ipc(ipc_path)
+            logger.error(f"CSV range worker error: {e}")
+            raise HTTPException(status_code=500, detail=f"CSV parsing failed: {e}")
+        return frame, rows, rejected
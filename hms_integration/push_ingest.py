@@ -0,0 +1,115 @@
+"""
+Push ingest of NDJSON request bodies from HMS vendors
+Parses the body as it streams in and validates and writes it in micro-batches
+"""
+
+import logging
+import os
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List, Union
+
+import pandas as pd
+from fastapi import HTTPException
+
+import json_codecs
+from sync_pipeline import (
+    SyncPipeline, PipelineStage, PipelineStats, SyncDataType, validate_records, transform_batch, write_batch,
+    PIPELINE_WRITE_CONCURRENCY
+)
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = int(os.getenv("HMS_INGEST_BATCH_SIZE", "500"))
+# A single line longer than this is rejected instead of being buffered
+INGEST_MAX_LINE_BYTES = int(os.getenv("HMS_INGEST_MAX_LINE_BYTES", str(1024 * 1024)))
+INGEST_QUEUE_SIZE = int(os.getenv("HMS_INGEST_QUEUE_SIZE", "2"))
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+def check_ndjson_content_type(content_type: str):
+    """Reject bodies declared as anything other than NDJSON; a missing header is accepted"""
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type and media_type not in NDJSON_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Expected an NDJSON body ({NDJSON_CONTENT_TYPES[0]})")
+
+
+async def ndjson_lines(chunks: AsyncIterable[bytes],
+                       max_line_bytes: int = INGEST_MAX_LINE_BYTES) -> AsyncIterator[bytes]:
+    """Split a streamed body into non-empty lines, holding at most one partial line
+
+    Only each new chunk is searched for newlines; the pieces of a line that
+    spans chunks are kept in a list and joined once, when it ends.
+    """
+    parts: List[bytes] = []
+    pending_bytes = 0
+    async for chunk in chunks:
+        lines = chunk.split(b"\n")
+        tail = lines.pop()
+        if lines:
+            if parts:
+                parts.append(lines[0])
+                lines[0] = b"".join(parts)
+                parts = []
+                pending_bytes = 0
+            for line in lines:
+                if line.strip():
+                    yield line
+        if tail:
+            parts.append(tail)
+            pending_bytes += len(tail)
+            if pending_bytes > max_line_bytes:
+                raise HTTPException(status_code=413, detail=f"NDJSON line exceeds {max_line_bytes} bytes")
+    line = b"".join(parts)
+    if line.strip():
+        yield line
+
+
+async def ndjson_batches(chunks: AsyncIterable[bytes], stats: PipelineStats,
+                         batch_size: int = INGEST_BATCH_SIZE) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Decode NDJSON lines into micro-batches of objects; undecodable lines count as rejected"""
+    batch = []
+    line_number = 0
+    async for line in ndjson_lines(chunks):
+        line_number += 1
+        stats.add("read", 1)
+        try:
+            record = json_codecs.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            logger.warning(f"Skipping NDJSON line {line_number}: {e}")
+            stats.rejected += 1
+            continue
+
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+async def ingest_ndjson(chunks: AsyncIterable[bytes], data_type: SyncDataType) -> PipelineStats:
+    """Validate, transform and write a streamed NDJSON body batch by batch
+
+    Stats count lines read under "read", records that passed validation
+    under "validate" and rows written under "write".
+    """
+    stats = PipelineStats()
+
+    async def validate(records: List[Dict[str, Any]]) -> List[Any]:
+        return validate_records(records, data_type.record, stats)
+
+    async def transform(records: List[Any]) -> Union[List[tuple], pd.DataFrame]:
+        return transform_batch(records, data_type)
+
+    async def write(batch: Union[List[tuple], pd.DataFrame]) -> int:
+        return await write_batch(batch, data_type)
+
+    pipeline = SyncPipeline([
+        PipelineStage("validate", validate),
+        PipelineStage("transform", transform),
+        PipelineStage("write", write, PIPELINE_WRITE_CONCURRENCY),
+    ], queue_size=INGEST_QUEUE_SIZE)
+    return await pipeline.run(ndjson_batches(chunks, stats), stats)
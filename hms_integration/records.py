@@ -0,0 +1,85 @@
+"""
+Compact record types carried between fetch and write
+Slotted dataclasses with the same fields as the API models; pydantic models
+are only used at the API boundary and converted to these on the way in
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, List, Optional
+
+
+# Required fields come first so records can be built positionally from converted columns
+
+@dataclass(slots=True)
+class VitalRecord:
+    patient_id: str
+    timestamp: datetime
+    encounter_id: Optional[str] = None
+    systolic_bp: Optional[float] = None
+    diastolic_bp: Optional[float] = None
+    heart_rate: Optional[float] = None
+    temperature: Optional[float] = None
+    respiratory_rate: Optional[float] = None
+    oxygen_saturation: Optional[float] = None
+    weight: Optional[float] = None
+    height: Optional[float] = None
+    bmi: Optional[float] = None
+    recorded_by: Optional[str] = None
+
+
+@dataclass(slots=True)
+class LabRecord:
+    patient_id: str
+    test_name: str
+    ordered_date: datetime
+    order_id: Optional[str] = None
+    test_code: Optional[str] = None
+    result_value: Optional[str] = None
+    result_numeric: Optional[float] = None
+    reference_range: Optional[str] = None
+    units: Optional[str] = None
+    status: str = "completed"
+    result_date: Optional[datetime] = None
+    ordered_by: Optional[str] = None
+    resulted_by: Optional[str] = None
+
+
+@dataclass(slots=True)
+class PrescriptionRecord:
+    patient_id: str
+    medication_name: str
+    dosage: str
+    frequency: str
+    prescribed_date: datetime
+    prescribed_by: str
+    encounter_id: Optional[str] = None
+    medication_code: Optional[str] = None
+    duration: Optional[str] = None
+    quantity: Optional[float] = None
+    instructions: Optional[str] = None
+    status: str = "active"
+
+
+@dataclass(slots=True)
+class DiagnosisRecord:
+    patient_id: str
+    diagnosis_code: str
+    diagnosis_name: str
+    diagnosed_date: datetime
+    diagnosed_by: str
+    encounter_id: Optional[str] = None
+    diagnosis_type: str = "primary"
+    status: str = "confirmed"
+
+
+def record_fields(record_type: type) -> List[str]:
+    """Field names of a record type in constructor order"""
+    return list(record_type.__slots__)
+
+
+def to_record(item: Any, record_type: type) -> Any:
+    """Record from an already validated API model (or a record, returned as is)"""
+    if isinstance(item, record_type):
+        return item
+    return record_type(*[getattr(item, name) for name in record_type.__slots__])
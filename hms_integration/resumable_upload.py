@@ -0,0 +1,247 @@
+"""
+Resumable chunked uploads for large HMS exports
+Chunks are written to local disk at their offsets and the contiguous prefix
+can be read by the ingest pipeline while later chunks are still arriving
+"""
+
+import io
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from parallel_parse import UPLOAD_DIR
+
+logger = logging.getLogger(__name__)
+
+# Largest declared upload size accepted; the file on disk is sized to the declared total up front
+UPLOAD_MAX_BYTES = int(os.getenv("HMS_UPLOAD_MAX_BYTES", str(16 * 1024 ** 3)))
+UPLOAD_CHUNK_MAX_BYTES = int(os.getenv("HMS_UPLOAD_CHUNK_MAX_BYTES", str(64 * 1024 * 1024)))
+# A reader waiting this long for the next contiguous bytes gives up and fails the upload
+UPLOAD_IDLE_TIMEOUT_SECONDS = float(os.getenv("HMS_UPLOAD_IDLE_TIMEOUT_SECONDS", "3600"))
+UPLOAD_READ_BUFFER_BYTES = 1024 * 1024
+# Open uploads per replica. Each upload's ingest reads in a thread that blocks until the client
+# sends more bytes, so those threads come from a pool of this size rather than the default executor.
+UPLOAD_MAX_SESSIONS = int(os.getenv("HMS_UPLOAD_MAX_SESSIONS", "16"))
+
+
+class UploadAborted(Exception):
+    """Raised to readers of an upload that was cancelled or timed out"""
+
+
+class UploadLimitReached(Exception):
+    """Raised when this replica already has its maximum number of uploads open"""
+
+
+class UploadSession:
+    """One resumable upload backed by a preallocated file on disk
+
+    Chunks may arrive in any order and may be resent; received byte ranges
+    are merged so the contiguous prefix from offset 0 is always known.
+    """
+
+    def __init__(self, data_type: str, filename: str, total_size: int, directory: str = UPLOAD_DIR):
+        self.upload_id = str(uuid.uuid4())
+        self.data_type = data_type
+        self.filename = filename
+        self.total_size = total_size
+        self.path = os.path.join(directory, f"hms-upload-{self.upload_id}")
+        self.created_at = datetime.utcnow()
+        self.updated_at = self.created_at
+        self.finalized = False
+        self.aborted: Optional[str] = None
+        self.job_id: Optional[str] = None
+        self.contiguous = 0
+        # Sorted, non-overlapping [start, end) ranges received so far
+        self._received: List[Tuple[int, int]] = []
+        self._changed = threading.Condition()
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        os.ftruncate(self._fd, total_size)
+
+    @property
+    def is_complete(self) -> bool:
+        return self.contiguous >= self.total_size
+
+    def write_chunk(self, offset: int, data: bytes) -> int:
+        """Write a chunk at its offset and return the new contiguous byte count"""
+        if offset < 0 or offset + len(data) > self.total_size:
+            raise ValueError(f"Chunk {offset}-{offset + len(data)} is outside the declared size {self.total_size}")
+        if self.aborted or self._fd is None:
+            raise UploadAborted(self.aborted or "upload is closed")
+
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.pwrite(self._fd, view[written:], offset + written)
+
+        with self._changed:
+            self._merge(offset, offset + len(data))
+            self.updated_at = datetime.utcnow()
+            self._changed.notify_all()
+            return self.contiguous
+
+    def _merge(self, start: int, end: int):
+        if start == end:
+            return
+        merged = []
+        for range_start, range_end in self._received:
+            if range_end < start or range_start > end:
+                merged.append((range_start, range_end))
+            else:
+                start, end = min(start, range_start), max(end, range_end)
+        merged.append((start, end))
+        merged.sort()
+        self._received = merged
+        self.contiguous = merged[0][1] if merged[0][0] == 0 else 0
+
+    def missing_ranges(self) -> List[Tuple[int, int]]:
+        """Byte ranges the client still has to send"""
+        with self._changed:
+            missing = []
+            position = 0
+            for start, end in self._received:
+                if start > position:
+                    missing.append((position, start))
+                position = end
+            if position < self.total_size:
+                missing.append((position, self.total_size))
+            return missing
+
+    def finalize(self):
+        if not self.is_complete:
+            raise ValueError(f"Upload has {self.contiguous} of {self.total_size} bytes")
+        with self._changed:
+            self.finalized = True
+            self._changed.notify_all()
+
+    def abort(self, reason: str):
+        with self._changed:
+            if self.aborted is None:
+                self.aborted = reason
+            self._changed.notify_all()
+
+    def wait_for(self, position: int, timeout: float = UPLOAD_IDLE_TIMEOUT_SECONDS) -> int:
+        """Block until bytes past position are contiguous (or the file is complete); returns the contiguous count"""
+        with self._changed:
+            while self.contiguous <= position and position < self.total_size:
+                if self.aborted:
+                    raise UploadAborted(self.aborted)
+                if not self._changed.wait(timeout):
+                    self.aborted = f"no data for {timeout:.0f}s"
+                    raise UploadAborted(self.aborted)
+            if self.aborted:
+                raise UploadAborted(self.aborted)
+            return self.contiguous
+
+    def wait_until_finalized(self, timeout: float = UPLOAD_IDLE_TIMEOUT_SECONDS):
+        """Block until finalize() (used by formats that need the whole file, e.g. Parquet)"""
+        with self._changed:
+            while not self.finalized:
+                if self.aborted:
+                    raise UploadAborted(self.aborted)
+                if not self._changed.wait(timeout):
+                    self.aborted = f"not finalized within {timeout:.0f}s"
+                    raise UploadAborted(self.aborted)
+
+    def read_at(self, position: int, size: int) -> bytes:
+        fd = self._fd
+        if fd is None:
+            raise UploadAborted(self.aborted or "upload is closed")
+        return os.pread(fd, size, position)
+
+    def open_reader(self) -> io.BufferedReader:
+        """Sequential reader over the contiguous prefix that waits for more bytes instead of hitting EOF"""
+        return io.BufferedReader(ContiguousReader(self), UPLOAD_READ_BUFFER_BYTES)
+
+    def close(self):
+        """Release the file descriptor and remove the data on disk"""
+        with self._changed:
+            if self._fd is None:
+                return
+            os.close(self._fd)
+            self._fd = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "upload_id": self.upload_id,
+            "data_type": self.data_type,
+            "filename": self.filename,
+            "total_size": self.total_size,
+            "received_bytes": sum(end - start for start, end in self._received),
+            "contiguous_bytes": self.contiguous,
+            "missing_ranges": [list(r) for r in self.missing_ranges()],
+            "finalized": self.finalized,
+            "aborted": self.aborted,
+            "job_id": self.job_id,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat()
+        }
+
+
+class ContiguousReader(io.RawIOBase):
+    """Raw reader that only returns bytes below the session's contiguous offset"""
+
+    def __init__(self, session: UploadSession):
+        self.session = session
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.session.total_size:
+            # End of file only once the client has committed the upload
+            self.session.wait_until_finalized()
+            return 0
+        available = self.session.wait_for(self.position) - self.position
+        data = self.session.read_at(self.position, min(len(buffer), available))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class ResumableUploadStore:
+    """Open upload sessions of this replica, by upload ID
+
+    executor runs the blocking reads and waits of upload ingest, one thread
+    per open session, so uploads waiting on slow clients never hold threads
+    of the event loop's default executor.
+    """
+
+    def __init__(self, directory: str = UPLOAD_DIR, max_sessions: int = UPLOAD_MAX_SESSIONS):
+        self.directory = directory
+        self.max_sessions = max_sessions
+        self.sessions: Dict[str, UploadSession] = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix="hms-upload")
+
+    def create(self, data_type: str, filename: str, total_size: int) -> UploadSession:
+        if len(self.sessions) >= self.max_sessions:
+            raise UploadLimitReached(f"{len(self.sessions)} uploads are already open; retry later")
+        session = UploadSession(data_type, filename, total_size, self.directory)
+        self.sessions[session.upload_id] = session
+        logger.info(f"Opened upload {session.upload_id} for {filename} ({total_size} bytes)")
+        return session
+
+    def get(self, upload_id: str) -> Optional[UploadSession]:
+        return self.sessions.get(upload_id)
+
+    def discard(self, session: UploadSession):
+        self.sessions.pop(session.upload_id, None)
+        session.close()
+
+    def abort_all(self, reason: str):
+        for session in list(self.sessions.values()):
+            session.abort(reason)
+
+    def shutdown(self):
+        """Abort open uploads, which wakes their blocked readers, and stop the reader threads"""
+        self.abort_all("service shutting down")
+        self.executor.shutdown(wait=False, cancel_futures=True)
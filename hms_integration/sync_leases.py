@@ -0,0 +1,186 @@
+"""
+Cross-replica sync coordination using Postgres advisory locks
+Only one service replica works a given (facility, data type) shard at a time
+"""
+
+import asyncio
+import asyncpg
+import logging
+import os
+import socket
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+REPLICA_ID = os.getenv("HMS_REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASES_ENABLED = os.getenv("HMS_SYNC_LEASES_ENABLED", "true").lower() == "true"
+
+# TCP keepalives on the lease session so Postgres notices a dead replica and frees its locks within about a minute
+LEASE_SERVER_SETTINGS = {
+    "application_name": f"hms-sync-lease:{REPLICA_ID}"[:63],
+    "tcp_keepalives_idle": os.getenv("HMS_LEASE_KEEPALIVE_IDLE", "20"),
+    "tcp_keepalives_interval": os.getenv("HMS_LEASE_KEEPALIVE_INTERVAL", "10"),
+    "tcp_keepalives_count": os.getenv("HMS_LEASE_KEEPALIVE_COUNT", "3"),
+}
+
+
+class LeaseUnavailable(Exception):
+    """Raised when another replica holds the lease for one or more shards"""
+
+    def __init__(self, facility_key: str, data_types: List[str], counts: Optional[Dict[str, int]] = None):
+        super().__init__(f"Sync leases for {facility_key} held by another replica: {', '.join(data_types)}")
+        self.facility_key = facility_key
+        self.data_types = data_types
+        self.counts = counts or {}
+
+
+class SyncLease:
+    """A held advisory lock; the lock lives exactly as long as its session"""
+
+    def __init__(self, facility_key: str, data_type: str, conn):
+        self.facility_key = facility_key
+        self.data_type = data_type
+        self.conn = conn
+        self.acquired_at = datetime.utcnow()
+
+    @property
+    def is_held(self) -> bool:
+        return not self.conn.is_closed()
+
+    def to_dict(self) -> Dict[str, str]:
+        return {
+            "facility": self.facility_key,
+            "data_type": self.data_type,
+            "acquired_at": self.acquired_at.isoformat()
+        }
+
+
+def lease_facility_key(hms_credentials) -> str:
+    """Identify a facility by its HMS base URL so API and scheduled syncs share leases"""
+    return hms_credentials.base_url.rstrip('/').lower()
+
+
+class SyncLeaseManager:
+    """Hands out (facility, data type) leases backed by session advisory locks
+
+    All of a replica's leases are held on one dedicated connection, opened
+    on first use and kept for later leases. Releasing a lease unlocks it;
+    if the replica dies, Postgres ends the session and its locks pass to
+    whichever replica asks next, with no expiry bookkeeping. If the lease
+    connection drops, every lease on it is lost and the next acquire opens
+    a new one.
+    """
+
+    def __init__(self, database_url: str, enabled: bool = LEASES_ENABLED):
+        self.database_url = database_url
+        self.enabled = enabled
+        self._held: Dict[Tuple[str, str], SyncLease] = {}
+        self._conn = None
+        # One query at a time on the shared lease session
+        self._conn_lock = asyncio.Lock()
+
+    async def _connection(self):
+        if self._conn is None or self._conn.is_closed():
+            # Locks held on a dropped session are gone
+            self._held = {key: lease for key, lease in self._held.items() if lease.is_held}
+            self._conn = await asyncpg.connect(self.database_url, server_settings=LEASE_SERVER_SETTINGS)
+        return self._conn
+
+    async def try_acquire(self, facility_key: str, data_type: str) -> Optional[SyncLease]:
+        """Take the lease without waiting; None if another session holds it"""
+        key = (facility_key, data_type)
+        async with self._conn_lock:
+            held = self._held.get(key)
+            if held is not None and held.is_held:
+                # Another job in this replica already owns the shard
+                return None
+
+            conn = await self._connection()
+            acquired = await conn.fetchval(
+                "SELECT pg_try_advisory_lock(hashtext($1), hashtext($2))",
+                f"hms_sync:{facility_key}",
+                data_type
+            )
+            if not acquired:
+                return None
+
+            lease = SyncLease(facility_key, data_type, conn)
+            self._held[key] = lease
+        logger.info(f"Replica {REPLICA_ID} acquired sync lease {facility_key}/{data_type}")
+        return lease
+
+    async def release(self, lease: SyncLease):
+        """Unlock the lease; the session stays open for later leases"""
+        async with self._conn_lock:
+            if self._held.get((lease.facility_key, lease.data_type)) is lease:
+                del self._held[(lease.facility_key, lease.data_type)]
+            try:
+                if lease.is_held:
+                    await lease.conn.execute(
+                        "SELECT pg_advisory_unlock(hashtext($1), hashtext($2))",
+                        f"hms_sync:{lease.facility_key}",
+                        lease.data_type
+                    )
+            except Exception as e:
+                logger.warning(f"Failed to unlock sync lease {lease.facility_key}/{lease.data_type}: {e}")
+                # A session in an unknown state could keep the lock; closing it frees every lock it holds
+                await lease.conn.close()
+
+    async def close(self):
+        """Close the lease session, releasing every lease this replica holds"""
+        async with self._conn_lock:
+            if self._conn is not None and not self._conn.is_closed():
+                await self._conn.close()
+            self._conn = None
+            self._held = {}
+
+    def lease_set(self, facility_key: str) -> "LeaseSet":
+        return LeaseSet(self, facility_key)
+
+    def held(self) -> List[Dict[str, str]]:
+        return [lease.to_dict() for lease in self._held.values() if lease.is_held]
+
+
+class LeaseSet:
+    """The leases one job holds on a facility, kept from first acquire until the job finishes
+
+    A data type is leased at most once per job: once taken it stays held
+    across the job's slices, and once refused it is not retried, so the
+    job never works part of a window another replica also works.
+    """
+
+    def __init__(self, manager: SyncLeaseManager, facility_key: str):
+        self.manager = manager
+        self.facility_key = facility_key
+        self._leases: Dict[str, SyncLease] = {}
+        self._refused: set = set()
+
+    async def hold(self, data_type: str) -> bool:
+        """Whether this job holds the data type's lease, taking it if not yet tried"""
+        if not self.manager.enabled:
+            return True
+        if data_type in self._refused:
+            return False
+        lease = self._leases.get(data_type)
+        if lease is not None:
+            if lease.is_held:
+                return True
+            raise RuntimeError(f"Sync lease {self.facility_key}/{data_type} was lost with its session")
+        lease = await self.manager.try_acquire(self.facility_key, data_type)
+        if lease is None:
+            self._refused.add(data_type)
+            return False
+        self._leases[data_type] = lease
+        return True
+
+    async def release(self):
+        leases, self._leases = self._leases, {}
+        for lease in leases.values():
+            await self.manager.release(lease)
+
+    async def __aenter__(self) -> "LeaseSet":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
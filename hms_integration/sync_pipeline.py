@@ -0,0 +1,239 @@
+"""
+Stage-based sync pipeline for HMS data
+Fetch, validate, transform and write stages connected by bounded queues
+"""
+
+import asyncio
+import logging
+import os
+from functools import lru_cache
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+import pandas as pd
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from converters import FRAME_SCHEMAS, frame_from_records
+from records import to_record
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_PAGE_SIZE = int(os.getenv("HMS_PIPELINE_PAGE_SIZE", "25"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("HMS_PIPELINE_QUEUE_SIZE", "4"))
+PIPELINE_FETCH_CONCURRENCY = int(os.getenv("HMS_PIPELINE_FETCH_CONCURRENCY", "2"))
+PIPELINE_VALIDATE_CONCURRENCY = int(os.getenv("HMS_PIPELINE_VALIDATE_CONCURRENCY", "1"))
+PIPELINE_TRANSFORM_CONCURRENCY = int(os.getenv("HMS_PIPELINE_TRANSFORM_CONCURRENCY", "1"))
+PIPELINE_WRITE_CONCURRENCY = int(os.getenv("HMS_PIPELINE_WRITE_CONCURRENCY", "2"))
+# Batches at least this large are carried as column frames and written with COPY
+PIPELINE_COLUMNAR_MIN_ROWS = int(os.getenv("HMS_PIPELINE_COLUMNAR_MIN_ROWS", "1000"))
+
+# Marks the end of input for one stage worker
+_END = object()
+
+
+def _is_empty(result: Any) -> bool:
+    """True for None, zero counts and empty batches (lists or frames)"""
+    if result is None:
+        return True
+    if isinstance(result, int):
+        return result == 0
+    return len(result) == 0
+
+
+class PipelineStage:
+    """One named pipeline step run by a fixed number of concurrent workers"""
+
+    def __init__(self, name: str, handler: Callable[[Any], Awaitable[Any]], concurrency: int = 1):
+        if concurrency < 1:
+            raise ValueError(f"Stage {name} needs at least one worker")
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+
+
+class PipelineStats:
+    """Item counts produced by each stage of a pipeline run"""
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self.rejected = 0
+
+    def add(self, stage_name: str, result: Any):
+        size = result if isinstance(result, int) else len(result)
+        self.counts[stage_name] = self.counts.get(stage_name, 0) + size
+
+    def get(self, stage_name: str) -> int:
+        return self.counts.get(stage_name, 0)
+
+
+class SyncPipeline:
+    """Runs batches through ordered stages with backpressure between them
+
+    Each stage reads from a bounded queue and writes its result to the next
+    stage's queue, so the fetch of one page overlaps the write of the
+    previous one while at most queue_size batches wait between any two
+    stages. Empty results are dropped instead of being passed on.
+    """
+
+    def __init__(self, stages: List[PipelineStage], queue_size: int = PIPELINE_QUEUE_SIZE):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = stages
+        self.queue_size = queue_size
+
+    async def run(self, source: Union[Iterable[Any], AsyncIterable[Any]],
+                  stats: Optional[PipelineStats] = None) -> PipelineStats:
+        """Feed every item from source through all stages and wait for the last write"""
+        stats = stats or PipelineStats()
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [stage.concurrency for stage in self.stages]
+
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                task_group.create_task(self._feed(source, queues[0], self.stages[0].concurrency))
+                for index, stage in enumerate(self.stages):
+                    for _ in range(stage.concurrency):
+                        task_group.create_task(self._worker(index, queues, remaining, stats))
+        except BaseExceptionGroup as group:
+            # A failing stage cancels the others; surface its error rather than the group wrapper
+            raise group.exceptions[0]
+
+        logger.info(f"Pipeline finished: {stats.counts}, rejected {stats.rejected}")
+        return stats
+
+    async def _feed(self, source: Union[Iterable[Any], AsyncIterable[Any]], inbox: asyncio.Queue, workers: int):
+        if hasattr(source, "__aiter__"):
+            async for item in source:
+                await inbox.put(item)
+        else:
+            for item in source:
+                await inbox.put(item)
+        for _ in range(workers):
+            await inbox.put(_END)
+
+    async def _worker(self, index: int, queues: List[asyncio.Queue], remaining: List[int], stats: PipelineStats):
+        stage = self.stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(queues) else None
+
+        while True:
+            item = await inbox.get()
+            if item is _END:
+                break
+            result = await stage.handler(item)
+            if _is_empty(result):
+                continue
+            stats.add(stage.name, result)
+            if outbox is not None:
+                await outbox.put(result)
+
+        # The last worker of a stage closes the next stage
+        remaining[index] -= 1
+        if remaining[index] == 0 and outbox is not None:
+            for _ in range(self.stages[index + 1].concurrency):
+                await outbox.put(_END)
+
+
+class SyncDataType:
+    """Binds a sync data type to its HMS fetch method, models and mapper steps
+
+    model is the pydantic API model; record is the slotted type the
+    pipeline carries between validation and write. copy, when set, bulk-writes an already converted column frame and lets
+    columnar uploads skip building models and row tuples.
+    """
+
+    def __init__(self, name: str, fetch_method: str, model: type, record: type,
+                 transform: Callable[[List[Any]], List[tuple]],
+                 write: Callable[[List[tuple]], Awaitable[int]],
+                 copy: Optional[Callable[[Any], Awaitable[int]]] = None):
+        self.name = name
+        self.fetch_method = fetch_method
+        self.model = model
+        self.record = record
+        self.transform = transform
+        self.write = write
+        self.copy = copy
+
+
+def paginate(patient_ids: Optional[List[str]], page_size: int = PIPELINE_PAGE_SIZE) -> List[List[str]]:
+    """Split patient IDs into fetch pages; no patient list is a single empty page"""
+    if not patient_ids:
+        return [[]]
+    return [patient_ids[i:i + page_size] for i in range(0, len(patient_ids), page_size)]
+
+
+@lru_cache(maxsize=None)
+def batch_adapter(record_type: type) -> TypeAdapter:
+    """List validator for a record type, built once; a batch is validated in one pydantic-core call"""
+    return TypeAdapter(List[record_type])
+
+
+def validate_records(records: List[Any], record_type: type, stats: Optional[PipelineStats] = None) -> List[Any]:
+    """Coerce a batch of untrusted records to the data type's record type and drop ones that fail or lack a patient ID
+
+    The whole batch is validated at once; when it fails, the records named
+    in the errors are dropped and the rest validated again. API models
+    returned by HMS clients are already validated and only copied into
+    records; records pass through unchanged.
+    """
+    items = [to_record(record, record_type) if isinstance(record, BaseModel) else record for record in records]
+    adapter = batch_adapter(record_type)
+    try:
+        validated = adapter.validate_python(items)
+    except ValidationError as e:
+        failures: Dict[int, str] = {}
+        for error in e.errors():
+            failures.setdefault(error["loc"][0], f"{'.'.join(str(part) for part in error['loc'][1:])}: {error['msg']}")
+        for index, reason in failures.items():
+            logger.warning(f"Skipping invalid {record_type.__name__} record {index}: {reason}")
+        if stats is not None:
+            stats.rejected += len(failures)
+        validated = adapter.validate_python([item for index, item in enumerate(items) if index not in failures])
+
+    valid = [record for record in validated if record.patient_id]
+    if len(valid) < len(validated):
+        logger.warning(f"Skipping {len(validated) - len(valid)} {record_type.__name__} records without a patient_id")
+        if stats is not None:
+            stats.rejected += len(validated) - len(valid)
+    return valid
+
+
+def transform_batch(records: List[Any], data_type: SyncDataType,
+                    columnar_min_rows: int = PIPELINE_COLUMNAR_MIN_ROWS) -> Union[List[tuple], pd.DataFrame]:
+    """Row tuples for the data type's writer, or a converted column frame when the batch is large enough for COPY"""
+    if data_type.copy is not None and len(records) >= columnar_min_rows:
+        return frame_from_records(records, FRAME_SCHEMAS[data_type.name])
+    return data_type.transform(records)
+
+
+async def write_batch(batch: Union[List[tuple], pd.DataFrame], data_type: SyncDataType) -> int:
+    """Write a transformed batch with COPY if it is a column frame, row by row otherwise"""
+    if isinstance(batch, pd.DataFrame):
+        return await data_type.copy(batch)
+    return await data_type.write(batch)
+
+
+async def run_sync_pipeline(hms_client: Any, data_type: SyncDataType, patient_ids: Optional[List[str]],
+                            date_from: Any = None, date_to: Any = None) -> PipelineStats:
+    """Sync one data type from an authenticated HMS client through the staged pipeline"""
+    fetch_method = getattr(hms_client, data_type.fetch_method)
+    stats = PipelineStats()
+
+    async def fetch(page: List[str]) -> List[Any]:
+        return await fetch_method(page, date_from, date_to)
+
+    async def validate(records: List[Any]) -> List[Any]:
+        return validate_records(records, data_type.record, stats)
+
+    async def transform(records: List[Any]) -> Union[List[tuple], pd.DataFrame]:
+        return transform_batch(records, data_type)
+
+    async def write(batch: Union[List[tuple], pd.DataFrame]) -> int:
+        return await write_batch(batch, data_type)
+
+    pipeline = SyncPipeline([
+        PipelineStage("fetch", fetch, PIPELINE_FETCH_CONCURRENCY),
+        PipelineStage("validate", validate, PIPELINE_VALIDATE_CONCURRENCY),
+        PipelineStage("transform", transform, PIPELINE_TRANSFORM_CONCURRENCY),
+        PipelineStage("write", write, PIPELINE_WRITE_CONCURRENCY),
+    ])
+    return await pipeline.run(paginate(patient_ids), stats)
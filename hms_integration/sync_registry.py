@@ -0,0 +1,39 @@
+"""
+Sync data type registry
+The database mapper and the fetch/write stages of each data type, cheap to
+import for shard worker processes that must not load the API in main
+"""
+
+from typing import List
+
+from database_mapper import ErlessedDatabaseMapper
+from hms_clients import VitalSigns, LabResult, Prescription, Diagnosis
+from records import VitalRecord, LabRecord, PrescriptionRecord, DiagnosisRecord
+from sync_pipeline import SyncDataType
+
+db_mapper = ErlessedDatabaseMapper()
+
+SYNC_DATA_TYPES = {
+    "vitals": SyncDataType("vitals", "get_vitals", VitalSigns, VitalRecord,
+                           db_mapper.prepare_vitals, db_mapper.write_vitals,
+                           db_mapper.copy_vitals_frame),
+    "lab_results": SyncDataType("lab_results", "get_lab_results", LabResult, LabRecord,
+                                db_mapper.prepare_lab_results, db_mapper.write_lab_results,
+                                db_mapper.copy_lab_results_frame),
+    "prescriptions": SyncDataType("prescriptions", "get_prescriptions", Prescription, PrescriptionRecord,
+                                  db_mapper.prepare_prescriptions, db_mapper.write_prescriptions,
+                                  db_mapper.copy_prescriptions_frame),
+    "diagnoses": SyncDataType("diagnoses", "get_diagnoses", Diagnosis, DiagnosisRecord,
+                              db_mapper.prepare_diagnoses, db_mapper.write_diagnoses,
+                              db_mapper.copy_diagnoses_frame),
+}
+
+def requested_data_types(request) -> List[str]:
+    """Data types enabled by the include_* flags of a sync request or facility schedule"""
+    flags = [
+        ("vitals", request.include_vitals),
+        ("lab_results", request.include_labs),
+        ("prescriptions", request.include_prescriptions),
+        ("diagnoses", request.include_diagnoses),
+    ]
+    return [data_type for data_type, enabled in flags if enabled]
@@ -0,0 +1,452 @@
+"""
+Periodic incremental sync scheduler for registered HMS facilities
+Staggers facility start times with jitter, shares workers fairly between facilities
+and serves urgent-patient vitals ahead of routine and backfill work
+"""
+
+import asyncio
+import logging
+import os
+import random
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from sync_leases import LeaseSet, LeaseUnavailable, SyncLeaseManager, lease_facility_key
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv("HMS_SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_TICK_SECONDS = float(os.getenv("HMS_SCHEDULER_TICK_SECONDS", "5"))
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("HMS_SCHEDULER_MAX_CONCURRENCY", "4"))
+SCHEDULER_SLICE_SIZE = int(os.getenv("HMS_SCHEDULER_SLICE_SIZE", "50"))
+SCHEDULER_JITTER_RATIO = float(os.getenv("HMS_SCHEDULER_JITTER_RATIO", "0.1"))
+SCHEDULER_JOB_HISTORY = int(os.getenv("HMS_SCHEDULER_JOB_HISTORY", "500"))
+SCHEDULER_REALTIME_SECONDS = float(os.getenv("HMS_SCHEDULER_REALTIME_SECONDS", "60"))
+SCHEDULER_REALTIME_WORKERS = int(os.getenv("HMS_SCHEDULER_REALTIME_WORKERS", "1"))
+SCHEDULER_MAX_WAIT_SECONDS = float(os.getenv("HMS_SCHEDULER_MAX_WAIT_SECONDS", "300"))
+
+# Priority classes, highest first
+PRIORITY_REALTIME = "realtime"
+PRIORITY_INCREMENTAL = "incremental"
+PRIORITY_BACKFILL = "backfill"
+PRIORITY_CLASSES = [PRIORITY_REALTIME, PRIORITY_INCREMENTAL, PRIORITY_BACKFILL]
+# Jobs started directly from the API and run outside the scheduler queues
+PRIORITY_ON_DEMAND = "on_demand"
+
+# sync_handler(facility, patient_ids, date_from, date_to, data_types, leases) -> records stored per data type;
+# leases is the job's LeaseSet, held from its first slice until it finishes (None without a lease manager)
+SyncHandler = Callable[[Any, Optional[List[str]], Optional[datetime], Optional[datetime], Optional[List[str]],
+                        Optional[LeaseSet]], Awaitable[Dict[str, int]]]
+# urgent_patients_provider() -> urgent HMS patient IDs by the facility their queue row was triaged under
+UrgentPatientsProvider = Callable[[], Awaitable[Dict[str, List[str]]]]
+
+
+def _chunk(items: List[str], size: int) -> List[List[str]]:
+    """Split a list into consecutive slices of at most size items"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class SyncJob:
+    """Tracks one sync run for a facility, split into patient slices"""
+
+    def __init__(self, facility_id: str, patient_ids: Optional[List[str]],
+                 date_from: Optional[datetime], date_to: Optional[datetime], slice_size: int,
+                 priority: str = PRIORITY_INCREMENTAL, data_types: Optional[List[str]] = None,
+                 slices: Optional[List[List[str]]] = None):
+        self.job_id = str(uuid.uuid4())
+        self.facility_id = facility_id
+        self.priority = priority
+        self.data_types = data_types
+        self.date_from = date_from
+        self.date_to = date_to
+        self.status = "queued"
+        self.records_synced: Dict[str, int] = {}
+        self.errors: List[str] = []
+        # Problems that do not fail the job, e.g. an upload whose digest differs from the declared one
+        self.warnings: List[str] = []
+        # Data types skipped because another replica held their lease
+        self.deferred: List[str] = []
+        self.leases: Optional[LeaseSet] = None
+        self.created_at = datetime.utcnow()
+        # When the job last joined its class queue; aging is measured from here
+        self.enqueued_at = self.created_at
+        self.started_at: Optional[datetime] = None
+        self.completed_at: Optional[datetime] = None
+
+        # A facility without an explicit patient list is synced as a single slice
+        if slices is None:
+            slices = _chunk(patient_ids, slice_size) if patient_ids else [None]
+        self._slices: Deque[Optional[List[str]]] = deque(slices)
+        self.slices_total = len(self._slices)
+        self.slices_done = 0
+
+    @property
+    def has_pending_slices(self) -> bool:
+        return bool(self._slices)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("completed", "failed", "deferred", "cancelled")
+
+    def next_slice(self) -> Optional[List[str]]:
+        return self._slices.popleft()
+
+    def record(self, counts: Dict[str, int]):
+        """Accumulate per data type counts of records stored by a finished slice"""
+        for data_type, count in counts.items():
+            self.records_synced[data_type] = self.records_synced.get(data_type, 0) + count
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "facility_id": self.facility_id,
+            "priority": self.priority,
+            "data_types": self.data_types,
+            "status": self.status,
+            "date_from": self.date_from.isoformat() if self.date_from else None,
+            "date_to": self.date_to.isoformat() if self.date_to else None,
+            "slices_total": self.slices_total,
+            "slices_done": self.slices_done,
+            "records_synced": self.records_synced,
+            "total_records_synced": sum(self.records_synced.values()),
+            "errors": self.errors,
+            "warnings": self.warnings,
+            "deferred": self.deferred,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "completed_at": self.completed_at.isoformat() if self.completed_at else None
+        }
+
+
+class FacilityState:
+    """Schedule and incremental sync watermark for one registered facility"""
+
+    def __init__(self, schedule: Any, next_run_at: datetime):
+        self.schedule = schedule
+        self.next_run_at = next_run_at
+        self.last_synced_at: Optional[datetime] = None
+        self.last_realtime_at: Optional[datetime] = None
+        # At most one active job per priority class
+        self.active_jobs: Dict[str, SyncJob] = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "facility_id": self.schedule.facility_id,
+            "interval_minutes": self.schedule.interval_minutes,
+            "next_run_at": self.next_run_at.isoformat(),
+            "last_synced_at": self.last_synced_at.isoformat() if self.last_synced_at else None,
+            "last_realtime_at": self.last_realtime_at.isoformat() if self.last_realtime_at else None,
+            "active_jobs": {priority: job.job_id for priority, job in self.active_jobs.items()}
+        }
+
+
+class SyncScheduler:
+    """Runs incremental syncs per registered facility on a jittered interval
+
+    Each due facility gets a job whose patients are split into slices. Jobs
+    wait in one round-robin queue per priority class and workers take one
+    slice at a time, so a facility with a very large patient list goes to the
+    back of its class queue after each slice.
+
+    Higher classes are served first and preempt lower ones at slice
+    boundaries. A reserved pool of workers only takes realtime slices so
+    urgent vitals never wait behind a running backfill slice, and a class
+    whose head job has been queued for longer than max_wait_seconds is
+    served next so backfills keep moving.
+
+    Registrations and watermarks are kept in memory only, so a restart or a
+    second replica starts without them.
+    """
+
+    def __init__(self, sync_handler: SyncHandler,
+                 urgent_patients_provider: Optional[UrgentPatientsProvider] = None,
+                 max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+                 realtime_workers: int = SCHEDULER_REALTIME_WORKERS,
+                 slice_size: int = SCHEDULER_SLICE_SIZE,
+                 jitter_ratio: float = SCHEDULER_JITTER_RATIO,
+                 tick_seconds: float = SCHEDULER_TICK_SECONDS,
+                 realtime_seconds: float = SCHEDULER_REALTIME_SECONDS,
+                 max_wait_seconds: float = SCHEDULER_MAX_WAIT_SECONDS,
+                 lease_manager: Optional[SyncLeaseManager] = None):
+        self.sync_handler = sync_handler
+        self.lease_manager = lease_manager
+        self.urgent_patients_provider = urgent_patients_provider
+        self.max_concurrency = max_concurrency
+        self.realtime_workers = realtime_workers
+        self.slice_size = slice_size
+        self.jitter_ratio = jitter_ratio
+        self.tick_seconds = tick_seconds
+        self.realtime_seconds = realtime_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.facilities: Dict[str, FacilityState] = {}
+        self.jobs: Dict[str, SyncJob] = {}
+        self._ready: Dict[str, Deque[SyncJob]] = {priority: deque() for priority in PRIORITY_CLASSES}
+        self._ready_event = asyncio.Event()
+        self._realtime_event = asyncio.Event()
+        self._next_realtime_at = datetime.utcnow()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def register_facility(self, schedule: Any) -> FacilityState:
+        """Register or replace a facility schedule, staggering its first run"""
+        interval = timedelta(minutes=schedule.interval_minutes)
+        # Spread first runs uniformly over one interval so facilities registered together do not fire together
+        first_run_at = datetime.utcnow() + timedelta(seconds=random.uniform(0, interval.total_seconds()))
+
+        existing = self.facilities.get(schedule.facility_id)
+        state = FacilityState(schedule, first_run_at)
+        if existing:
+            state.last_synced_at = existing.last_synced_at
+            state.last_realtime_at = existing.last_realtime_at
+            state.active_jobs = existing.active_jobs
+        self.facilities[schedule.facility_id] = state
+
+        logger.info(f"Registered facility {schedule.facility_id} for sync every {schedule.interval_minutes} min, "
+                    f"first run at {first_run_at.isoformat()}")
+        return state
+
+    def facility_for(self, hms_credentials: Any) -> str:
+        """Canonical facility key for an HMS: the registered facility_id with the same base URL, else the base URL"""
+        key = lease_facility_key(hms_credentials)
+        for facility_id, state in self.facilities.items():
+            if lease_facility_key(state.schedule.hms_credentials) == key:
+                return facility_id
+        return key
+
+    def unregister_facility(self, facility_id: str) -> bool:
+        """Stop scheduling a facility; any slice already running finishes"""
+        return self.facilities.pop(facility_id, None) is not None
+
+    def trigger(self, facility_id: str) -> SyncJob:
+        """Queue an immediate incremental sync for a facility"""
+        state = self.facilities.get(facility_id)
+        if state is None:
+            raise KeyError(facility_id)
+        if PRIORITY_INCREMENTAL in state.active_jobs:
+            return state.active_jobs[PRIORITY_INCREMENTAL]
+        return self._enqueue_job(state, datetime.utcnow())
+
+    def enqueue_backfill(self, facility_id: str, date_from: Optional[datetime], date_to: Optional[datetime],
+                         data_types: Optional[List[str]] = None) -> SyncJob:
+        """Queue a historical backfill that runs behind realtime and incremental work"""
+        state = self.facilities.get(facility_id)
+        if state is None:
+            raise KeyError(facility_id)
+        if PRIORITY_BACKFILL in state.active_jobs:
+            raise ValueError(f"Facility {facility_id} already has a backfill in progress")
+        job = SyncJob(facility_id, state.schedule.patient_ids, date_from, date_to or datetime.utcnow(),
+                      self.slice_size, PRIORITY_BACKFILL, data_types)
+        return self._submit(state, job)
+
+    def track_job(self, job: SyncJob) -> SyncJob:
+        """Record a job run outside the scheduler queues so it shows up in job status"""
+        self.jobs[job.job_id] = job
+        self._prune_jobs()
+        return job
+
+    def get_job(self, job_id: str) -> Optional[SyncJob]:
+        return self.jobs.get(job_id)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "max_concurrency": self.max_concurrency,
+            "realtime_workers": self.realtime_workers,
+            "slice_size": self.slice_size,
+            "queued_jobs": {priority: len(queue) for priority, queue in self._ready.items()},
+            "facilities": [state.to_dict() for state in self.facilities.values()]
+        }
+
+    async def start(self):
+        """Start the timer loop and worker pool"""
+        if self.running:
+            return
+        self._tasks.append(asyncio.create_task(self._timer_loop()))
+        for worker_id in range(self.realtime_workers):
+            self._tasks.append(asyncio.create_task(self._worker(worker_id, realtime_only=True)))
+        for worker_id in range(self.realtime_workers, self.realtime_workers + self.max_concurrency):
+            self._tasks.append(asyncio.create_task(self._worker(worker_id, realtime_only=False)))
+        logger.info(f"Sync scheduler started with {self.max_concurrency} workers "
+                    f"and {self.realtime_workers} reserved realtime workers")
+
+    async def stop(self):
+        """Cancel the timer loop and workers, releasing the leases of unfinished jobs"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in list(self.jobs.values()):
+            await self._release_leases(job)
+        logger.info("Sync scheduler stopped")
+
+    def _next_interval(self, schedule: Any) -> timedelta:
+        """Base interval with +/- jitter so facilities drift apart instead of aligning"""
+        base = schedule.interval_minutes * 60
+        jitter = base * self.jitter_ratio
+        return timedelta(seconds=max(1.0, base + random.uniform(-jitter, jitter)))
+
+    def _enqueue_job(self, state: FacilityState, now: datetime) -> SyncJob:
+        schedule = state.schedule
+        job = SyncJob(schedule.facility_id, schedule.patient_ids, state.last_synced_at, now, self.slice_size)
+        state.next_run_at = now + self._next_interval(schedule)
+        return self._submit(state, job)
+
+    async def _enqueue_realtime(self, now: datetime):
+        """Queue vitals-only jobs for each facility's patients currently triaged as urgent"""
+        try:
+            urgent_by_facility = await self.urgent_patients_provider()
+        except Exception as e:
+            logger.error(f"Failed to load urgent patients for realtime sync: {e}")
+            return
+        if not urgent_by_facility:
+            return
+
+        for state in list(self.facilities.values()):
+            schedule = state.schedule
+            if not schedule.include_vitals or PRIORITY_REALTIME in state.active_jobs:
+                continue
+            urgent_ids = set(urgent_by_facility.get(schedule.facility_id, ()))
+            if schedule.patient_ids:
+                patient_ids = [patient_id for patient_id in schedule.patient_ids if patient_id in urgent_ids]
+            else:
+                patient_ids = sorted(urgent_ids)
+            if not patient_ids:
+                continue
+            date_from = state.last_realtime_at or state.last_synced_at
+            job = SyncJob(schedule.facility_id, patient_ids, date_from, now, self.slice_size,
+                          PRIORITY_REALTIME, ["vitals"])
+            self._submit(state, job)
+
+    def _submit(self, state: FacilityState, job: SyncJob) -> SyncJob:
+        self.jobs[job.job_id] = job
+        self._prune_jobs()
+        state.active_jobs[job.priority] = job
+        self._push(job)
+        return job
+
+    def _push(self, job: SyncJob):
+        job.enqueued_at = datetime.utcnow()
+        self._ready[job.priority].append(job)
+        self._ready_event.set()
+        if job.priority == PRIORITY_REALTIME:
+            self._realtime_event.set()
+
+    def _next_job(self, realtime_only: bool) -> Optional[SyncJob]:
+        """Pick the next job slice, highest class first unless a lower class's head has waited too long"""
+        classes = [PRIORITY_REALTIME] if realtime_only else PRIORITY_CLASSES
+        now = datetime.utcnow()
+
+        chosen = None
+        for priority in reversed(classes):
+            queue = self._ready[priority]
+            if queue and (now - queue[0].enqueued_at).total_seconds() >= self.max_wait_seconds:
+                chosen = priority
+                break
+        if chosen is None:
+            chosen = next((priority for priority in classes if self._ready[priority]), None)
+        if chosen is None:
+            return None
+        return self._ready[chosen].popleft()
+
+    def _prune_jobs(self):
+        """Drop the oldest finished jobs once the history limit is exceeded"""
+        excess = len(self.jobs) - SCHEDULER_JOB_HISTORY
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.is_finished][:excess]:
+            del self.jobs[job_id]
+
+    async def _timer_loop(self):
+        while True:
+            now = datetime.utcnow()
+            for state in list(self.facilities.values()):
+                # Skip a due facility whose previous job is still running rather than piling up jobs
+                if state.next_run_at <= now and PRIORITY_INCREMENTAL not in state.active_jobs:
+                    self._enqueue_job(state, now)
+            if self.urgent_patients_provider and now >= self._next_realtime_at:
+                self._next_realtime_at = now + timedelta(seconds=self.realtime_seconds)
+                await self._enqueue_realtime(now)
+            await asyncio.sleep(self.tick_seconds)
+
+    async def _worker(self, worker_id: int, realtime_only: bool):
+        event = self._realtime_event if realtime_only else self._ready_event
+        while True:
+            await event.wait()
+            job = self._next_job(realtime_only)
+            if job is None:
+                event.clear()
+                continue
+
+            state = self.facilities.get(job.facility_id)
+            if state is None or state.active_jobs.get(job.priority) is not job:
+                # Finished here so the job history can prune it
+                job.status = "cancelled"
+                job.completed_at = datetime.utcnow()
+                job.errors.append("facility was unregistered" if state is None
+                                  else "facility was re-registered with a newer job")
+                await self._release_leases(job)
+                continue
+
+            await self._run_slice(state, job)
+
+            if job.has_pending_slices:
+                # Back of its class queue so other facilities get a turn between slices
+                self._push(job)
+            else:
+                self._finish_job(job)
+                await self._release_leases(job)
+
+    async def _run_slice(self, state: FacilityState, job: SyncJob):
+        if job.started_at is None:
+            job.started_at = datetime.utcnow()
+            job.status = "running"
+            if self.lease_manager is not None:
+                job.leases = self.lease_manager.lease_set(lease_facility_key(state.schedule.hms_credentials))
+
+        patient_slice = job.next_slice()
+        try:
+            counts = await self.sync_handler(state.schedule, patient_slice, job.date_from, job.date_to,
+                                             job.data_types, job.leases)
+            job.record(counts)
+        except LeaseUnavailable as e:
+            logger.info(f"Deferring {job.priority} sync slice for facility {job.facility_id}: {e}")
+            job.record(e.counts)
+            job.deferred.extend(data_type for data_type in e.data_types if data_type not in job.deferred)
+        except Exception as e:
+            logger.error(f"Scheduled {job.priority} sync slice failed for facility {job.facility_id}: {e}")
+            job.errors.append(str(e))
+        job.slices_done += 1
+
+    async def _release_leases(self, job: SyncJob):
+        if job.leases is not None:
+            leases, job.leases = job.leases, None
+            try:
+                await leases.release()
+            except Exception as e:
+                logger.warning(f"Releasing sync leases of job {job.job_id} failed: {e}")
+
+    def _finish_job(self, job: SyncJob):
+        # Looked up again: the facility may have been re-registered (a new state) while the slice ran
+        state = self.facilities.get(job.facility_id)
+        job.completed_at = datetime.utcnow()
+        if job.errors:
+            # Keep the old watermark so the next run re-covers this window
+            job.status = "failed"
+        elif job.deferred:
+            # Another replica owned part of the window; cover it again next run
+            job.status = "deferred"
+        else:
+            job.status = "completed"
+            if state is not None and job.priority == PRIORITY_INCREMENTAL:
+                state.last_synced_at = job.date_to
+            elif state is not None and job.priority == PRIORITY_REALTIME:
+                state.last_realtime_at = job.date_to
+        if state is not None and state.active_jobs.get(job.priority) is job:
+            state.active_jobs.pop(job.priority)
+        logger.info(f"{job.priority} sync job {job.job_id} for facility {job.facility_id} "
+                    f"{job.status}: {job.records_synced}")
@@ -0,0 +1,130 @@
+"""
+Sharded parallel sync across worker processes
+Partitions a sync job by patient ID hash and runs one pipeline per shard in a process pool
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from triage_rules import current_facility
+
+logger = logging.getLogger(__name__)
+
+SHARD_PROCESSES = int(os.getenv("HMS_SYNC_SHARD_PROCESSES") or os.cpu_count() or 2)
+
+
+def shard_for(patient_id: str, shards: int) -> int:
+    """Stable shard index for a patient; Python's hash() is salted per process so it cannot be used"""
+    digest = hashlib.blake2b(patient_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+def partition_patients(patient_ids: List[str], shards: int) -> List[List[str]]:
+    """Group patient IDs by shard, dropping empty shards"""
+    partitions: List[List[str]] = [[] for _ in range(shards)]
+    for patient_id in patient_ids:
+        partitions[shard_for(patient_id, shards)].append(patient_id)
+    return [partition for partition in partitions if partition]
+
+
+def _run_shard(credentials: Dict[str, Any], facility: Optional[str], data_types: List[str], patient_ids: List[str],
+               date_from: Optional[datetime], date_to: Optional[datetime]) -> Dict[str, Dict[str, int]]:
+    """Process pool entry point: run the fetch/write pipeline for one shard"""
+    return asyncio.run(_run_shard_async(credentials, facility, data_types, patient_ids, date_from, date_to))
+
+
+async def _run_shard_async(credentials: Dict[str, Any], facility: Optional[str], data_types: List[str],
+                           patient_ids: List[str], date_from: Optional[datetime],
+                           date_to: Optional[datetime]) -> Dict[str, Dict[str, int]]:
+    # Imported in the worker only; none of these load the API in main
+    from hms_clients import HMSCredentials, create_hms_client
+    from news2 import news2_tracker
+    from sync_pipeline import run_sync_pipeline
+    from sync_registry import SYNC_DATA_TYPES, db_mapper
+    from vitals_baseline import vitals_baselines
+
+    hms_credentials = HMSCredentials(**credentials)
+    hms_client = create_hms_client(hms_credentials)
+    if not await hms_client.authenticate():
+        raise RuntimeError("HMS authentication failed in shard worker")
+    # Resolved by the parent, which knows the registered facilities
+    current_facility.set(facility)
+    # Pool processes are reused across jobs; other processes may have moved these patients on since
+    vitals_baselines.invalidate(patient_ids)
+    news2_tracker.forget(patient_ids)
+
+    results = {}
+    try:
+        for data_type in data_types:
+            stats = await run_sync_pipeline(hms_client, SYNC_DATA_TYPES[data_type], patient_ids, date_from, date_to)
+            results[data_type] = {
+                "fetched": stats.get("fetch"),
+                "written": stats.get("write"),
+                "rejected": stats.rejected
+            }
+        # This process's baselines would otherwise wait for a save that never comes
+        await db_mapper.save_vitals_baselines()
+    finally:
+        # The pool belongs to this shard's event loop; the next shard runs on a new one
+        await db_mapper.close()
+    return results
+
+
+class ShardedSyncRunner:
+    """Runs sync jobs split by patient hash across a pool of worker processes
+
+    Each shard authenticates and runs its own pipeline, so JSON parsing and
+    model validation for different shards happen on different cores. Shard
+    results are folded into the tracking job as each one finishes.
+    """
+
+    def __init__(self, processes: int = SHARD_PROCESSES):
+        self.processes = max(1, processes)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Spawn rather than fork: forking a process with a running event loop and open sockets is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, job: Any, credentials: Dict[str, Any], data_types: List[str],
+                  shards: List[List[str]], facility: Optional[str] = None) -> Any:
+        """Run every shard of a job and aggregate counts into it; facility is the key shards triage under"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+
+        futures = [
+            loop.run_in_executor(executor, _run_shard, credentials, facility, data_types, patient_ids,
+                                 job.date_from, job.date_to)
+            for patient_ids in shards
+        ]
+        for future in asyncio.as_completed(futures):
+            try:
+                shard_results = await future
+                job.record({data_type: counts["written"] for data_type, counts in shard_results.items()})
+            except Exception as e:
+                logger.error(f"Sync shard for job {job.job_id} failed: {e}")
+                job.errors.append(str(e))
+            job.slices_done += 1
+
+        job.completed_at = datetime.utcnow()
+        job.status = "failed" if job.errors else "completed"
+        logger.info(f"Sharded sync job {job.job_id} {job.status} across {len(shards)} shards: {job.records_synced}")
+        return job
@@ -0,0 +1,113 @@
+"""
+Equivalence of the configurable triage rules with the original scalar thresholds
+The built-in "default" rule set must give the priority the old if-chain gave
+"""
+
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from triage_rules import DEFAULT_TRIAGE_RULES, TRIAGE_VITALS, TriageEngine
+
+VITALS = ["systolic_bp", "heart_rate", "temperature", "oxygen_saturation"]
+
+
+def calculate_triage_priority(vital) -> str:
+    """The scalar rules triage_rules replaced, as they stood in database_mapper"""
+    high_priority_conditions = []
+
+    if vital.systolic_bp and (vital.systolic_bp > 180 or vital.systolic_bp < 90):
+        high_priority_conditions.append("critical_bp")
+
+    if vital.heart_rate and (vital.heart_rate > 120 or vital.heart_rate < 50):
+        high_priority_conditions.append("critical_hr")
+
+    if vital.temperature and vital.temperature > 39.0:
+        high_priority_conditions.append("high_fever")
+
+    if vital.oxygen_saturation and vital.oxygen_saturation < 92:
+        high_priority_conditions.append("low_o2")
+
+    if high_priority_conditions:
+        return "urgent"
+    elif vital.systolic_bp and vital.systolic_bp > 160:
+        return "semi_urgent"
+    else:
+        return "routine"
+
+
+def engine_priority(engine: TriageEngine, readings: dict, facility=None) -> str:
+    frame = pd.DataFrame([readings], columns=TRIAGE_VITALS, dtype=float)
+    return engine.evaluate(frame, facility=facility)[0]
+
+
+@pytest.fixture
+def engine() -> TriageEngine:
+    return TriageEngine(DEFAULT_TRIAGE_RULES)
+
+
+@pytest.mark.parametrize("readings", [
+    {},
+    {"systolic_bp": None, "heart_rate": None, "temperature": None, "oxygen_saturation": None},
+    {"systolic_bp": 0, "heart_rate": 0, "temperature": 0, "oxygen_saturation": 0},
+    {"systolic_bp": 0},
+    {"heart_rate": 0},
+    {"oxygen_saturation": 0, "temperature": 36.8},
+    {"systolic_bp": 120, "heart_rate": 80, "temperature": 36.8, "oxygen_saturation": 98},
+    {"systolic_bp": 180},
+    {"systolic_bp": 180.1},
+    {"systolic_bp": 90},
+    {"systolic_bp": 89.9},
+    {"systolic_bp": 160},
+    {"systolic_bp": 161},
+    {"systolic_bp": 170, "heart_rate": 130},
+    {"heart_rate": 120},
+    {"heart_rate": 121},
+    {"heart_rate": 50},
+    {"heart_rate": 49},
+    {"temperature": 39.0},
+    {"temperature": 39.1},
+    {"temperature": 34.0},
+    {"oxygen_saturation": 92},
+    {"oxygen_saturation": 91},
+    {"systolic_bp": None, "heart_rate": 0, "temperature": 39.5, "oxygen_saturation": None},
+    {"systolic_bp": 165, "oxygen_saturation": 0},
+    {"systolic_bp": 165, "heart_rate": 0, "temperature": None},
+])
+def test_default_rules_match_scalar_thresholds(engine, readings):
+    vital = SimpleNamespace(**{name: readings.get(name) for name in VITALS})
+    assert engine_priority(engine, readings) == calculate_triage_priority(vital)
+
+
+def test_default_rules_match_scalar_thresholds_in_batch(engine):
+    rng = np.random.default_rng(46)
+    rows = 5000
+    frame = pd.DataFrame({
+        "systolic_bp": rng.choice([0, 89, 90, 120, 160, 161, 180, 181], rows),
+        "heart_rate": rng.choice([0, 49, 50, 80, 120, 121], rows),
+        "temperature": rng.choice([0, 36.5, 39.0, 39.2], rows),
+        "oxygen_saturation": rng.choice([0, 91, 92, 97], rows),
+    }, dtype=float)
+    # Missing readings as well as zero ones
+    frame = frame.mask(rng.random(frame.shape) < 0.2)
+
+    expected = [
+        calculate_triage_priority(SimpleNamespace(**{
+            name: None if pd.isna(value) else value for name, value in row.items()
+        }))
+        for row in frame.to_dict("records")
+    ]
+    assert engine.evaluate(frame).tolist() == expected
+
+
+def test_unknown_facility_uses_default_rules_and_warns(engine, caplog):
+    readings = {"systolic_bp": 170}
+    with caplog.at_level(logging.WARNING, logger="triage_rules"):
+        assert engine_priority(engine, readings, facility="unregistered") == "semi_urgent"
+        engine_priority(engine, readings, facility="unregistered")
+    assert [record.message for record in caplog.records] == [
+        "No triage rules for facility unregistered; using the default rules"
+    ]
@@ -0,0 +1,156 @@
+"""
+In-memory triage queue per facility
+Orders queued patients by triage priority, then arrival (queue_position from
+a Postgres sequence), in a heap so enqueue and reprioritization are O(log n)
+"""
+
+import heapq
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from triage_rules import triage_engine
+
+logger = logging.getLogger(__name__)
+
+TRIAGE_QUEUE_REFRESH_SECONDS = float(os.getenv("HMS_TRIAGE_QUEUE_REFRESH_SECONDS", "300"))
+
+# Arrival order shared by every replica and writer. The sequence is seeded from the positions already
+# in patient_queue only when it is created; a later setval could move it behind positions that other
+# writers have taken since. The advisory lock makes one replica the creator.
+QUEUE_SEQUENCE_SCHEMA = """
+    DO $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('hms_queue_position_seq'));
+        IF to_regclass('hms_queue_position_seq') IS NULL THEN
+            CREATE SEQUENCE hms_queue_position_seq;
+            PERFORM setval('hms_queue_position_seq',
+                GREATEST((SELECT COALESCE(MAX(queue_position), 0) FROM patient_queue), 1));
+        END IF;
+    END $$;
+"""
+
+DEFAULT_FACILITY = "default"
+
+
+class FacilityQueue:
+    """Heap of [rank, queue_position, patient_id, priority, live] entries
+
+    Reprioritizing a patient marks their old entry dead and pushes a new
+    one; dead entries are skipped when reading and dropped when they
+    outnumber the live ones.
+    """
+
+    def __init__(self):
+        self._heap: List[list] = []
+        self._entries: Dict[str, list] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def push(self, patient_id: str, rank: int, position: int, priority: str):
+        entry = self._entries.get(patient_id)
+        if entry is not None:
+            if entry[0] == rank and entry[1] == position:
+                return
+            entry[4] = False
+        entry = [rank, position, patient_id, priority, True]
+        self._entries[patient_id] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def remove(self, patient_id: str):
+        entry = self._entries.pop(patient_id, None)
+        if entry is not None:
+            entry[4] = False
+
+    def ordered(self, limit: int) -> List[list]:
+        """The first limit live entries, most urgent first
+
+        Walks the heap from the root through a frontier of candidate nodes,
+        so only the entries above the cut are visited: O(limit log limit)
+        plus the dead entries met on the way.
+        """
+        heap = self._heap
+        result: List[list] = []
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier and len(result) < limit:
+            entry, index = heapq.heappop(frontier)
+            if entry[4]:
+                result.append(entry)
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+        return result
+
+
+class TriageQueueManager:
+    """Triage queues by facility (the key current_facility carries), "default" for none"""
+
+    def __init__(self):
+        self._queues: Dict[str, FacilityQueue] = {}
+        self._facility_of: Dict[str, str] = {}
+        self._updated_at: Dict[str, datetime] = {}
+        self.loaded = False
+
+    def enqueue(self, facility: Optional[str], patient_id: str, priority: str, position: int,
+                updated_at: datetime):
+        """Add or reprioritize a queued patient, unless a newer write for them was already applied"""
+        known = self._updated_at.get(patient_id)
+        if known is not None and known > updated_at:
+            return
+        self._updated_at[patient_id] = updated_at
+        facility = facility or DEFAULT_FACILITY
+        previous = self._facility_of.get(patient_id)
+        if previous is not None and previous != facility:
+            self._queues[previous].remove(patient_id)
+        self._facility_of[patient_id] = facility
+        queue = self._queues.get(facility)
+        if queue is None:
+            queue = self._queues[facility] = FacilityQueue()
+        queue.push(patient_id, triage_engine.priority_rank(priority, facility), position, priority)
+
+    def remove(self, patient_id: str):
+        """Take a patient off their facility's queue"""
+        facility = self._facility_of.pop(patient_id, None)
+        self._updated_at.pop(patient_id, None)
+        if facility is not None:
+            self._queues[facility].remove(patient_id)
+
+    def load(self, rows: List[Tuple[str, int, str, Optional[str], datetime]], read_started: datetime):
+        """Bring the queues up to date with all patient_queue rows
+
+        Rows are (patient_id, queue_position, triage_priority, facility,
+        updated_at); writes applied while the rows were being read win.
+        Patients missing from the rows were removed from patient_queue and
+        are dropped, unless they were written here after read_started.
+        """
+        present = set()
+        for patient_id, position, priority, facility, updated_at in rows:
+            present.add(patient_id)
+            self.enqueue(facility, patient_id, priority, position, updated_at)
+        for patient_id in [patient_id for patient_id, updated_at in self._updated_at.items()
+                           if patient_id not in present and updated_at < read_started]:
+            self.remove(patient_id)
+        self.loaded = True
+
+    def ordered(self, facility: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        queue = self._queues.get(facility or DEFAULT_FACILITY)
+        if queue is None:
+            return []
+        return [
+            {"patient_id": patient_id, "triage_priority": priority, "queue_position": position}
+            for _, position, patient_id, priority, _ in queue.ordered(limit)
+        ]
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "loaded": self.loaded,
+            "facilities": {facility: len(queue) for facility, queue in self._queues.items()}
+        }
+
+
+triage_queue = TriageQueueManager()
@@ -0,0 +1,177 @@
+"""
+Configurable triage rules for synced vitals
+Rule sets per facility and age band are loaded from config and compiled into
+threshold arrays that score a whole batch of readings with NumPy
+"""
+
+import json
+import logging
+import os
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+TRIAGE_RULES_PATH = os.getenv("HMS_TRIAGE_RULES")
+
+TRIAGE_VITALS = ["systolic_bp", "diastolic_bp", "heart_rate", "temperature", "respiratory_rate",
+                 "oxygen_saturation", "weight", "height", "bmi"]
+DEFAULT_PRIORITY = "routine"
+
+# Facility whose vitals are being written; set by the sync entry points and
+# inherited by the pipeline tasks they start
+current_facility: ContextVar[Optional[str]] = ContextVar("current_facility", default=None)
+
+# The thresholds the service has always applied, as the "default" facility
+DEFAULT_TRIAGE_RULES: Dict[str, Any] = {
+    "default": {
+        "rules": [
+            {"priority": "urgent", "any": [
+                {"vital": "systolic_bp", "above": 180}, {"vital": "systolic_bp", "below": 90},
+                {"vital": "heart_rate", "above": 120}, {"vital": "heart_rate", "below": 50},
+                {"vital": "temperature", "above": 39.0},
+                {"vital": "oxygen_saturation", "below": 92},
+            ]},
+            {"priority": "semi_urgent", "any": [
+                {"vital": "systolic_bp", "above": 160},
+            ]},
+        ]
+    }
+}
+
+
+class CompiledRuleSet:
+    """Ordered priority rules compiled to per-condition column indexes and bounds
+
+    A condition is met when its reading is present (not missing or zero)
+    and strictly above its "above" or below its "below" bound. The first
+    priority with any condition met wins.
+    """
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self.rules = rules
+        self.priorities = [rule["priority"] for rule in rules]
+        self._compiled: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        for rule in rules:
+            conditions = rule.get("any") or []
+            unknown = {condition["vital"] for condition in conditions} - set(TRIAGE_VITALS)
+            if unknown:
+                raise ValueError(f"Triage rule for {rule['priority']} uses unknown vitals: {', '.join(sorted(unknown))}")
+            self._compiled.append((
+                np.array([TRIAGE_VITALS.index(condition["vital"]) for condition in conditions], dtype=np.intp),
+                np.array([condition.get("above", np.inf) for condition in conditions], dtype=float),
+                np.array([condition.get("below", -np.inf) for condition in conditions], dtype=float),
+            ))
+
+    def evaluate(self, values: np.ndarray, present: np.ndarray) -> np.ndarray:
+        """Index into self.priorities per row, -1 where no rule matched"""
+        matched = np.full(len(values), -1, dtype=np.intp)
+        # Apply the lowest priority first so earlier rules overwrite later ones
+        for index in reversed(range(len(self._compiled))):
+            columns, above, below = self._compiled[index]
+            if not len(columns):
+                continue
+            readings = values[:, columns]
+            hit = (present[:, columns] & ((readings > above) | (readings < below))).any(axis=1)
+            matched[hit] = index
+        return matched
+
+
+class FacilityRules:
+    """Base rules for a facility plus overrides for age bands [min_age, max_age)"""
+
+    def __init__(self, name: str, config: Dict[str, Any]):
+        self.name = name
+        self.base = CompiledRuleSet(config.get("rules") or [])
+        self.age_bands: List[Tuple[float, float, CompiledRuleSet]] = []
+        for band in config.get("age_bands") or []:
+            min_age = band.get("min_age")
+            max_age = band.get("max_age")
+            self.age_bands.append((
+                -np.inf if min_age is None else float(min_age),
+                np.inf if max_age is None else float(max_age),
+                CompiledRuleSet(band.get("rules") or []),
+            ))
+        # Most to least urgent: base rule order, then priorities only age bands use, then the default
+        order = list(self.base.priorities)
+        for _, _, rule_set in self.age_bands:
+            order += [priority for priority in rule_set.priorities if priority not in order]
+        if DEFAULT_PRIORITY not in order:
+            order.append(DEFAULT_PRIORITY)
+        self.priority_ranks = {priority: rank for rank, priority in enumerate(order)}
+
+    def evaluate(self, values: np.ndarray, present: np.ndarray, ages: Optional[np.ndarray]) -> np.ndarray:
+        labels = np.array(self.base.priorities + [DEFAULT_PRIORITY], dtype=object)
+        priorities = labels[self.base.evaluate(values, present)]
+        if ages is None:
+            return priorities
+        # Rows with an unknown age (NaN) fall outside every band and keep the base rules
+        for min_age, max_age, rule_set in self.age_bands:
+            in_band = (ages >= min_age) & (ages < max_age)
+            if not in_band.any():
+                continue
+            band_labels = np.array(rule_set.priorities + [DEFAULT_PRIORITY], dtype=object)
+            priorities[in_band] = band_labels[rule_set.evaluate(values[in_band], present[in_band])]
+        return priorities
+
+
+class TriageEngine:
+    """Triage rule sets by facility, with a "default" facility for everyone else
+
+    Facilities are keyed by the scheduler's facility_id; on-demand and
+    sharded syncs resolve their HMS base URL to it, and uploads and pushes
+    name it explicitly. A facility without its own rules is scored with the
+    default rules, and a warning is logged the first time that happens.
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        if "default" not in config:
+            raise ValueError("Triage rules need a \"default\" facility")
+        self.config = config
+        self.facilities = {name: FacilityRules(name, rules) for name, rules in config.items()}
+        self._unconfigured: set = set()
+
+    @classmethod
+    def from_file(cls, path: Optional[str]) -> "TriageEngine":
+        """Load rules from a JSON object of facility -> {rules, age_bands}"""
+        if not path:
+            return cls(DEFAULT_TRIAGE_RULES)
+        with open(path) as f:
+            config = json.load(f)
+        engine = cls(config)
+        logger.info(f"Loaded triage rules for {len(config)} facilities from {path}")
+        return engine
+
+    def rules_for(self, facility: Optional[str] = None) -> FacilityRules:
+        rules = self.facilities.get(facility or "default")
+        if rules is not None:
+            return rules
+        if facility not in self._unconfigured:
+            self._unconfigured.add(facility)
+            logger.warning(f"No triage rules for facility {facility}; using the default rules")
+        return self.facilities["default"]
+
+    def priority_rank(self, priority: Optional[str], facility: Optional[str] = None) -> int:
+        """Position of a priority in the facility's urgency order; unknown priorities come last"""
+        ranks = self.rules_for(facility).priority_ranks
+        return ranks.get(priority, len(ranks))
+
+    def uses_age(self, facility: Optional[str] = None) -> bool:
+        """Whether the facility's rules need patient ages"""
+        return bool(self.rules_for(facility).age_bands)
+
+    def evaluate(self, readings: pd.DataFrame, ages: Optional[np.ndarray] = None,
+                 facility: Optional[str] = None) -> np.ndarray:
+        """Priority per row of a frame of vital columns (missing columns count as absent)"""
+        values = readings.reindex(columns=TRIAGE_VITALS).to_numpy(dtype=float, na_value=np.nan)
+        present = ~np.isnan(values) & (values != 0)
+        return self.rules_for(facility).evaluate(values, present, ages)
+
+    def status(self) -> Dict[str, Any]:
+        return {"facilities": self.config}
+
+
+triage_engine = TriageEngine.from_file(TRIAGE_RULES_PATH)
@@ -0,0 +1,376 @@
+"""
+Per-patient vitals baselines for anomaly flagging
+Keeps an EWMA mean/variance and a ring buffer of recent readings for every
+patient and vital in preallocated NumPy arrays, updated in O(1) per reading
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+ANOMALY_ALPHA = float(os.getenv("HMS_ANOMALY_ALPHA", "0.1"))
+ANOMALY_Z = float(os.getenv("HMS_ANOMALY_Z", "4.0"))
+ANOMALY_MIN_READINGS = max(1, int(os.getenv("HMS_ANOMALY_MIN_READINGS", "5")))
+ANOMALY_WINDOW = int(os.getenv("HMS_ANOMALY_WINDOW", "8"))
+BASELINE_PERSIST_SECONDS = float(os.getenv("HMS_BASELINE_PERSIST_SECONDS", "60"))
+# Patients kept in memory; beyond this the least recently used saved baselines are dropped and reloaded on demand
+BASELINE_MAX_PATIENTS = int(os.getenv("HMS_BASELINE_MAX_PATIENTS", "100000"))
+
+# Vitals with a baseline, and the smallest standard deviation assumed for each so
+# a patient whose readings never varied is not flagged for ordinary noise
+BASELINE_VITALS = {
+    "systolic_bp": 5.0,
+    "diastolic_bp": 4.0,
+    "heart_rate": 4.0,
+    "temperature": 0.2,
+    "respiratory_rate": 2.0,
+    "oxygen_saturation": 1.0,
+    "weight": 1.0,
+}
+
+
+def _epoch_seconds(times: List[datetime]) -> np.ndarray:
+    return pd.to_datetime(pd.Series(times)).to_numpy(dtype="datetime64[ns]").astype(np.int64) / 1e9
+
+
+BASELINE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hms_vitals_baselines (
+        patient_id text PRIMARY KEY,
+        window_size smallint NOT NULL,
+        stats bytea NOT NULL,
+        updated_at timestamp NOT NULL DEFAULT (now() at time zone 'utc')
+    );
+    ALTER TABLE hms_vitals_baselines ADD COLUMN IF NOT EXISTS observed_until timestamp;
+    ALTER TABLE hms_vitals_baselines ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;
+"""
+
+
+class VitalsBaselines:
+    """Rolling statistics per patient and vital, one row of each array per patient
+
+    A reading is flagged when the patient has at least min_readings of that
+    vital, its distance from the EWMA mean exceeds z_threshold standard
+    deviations, and it falls outside the range of the last window readings.
+    Flagged readings still update the baseline, so a sustained change
+    becomes the patient's new normal.
+
+    observe() scores a batch without changing any baseline and returns the
+    updated baselines; commit() applies them for the patients whose
+    readings were stored. Readings at or before the last one a patient's
+    baseline has seen (e.g. a re-synced batch) are scored but not folded in
+    again.
+
+    Patients are persisted as one packed bytea row (see pack/unpack) and
+    loaded the first time a sync writes vitals for them. Each row carries a
+    version, bumped on every save, so a process holding an outdated copy
+    (e.g. after shard workers moved the patient on) cannot overwrite a newer
+    row; such patients are dropped and reloaded instead. Beyond max_patients
+    the least recently used patients with nothing unsaved are dropped.
+    """
+
+    def __init__(self, alpha: float = ANOMALY_ALPHA, z_threshold: float = ANOMALY_Z,
+                 min_readings: int = ANOMALY_MIN_READINGS, window: int = ANOMALY_WINDOW,
+                 capacity: int = 1024, max_patients: int = BASELINE_MAX_PATIENTS):
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.min_readings = min_readings
+        self.window_size = window
+        self.vitals = list(BASELINE_VITALS)
+        self.floor_variance = np.square(np.array(list(BASELINE_VITALS.values()), dtype=float))
+        self.stats_size = len(self.vitals) * (8 + 8 + 4 + 4 * window)
+
+        self.max_patients = max_patients
+        # patient_id -> row of the arrays, least recently used first
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._free: List[int] = []
+        self._dirty: set = set()
+        vitals = len(self.vitals)
+        self.mean = np.zeros((capacity, vitals))
+        self.variance = np.zeros((capacity, vitals))
+        self.count = np.zeros((capacity, vitals), dtype=np.uint32)
+        self.window = np.full((capacity, vitals, window), np.nan, dtype=np.float32)
+        # Newest reading folded into each baseline, in epoch seconds
+        self.observed_until = np.full(capacity, -np.inf)
+        # Version of the persisted row each baseline was loaded from or last saved as, and
+        # which allocation of the slot it belongs to
+        self.version = np.zeros(capacity, dtype=np.int64)
+        self.generation = np.zeros(capacity, dtype=np.int64)
+        self._allocations = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _allocate(self, patient_id: str, keep: frozenset = frozenset()) -> int:
+        if len(self._slots) >= self.max_patients:
+            self._evict(len(self._slots) - self.max_patients + 1, keep)
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._slots)
+            if slot == len(self.mean):
+                grow = len(self.mean)
+                self.mean = np.concatenate([self.mean, np.zeros_like(self.mean[:grow])])
+                self.variance = np.concatenate([self.variance, np.zeros_like(self.variance[:grow])])
+                self.count = np.concatenate([self.count, np.zeros_like(self.count[:grow])])
+                self.window = np.concatenate([self.window, np.full_like(self.window[:grow], np.nan)])
+                self.observed_until = np.concatenate([self.observed_until, np.full(grow, -np.inf)])
+                self.version = np.concatenate([self.version, np.zeros_like(self.version[:grow])])
+                self.generation = np.concatenate([self.generation, np.zeros_like(self.generation[:grow])])
+        self._allocations += 1
+        self.generation[slot] = self._allocations
+        self._slots[patient_id] = slot
+        return slot
+
+    def _release(self, patient_id: str):
+        slot = self._slots.pop(patient_id)
+        self._dirty.discard(patient_id)
+        self.mean[slot] = 0
+        self.variance[slot] = 0
+        self.count[slot] = 0
+        self.window[slot] = np.nan
+        self.observed_until[slot] = -np.inf
+        self.version[slot] = 0
+        self._free.append(slot)
+
+    def _evict(self, needed: int, keep: frozenset):
+        """Drop up to needed least recently used patients whose baselines are saved, other than keep"""
+        evicted = []
+        for patient_id in self._slots:
+            if len(evicted) == needed:
+                break
+            if patient_id not in self._dirty and patient_id not in keep:
+                evicted.append(patient_id)
+        for patient_id in evicted:
+            self._release(patient_id)
+
+    def invalidate(self, patient_ids: List[str]):
+        """Drop baselines another process has moved on, so they are reloaded before their next use"""
+        for patient_id in set(patient_ids):
+            if patient_id in self._slots:
+                self._release(patient_id)
+
+    def unloaded(self, patient_ids: List[str]) -> List[str]:
+        """Patients not yet in memory, whose persisted baselines should be loaded first"""
+        return [patient_id for patient_id in set(patient_ids) if patient_id not in self._slots]
+
+    def pack(self, slot: int) -> bytes:
+        """Mean, variance, count and window of one patient as little-endian bytes"""
+        return b"".join((
+            self.mean[slot].astype("<f8").tobytes(),
+            self.variance[slot].astype("<f8").tobytes(),
+            self.count[slot].astype("<u4").tobytes(),
+            self.window[slot].astype("<f4").tobytes(),
+        ))
+
+    def unpack(self, slot: int, stats: bytes):
+        vitals = len(self.vitals)
+        offset = 0
+        for target, dtype, size in ((self.mean, "<f8", vitals), (self.variance, "<f8", vitals),
+                                    (self.count, "<u4", vitals),
+                                    (self.window, "<f4", vitals * self.window_size)):
+            values = np.frombuffer(stats, dtype=dtype, count=size, offset=offset)
+            target[slot] = values.reshape(target.shape[1:])
+            offset += values.nbytes
+
+    def load(self, patient_ids: List[str], rows: List[Tuple[str, int, bytes, Optional[datetime], int]]):
+        """Take persisted (patient_id, window_size, stats, observed_until, version) rows; patients without one start empty
+
+        Rows for a different window size or vital set start empty too rather
+        than being misread, but keep their version so the next save replaces
+        them. Patients that reached memory meanwhile are left alone.
+        """
+        persisted = {row[0]: row for row in rows}
+        for patient_id in patient_ids:
+            if patient_id in self._slots:
+                continue
+            slot = self._allocate(patient_id)
+            if patient_id not in persisted:
+                continue
+            _, window_size, stats, observed_until, version = persisted[patient_id]
+            self.version[slot] = version
+            if window_size == self.window_size and len(stats) == self.stats_size:
+                self.unpack(slot, stats)
+                if observed_until is not None:
+                    self.observed_until[slot] = _epoch_seconds([observed_until])[0]
+
+    def observe(self, readings: pd.DataFrame, patient_ids: List[str],
+                recorded_at: List[datetime]) -> Tuple[List[Optional[Dict[str, Any]]], Dict[str, tuple]]:
+        """Score a batch of readings against the baselines; anomalies per row and the pending baselines
+
+        Readings are applied in time order on copies of the patients'
+        baselines. Each round updates at most one reading per patient, so a
+        batch costs as many vectorized rounds as the most readings any one
+        patient has in it. Nothing changes until commit().
+        """
+        values = readings.reindex(columns=self.vitals).to_numpy(dtype=float, na_value=np.nan)
+        present = ~np.isnan(values) & (values != 0)
+        batch_patients = frozenset(patient_ids)
+        for patient_id in batch_patients:
+            if patient_id in self._slots:
+                self._slots.move_to_end(patient_id)
+            else:
+                self._allocate(patient_id, batch_patients)
+        slots = np.array([self._slots[patient_id] for patient_id in patient_ids], dtype=np.intp)
+        seconds = _epoch_seconds(recorded_at)
+
+        # Batch-local copies of the patients' baselines, indexed by position in unique_slots
+        unique_slots, local = np.unique(slots, return_inverse=True)
+        state = {
+            "mean": self.mean[unique_slots].copy(),
+            "variance": self.variance[unique_slots].copy(),
+            "count": self.count[unique_slots].copy(),
+            "window": self.window[unique_slots].copy(),
+            "observed_until": self.observed_until[unique_slots].copy(),
+            "version": self.version[unique_slots],
+            "generation": self.generation[unique_slots],
+        }
+
+        order = np.lexsort((seconds, local))
+        # Fold only readings newer than the baseline and than the patient's previous row in the batch
+        newer = seconds[order] > state["observed_until"][local[order]]
+        repeated = np.zeros(len(order), dtype=bool)
+        repeated[1:] = (local[order][1:] == local[order][:-1]) & (seconds[order][1:] == seconds[order][:-1])
+        fold = np.zeros(len(values), dtype=bool)
+        fold[order] = newer & ~repeated
+
+        flagged = np.zeros(values.shape, dtype=bool)
+        baseline = np.full(values.shape, np.nan)
+        z_scores = np.full(values.shape, np.nan)
+        rounds = np.empty(len(values), dtype=np.intp)
+        rounds[order] = pd.Series(local[order]).groupby(local[order]).cumcount().to_numpy()
+        for round_number in range(int(rounds.max()) + 1 if len(rounds) else 0):
+            rows = np.flatnonzero(rounds == round_number)
+            self._update(state, rows, local[rows], values[rows], present[rows], fold[rows],
+                         flagged, baseline, z_scores)
+        np.maximum.at(state["observed_until"], local[fold], seconds[fold])
+
+        changed = np.zeros(len(unique_slots), dtype=bool)
+        changed[local[fold & present.any(axis=1)]] = True
+        unique_patients = np.empty(len(unique_slots), dtype=object)
+        unique_patients[local] = np.asarray(patient_ids, dtype=object)
+        pending = {
+            patient_id: tuple(state[name][index]
+                              for name in ("mean", "variance", "count", "window", "observed_until", "version",
+                                           "generation"))
+            for index, patient_id in enumerate(unique_patients) if changed[index]
+        }
+
+        anomalies: List[Optional[Dict[str, Any]]] = [None] * len(values)
+        for row, column in zip(*np.nonzero(flagged)):
+            anomalies[row] = anomalies[row] or {}
+            anomalies[row][self.vitals[column]] = {
+                "value": float(values[row, column]),
+                "baseline": round(float(baseline[row, column]), 2),
+                "z": round(float(z_scores[row, column]), 1)
+            }
+        return anomalies, pending
+
+    def commit(self, pending: Dict[str, tuple], patient_ids: List[str]):
+        """Apply observe()'s baselines for patients whose readings were stored, and queue them for persisting"""
+        for patient_id in set(patient_ids):
+            update = pending.get(patient_id)
+            if update is None:
+                continue
+            slot = self._slots.get(patient_id)
+            if slot is None:
+                # Dropped since observe(); saving checks the version the update was based on
+                slot = self._allocate(patient_id)
+                self.version[slot] = update[5]
+            elif self.generation[slot] != update[6] or self.observed_until[slot] >= update[4]:
+                # Reloaded, possibly from a newer row, or a batch with newer readings was committed meanwhile
+                continue
+            self.mean[slot], self.variance[slot], self.count[slot], self.window[slot], \
+                self.observed_until[slot] = update[:5]
+            self._dirty.add(patient_id)
+
+    def _update(self, state: Dict[str, np.ndarray], rows: np.ndarray, local: np.ndarray, values: np.ndarray,
+                present: np.ndarray, fold: np.ndarray, flagged: np.ndarray, baseline: np.ndarray,
+                z_scores: np.ndarray):
+        """One reading per patient: score against the current baseline, then fold the reading in if it is new"""
+        mean = state["mean"][local]
+        variance = state["variance"][local]
+        count = state["count"][local]
+        window = state["window"][local]
+
+        with np.errstate(invalid="ignore"):
+            z = np.abs(values - mean) / np.sqrt(variance + self.floor_variance)
+            established = present & (count >= self.min_readings)
+            recent_low = np.nanmin(np.where(established[:, :, None], window, 0), axis=2)
+            recent_high = np.nanmax(np.where(established[:, :, None], window, 0), axis=2)
+            # Compared at the window's float32 precision so a repeat of a recent value is in range
+            stored = values.astype(np.float32)
+            hit = established & (z > self.z_threshold) & ((stored < recent_low) | (stored > recent_high))
+        flagged[rows] = hit
+        baseline[rows] = mean
+        z_scores[rows] = z
+
+        present = present & fold[:, None]
+        first = present & (count == 0)
+        diff = np.where(present, values - mean, 0.0)
+        increment = self.alpha * diff
+        state["mean"][local] = np.where(first, values, mean + increment)
+        state["variance"][local] = np.where(first, 0.0, np.where(present, (1 - self.alpha) * (variance + diff * increment), variance))
+        reading, vital = np.nonzero(present)
+        state["window"][local[reading], vital, count[reading, vital] % self.window_size] = values[reading, vital]
+        state["count"][local] = count + present
+
+    def take_dirty(self) -> List[Tuple[str, bytes, Optional[datetime], int]]:
+        """Baselines changed since the last call, for persisting
+
+        Each is (patient_id, packed stats, newest reading, version to save
+        as); the row is only written if it is still at the version before.
+        """
+        dirty, self._dirty = self._dirty, set()
+        changed = []
+        for patient_id in dirty:
+            slot = self._slots[patient_id]
+            seconds = self.observed_until[slot]
+            observed_until = datetime.utcfromtimestamp(seconds) if np.isfinite(seconds) else None
+            changed.append((patient_id, self.pack(slot), observed_until, int(self.version[slot]) + 1))
+        return changed
+
+    def saved(self, changed: List[Tuple[str, bytes, Optional[datetime], int]], written: List[str]) -> List[str]:
+        """Record which of take_dirty()'s rows were written; the rest were outdated and are dropped, and returned"""
+        written = set(written)
+        stale = []
+        for patient_id, _, _, version in changed:
+            slot = self._slots.get(patient_id)
+            if patient_id not in written:
+                stale.append(patient_id)
+                if slot is not None:
+                    self._release(patient_id)
+            elif slot is not None and self.version[slot] == version - 1:
+                self.version[slot] = version
+        return stale
+
+    def mark_dirty(self, patient_ids: List[str]):
+        """Queue patients again after a failed persist"""
+        self._dirty.update(patient_id for patient_id in patient_ids if patient_id in self._slots)
+
+    def describe(self, patient_id: str) -> Optional[Dict[str, Any]]:
+        slot = self._slots.get(patient_id)
+        if slot is None:
+            return None
+        baselines = {}
+        for column, vital in enumerate(self.vitals):
+            count = int(self.count[slot, column])
+            if not count:
+                continue
+            order = (np.arange(min(count, self.window_size)) + max(0, count - self.window_size)) % self.window_size
+            baselines[vital] = {
+                "mean": round(float(self.mean[slot, column]), 2),
+                "std": round(float(np.sqrt(self.variance[slot, column])), 2),
+                "readings": count,
+                "recent": [round(float(value), 2) for value in self.window[slot, column, order]]
+            }
+        return baselines
+
+
+vitals_baselines = VitalsBaselines()
@@ -0,0 +1,266 @@
+"""
+Append-only vitals history with hourly and daily rollups
+Every synced reading is kept in a monthly range-partitioned table, and the
+rollups are maintained in the same statement so trend queries never scan raw rows
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ENABLED = os.getenv("HMS_VITALS_HISTORY_ENABLED", "true").lower() == "true"
+# Days kept per resolution; 0 keeps forever. Raw history is dropped a whole month partition at a time.
+HISTORY_RETENTION_DAYS = int(os.getenv("HMS_VITALS_HISTORY_RETENTION_DAYS", "400"))
+HOURLY_RETENTION_DAYS = int(os.getenv("HMS_VITALS_HOURLY_RETENTION_DAYS", "730"))
+DAILY_RETENTION_DAYS = int(os.getenv("HMS_VITALS_DAILY_RETENTION_DAYS", "0"))
+RETENTION_INTERVAL_SECONDS = 6 * 3600
+
+# Column order of the history table; rollups identify a vital by its position here, from 1
+HISTORY_VITALS = ["systolic_bp", "diastolic_bp", "heart_rate", "temperature", "respiratory_rate",
+                  "oxygen_saturation", "weight", "height", "bmi"]
+ROLLUP_TABLES = {"hour": "hms_vitals_hourly", "day": "hms_vitals_daily"}
+
+_vital_columns = ", ".join(HISTORY_VITALS)
+
+# Catches readings whose month partition is missing, e.g. dropped by another replica's retention
+DEFAULT_PARTITION = "hms_vitals_history_default"
+
+# Fixed-width columns only: patient row ID, timestamp and float4 readings, 48 bytes of data per row
+HISTORY_SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS hms_vitals_history (
+        patient_id integer NOT NULL,
+        recorded_at timestamp NOT NULL,
+        {", ".join(f"{name} real" for name in HISTORY_VITALS)},
+        PRIMARY KEY (patient_id, recorded_at)
+    ) PARTITION BY RANGE (recorded_at);
+    CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF hms_vitals_history DEFAULT;
+""" + "".join(f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        patient_id integer NOT NULL,
+        vital smallint NOT NULL,
+        bucket timestamp NOT NULL,
+        readings integer NOT NULL,
+        total double precision NOT NULL,
+        minimum real NOT NULL,
+        maximum real NOT NULL,
+        PRIMARY KEY (patient_id, vital, bucket)
+    );
+""" for table in ROLLUP_TABLES.values())
+
+# {source} yields (patient_id, recorded_at, *HISTORY_VITALS). Readings already in
+# history are skipped, so a re-synced batch does not count twice in the rollups;
+# zero readings mean "not taken", as in triage, and stay out of the rollups.
+APPEND_QUERY = """
+    WITH inserted AS (
+        INSERT INTO hms_vitals_history (patient_id, recorded_at, {vitals})
+        {source}
+        ON CONFLICT (patient_id, recorded_at) DO NOTHING
+        RETURNING *
+    ),
+    readings AS (
+        SELECT i.patient_id, i.recorded_at, v.vital, v.value
+        FROM inserted i
+        CROSS JOIN LATERAL (VALUES {lateral}) AS v(vital, value)
+        WHERE v.value IS NOT NULL AND v.value <> 0
+    ),
+    {rollups}
+    SELECT count(*) FROM inserted
+""".format(
+    vitals=_vital_columns,
+    source="{source}",
+    lateral=", ".join(f"({code}::smallint, i.{name})" for code, name in enumerate(HISTORY_VITALS, 1)),
+    rollups=",\n    ".join(f"""{resolution}_rollup AS (
+        INSERT INTO {table} AS r (patient_id, vital, bucket, readings, total, minimum, maximum)
+        SELECT patient_id, vital, date_trunc('{resolution}', recorded_at),
+            count(*), sum(value), min(value), max(value)
+        FROM readings GROUP BY 1, 2, 3
+        ON CONFLICT (patient_id, vital, bucket) DO UPDATE SET
+            readings = r.readings + EXCLUDED.readings,
+            total = r.total + EXCLUDED.total,
+            minimum = LEAST(r.minimum, EXCLUDED.minimum),
+            maximum = GREATEST(r.maximum, EXCLUDED.maximum)
+    )""" for resolution, table in ROLLUP_TABLES.items())
+)
+
+# Source for the COPY path: the vitals stage table of ErlessedDatabaseMapper._copy_frame
+STAGE_SOURCE = f"""
+        SELECT p.id, s.timestamp, {", ".join(f"s.{name}" for name in HISTORY_VITALS)}
+        FROM hms_bulk_stage s
+        JOIN patients p ON p.patient_id = s.patient_id
+"""
+
+# Source for prepared rows: one array parameter per column, patients already resolved
+_vital_arrays = ", ".join(f"${index}::real[]" for index in range(3, len(HISTORY_VITALS) + 3))
+ROWS_SOURCE = f"""
+        SELECT * FROM unnest($1::integer[], $2::timestamp[], {_vital_arrays})
+"""
+
+
+def partition_name(month: pd.Period) -> str:
+    return f"hms_vitals_history_{month.year:04d}{month.month:02d}"
+
+
+class VitalsHistory:
+    """Writes, rolls up, queries and expires the vitals history tables
+
+    Monthly partitions are created by prepare() before the write transaction
+    opens, so a failed or racing CREATE cannot abort it. The append methods
+    take a connection from the caller so history rows are written in the
+    same transaction as the queue rows they come with.
+    """
+
+    def __init__(self, enabled: bool = HISTORY_ENABLED):
+        self.enabled = enabled
+        self._schema_ready = False
+        self._partitions: set = set()
+
+    async def _ensure_schema(self, conn):
+        if not self._schema_ready:
+            await self._create(conn, "vitals history schema", HISTORY_SCHEMA)
+            self._schema_ready = True
+
+    async def _create(self, conn, label: str, ddl: str):
+        """Run IF NOT EXISTS DDL in its own (sub)transaction, tolerating a replica creating it concurrently"""
+        try:
+            async with conn.transaction():
+                await conn.execute(ddl)
+        except (asyncpg.exceptions.DuplicateTableError, asyncpg.exceptions.DuplicateObjectError) as e:
+            logger.warning(f"Creating {label} raced: {e}")
+        except asyncpg.exceptions.UniqueViolationError as e:
+            if not (getattr(e, 'constraint_name', None) or '').startswith('pg_'):
+                raise
+            logger.warning(f"Creating {label} raced: {e}")
+
+    async def prepare(self, conn, timestamps: pd.Series):
+        """Create the month partitions a batch needs; call outside the write transaction"""
+        if not self.enabled:
+            return
+        await self._ensure_schema(conn)
+        months = pd.to_datetime(timestamps).dropna().dt.to_period("M").unique()
+        for month in months:
+            name = partition_name(month)
+            if name in self._partitions:
+                continue
+            start = month.start_time
+            end = (month + 1).start_time
+            try:
+                await self._create(
+                    conn, name,
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF hms_vitals_history "
+                    f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+                )
+            except asyncpg.exceptions.CheckViolationError as e:
+                # The default partition already holds readings for this month; they stay there
+                # and retention removes them with the month
+                logger.warning(f"Keeping {month} vitals history in {DEFAULT_PARTITION}: {e}")
+            self._partitions.add(name)
+
+    async def _append(self, conn, *args) -> int:
+        try:
+            return await conn.fetchval(*args)
+        except asyncpg.exceptions.CheckViolationError as e:
+            if "no partition" in str(e):
+                # The cache went stale (e.g. the default partition was dropped); re-check on the next batch
+                self._schema_ready = False
+                self._partitions.clear()
+            raise
+
+    async def append_from_stage(self, conn, timestamps: pd.Series) -> int:
+        """Append the vitals staged in hms_bulk_stage; returns readings new to history"""
+        if not self.enabled:
+            return 0
+        return await self._append(conn, APPEND_QUERY.format(source=STAGE_SOURCE))
+
+    async def append_rows(self, conn, patient_ids: List[int], recorded_at: List[datetime],
+                          readings: pd.DataFrame) -> int:
+        """Append readings for resolved Erlessed patient row IDs; returns readings new to history"""
+        if not self.enabled or not patient_ids:
+            return 0
+        values = readings.reindex(columns=HISTORY_VITALS).to_numpy(dtype=float, na_value=np.nan)
+        columns = [[None if np.isnan(value) else value for value in values[:, index].tolist()]
+                   for index in range(len(HISTORY_VITALS))]
+        return await self._append(conn, APPEND_QUERY.format(source=ROWS_SOURCE), patient_ids, recorded_at, *columns)
+
+    async def enforce_retention(self, conn, now: Optional[datetime] = None) -> Dict[str, int]:
+        """Drop raw partitions and delete rollup buckets older than their retention"""
+        now = now or datetime.utcnow()
+        removed = {"partitions": 0}
+        await self._ensure_schema(conn)
+
+        if HISTORY_RETENTION_DAYS > 0:
+            cutoff = pd.Timestamp(now - timedelta(days=HISTORY_RETENTION_DAYS))
+            names = await conn.fetch(
+                """
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'hms_vitals_history'::regclass
+                """
+            )
+            for row in names:
+                if row['relname'] == DEFAULT_PARTITION:
+                    continue
+                month = pd.Period(row['relname'].rsplit("_", 1)[-1], freq="M")
+                # Only partitions whose whole month has expired
+                if (month + 1).start_time <= cutoff:
+                    await conn.execute(f"DROP TABLE IF EXISTS {row['relname']}")
+                    self._partitions.discard(row['relname'])
+                    removed["partitions"] += 1
+            status = await conn.execute(f"DELETE FROM {DEFAULT_PARTITION} WHERE recorded_at < $1",
+                                        (cutoff.to_period("M")).start_time.to_pydatetime())
+            removed["default"] = int(status.split()[-1])
+
+        for resolution, days in (("hour", HOURLY_RETENTION_DAYS), ("day", DAILY_RETENTION_DAYS)):
+            if days > 0:
+                status = await conn.execute(
+                    f"DELETE FROM {ROLLUP_TABLES[resolution]} WHERE bucket < $1", now - timedelta(days=days)
+                )
+                removed[resolution] = int(status.split()[-1])
+        if removed["partitions"] or removed.get("default") or removed.get("hour") or removed.get("day"):
+            logger.info(f"Vitals history retention removed {removed}")
+        return removed
+
+    async def fetch(self, conn, patient_id: int, resolution: str, since: datetime,
+                    until: datetime) -> List[Dict[str, Any]]:
+        """Readings ("raw") or rollup buckets ("hour", "day") for one patient, oldest first"""
+        # A replica that has not synced yet may be the first to touch the tables
+        await self._ensure_schema(conn)
+        if resolution == "raw":
+            rows = await conn.fetch(
+                f"""
+                SELECT recorded_at, {_vital_columns} FROM hms_vitals_history
+                WHERE patient_id = $1 AND recorded_at >= $2 AND recorded_at < $3
+                ORDER BY recorded_at
+                """,
+                patient_id, since, until
+            )
+            return [dict(row) for row in rows]
+
+        rows = await conn.fetch(
+            f"""
+            SELECT bucket, vital, readings, total / readings AS mean, minimum, maximum
+            FROM {ROLLUP_TABLES[resolution]}
+            WHERE patient_id = $1 AND bucket >= $2 AND bucket < $3
+            ORDER BY bucket, vital
+            """,
+            patient_id, since, until
+        )
+        buckets: List[Dict[str, Any]] = []
+        for row in rows:
+            if not buckets or buckets[-1]["bucket"] != row['bucket']:
+                buckets.append({"bucket": row['bucket'], "vitals": {}})
+            buckets[-1]["vitals"][HISTORY_VITALS[row['vital'] - 1]] = {
+                "mean": round(row['mean'], 2),
+                "min": row['minimum'],
+                "max": row['maximum'],
+                "readings": row['readings']
+            }
+        return buckets
+
+
+vitals_history = VitalsHistory()